@@ -31,6 +31,7 @@ import logging
 import os
 
 import antd.ant as ant
+import antd.reactor as reactor
 import antd.antfs as antfs
 import antd.hw as hw
 import antd.garmin as garmin
@@ -40,10 +41,14 @@ import antd.connect as connect
 
 Host = antfs.Host
 Beacon = antfs.Beacon
+Scanner = antfs.Scanner
+Dispatcher = antfs.Dispatcher
 Core = ant.Core
 Session = ant.Session
 Channel = ant.Channel
 Network = ant.Network
+EventLoop = reactor.EventLoop
+AsyncSession = reactor.AsyncSession
 Device = garmin.Device
 
 AntError = ant.AntError
@@ -56,10 +61,14 @@ __all__ = [
     "UsbAntFsHost",
     "Host",
     "Beacon",
+    "Scanner",
+    "Dispatcher",
     "Core",
     "Session",
     "Channel",
     "Network",
+    "EventLoop",
+    "AsyncSession",
     "Device",
     "AntError",
     "AntTimeoutError",
@@ -29,11 +29,19 @@
 
 import threading
 import logging
+import os
+import fcntl
+import select
 import array
 import errno
 import time
 import struct
 import collections
+import binascii
+import heapq
+import itertools
+import bisect
+import random
 
 _log = logging.getLogger("antd.ant")
 _trace = logging.getLogger("antd.trace")
@@ -75,11 +83,18 @@ EVENT_CHANNEL_COLLISION = 9
 EVENT_TRANSFER_TX_START = 10
 EVENT_SERIAL_QUE_OVERFLOW = 52
 EVENT_QUEUE_OVERFLOW = 53
+EVENT_NAMES = dict((v, k) for k, v in globals().items() if k.startswith("EVENT_"))
 # channel status
 CHANNEL_STATUS_UNASSIGNED = 0
 CHANNEL_STATUS_ASSIGNED = 1
 CHANNEL_STATUS_SEARCHING = 2
 CHANNEL_STATUS_TRACKING = 3
+# capabilities, advanced options
+CAPABILITIES_SEARCH_LIST_ENABLED = 0x80
+# inclusion / exclusion list entries per channel
+MAX_ID_LIST_SIZE = 4
+# largest length byte of a valid message (MESG_MAX_SIZE_VALUE)
+MAX_MSG_LENGTH = 41
 
 class AntError(Exception):
     """
@@ -117,7 +132,7 @@ def msg_to_string(msg):
     Retruns a string representation of
     the provided array (for debug output)
     """
-    return array.array("B", msg).tostring().encode("hex")
+    return binascii.hexlify(bytearray(msg))
 
 def is_timeout(ioerror):
     """
@@ -150,17 +165,66 @@ def validate_checksum(msg):
     """
     return generate_checksum(msg) == 0
 
-def tokenize_message(msg):
+class MessageTokenizer(object):
     """
-    A generator returning on ant messages
-    from the provided string of one or more
-    conacatinated messages.
+    Splits the byte stream read from hardware into
+    ANT messages. Each read is appended once to a
+    buffer which is then walked by offset, checksums
+    are validated in place, and messages are returned
+    as memoryviews of that buffer (no per-message copy).
+    A trailing partial message is carried over and
+    completed by the next read. On an invalid length
+    or checksum, input is resynced one byte at a time.
     """
-    while msg:
-        assert msg[0] & 0xFE == SYNC
-        length = msg[1]
-        yield msg[:4 + length]
-        msg = msg[4 + length:]
+
+    def __init__(self):
+        self.partial = bytearray()
+
+    def tokenize(self, data):
+        """
+        A generator returning (msg_id, msg) for each
+        complete message in data (and any carried over
+        partial message). msg is a memoryview of the
+        entire message including sync and checksum.
+        Views stay valid after subsequent reads, each
+        read is tokenized from a new buffer.
+        """
+        buf = self.partial
+        buf += buffer(data)
+        self.partial = bytearray()
+        view = memoryview(buf)
+        end = len(buf)
+        offset = 0
+        while offset < end:
+            if buf[offset] & 0xFE != SYNC:
+                # lost sync, skip ahead to next possible message
+                start = offset
+                offset += 1
+                while offset < end and buf[offset] & 0xFE != SYNC: offset += 1
+                _log.warning("Discarding %d byte(s), expected SYNC. %s", offset - start, msg_to_string(view[start:offset]))
+                continue
+            if offset + 1 >= end:
+                break
+            if buf[offset + 1] > MAX_MSG_LENGTH:
+                # not a message, resync from next byte
+                _log.error("Invalid length, discarding SYNC. %s", msg_to_string(view[offset:offset + 2]))
+                offset += 1
+                continue
+            msg_end = offset + 4 + buf[offset + 1]
+            if msg_end > end:
+                break
+            checksum = 0
+            for n in xrange(offset, msg_end): checksum ^= buf[n]
+            if checksum:
+                # length may be corrupt, messages may follow within
+                # the claimed frame. resync from next byte.
+                _log.error("Invalid checksum, discarding SYNC. %s", msg_to_string(view[offset:msg_end]))
+                offset += 1
+            else:
+                yield buf[offset + 2], view[offset:msg_end]
+                offset = msg_end
+        if offset < end:
+            self.partial = buf[offset:]
 
 def data_tostring(data):
     """
@@ -195,13 +259,6 @@ def always_retry_policy(error):
 def never_retry_policy(error):
     return False
 
-def wait_and_retry_policy(error):
-    if default_retry_policy(error):
-        time.sleep(1)
-        return True
-    else:
-        return False
-
 # matcher define the strategry to determine
 # if an incoming message from ANT device sould
 # udpate the status of a running command.
@@ -264,82 +321,146 @@ def send_data_validator(request, reply):
     elif not (isinstance(reply, ChannelEvent) and reply.msg_id == 1 and reply.msg_code in (EVENT_TX, EVENT_TRANSFER_TX_COMPLETED)):
         return default_validator(request, reply)
 
-def message(direction, name, id, pack_format, arg_names, retry_policy=default_retry_policy, matcher=default_matcher, validator=default_validator):
+# source for the per-message methods compiled by message(), one
+# direct attribute assignment per argument, no intermediate tuples
+# args may include device numbers, bound the cache so
+# a long running daemon seeing many devices doesn't grow
+MAX_PACKED_CACHE_SIZE = 64
+
+class Message(object):
     """
-    Return a class supporting basic packing
-    operations with the give metadata.
+    Base of the message classes returned by message().
+    Each class has __slots__ for its args, and its
+    struct, packed header and header checksum built
+    once as class attributes, read by these methods.
     """
-    # pre-create the struct used to pack/unpack this message format
-    if pack_format:
-        byte_order_and_size = ""
-        if pack_format[0] not in ("@", "=", "<", ">", "!"):
-            # apply default by order and size
-            byte_order_and_size = "<"
-        msg_struct = struct.Struct(byte_order_and_size + pack_format)
-    else:
-        msg_struct = None
 
-    # create named-tuple used to converting *arg, **kwds to this messages args
-    msg_arg_tuple = collections.namedtuple(name, arg_names)
+    __slots__ = ()
 
-    # class representing the message definition pased to this method
-    class Message(object):
+    DIRECTION = None
+    NAME = None
+    ID = None
+    ARG_NAMES = ()
+    RETRY_BACKOFF = False
 
-        DIRECTION = direction
-        NAME = name
-        ID = id
+    _struct = None
+    _header = None
+    _header_checksum = 0
+    _packed_cache = None
+    _str_format = None
 
-        def __init__(self, *args, **kwds):
-            tuple = msg_arg_tuple(*args, **kwds)
-            self.__dict__.update(tuple._asdict())
+    def __init__(self, *args):
+        for name, value in zip(self.ARG_NAMES, args):
+            setattr(self, name, value)
 
-        @property
-        def args(self):
-            return msg_arg_tuple(**dict((k, v) for k, v in self.__dict__.items() if k in arg_names))
+    @classmethod
+    def unpack_args(cls, packed_args):
+        # subclasses may change __init__'s signature, set the slots directly
+        self = object.__new__(cls)
+        if cls._struct: Message.__init__(self, *cls._struct.unpack_from(packed_args))
+        else: Message.__init__(self, *[None] * len(cls.ARG_NAMES))
+        return self
 
-        @classmethod
-        def unpack_args(cls, packed_args):
-            try: return Message(*msg_struct.unpack(packed_args))
-            except AttributeError: return Message(*([None] * len(arg_names)))
+    @property
+    def args(self):
+        return tuple([getattr(self, name) for name in self.ARG_NAMES])
 
-        def pack_args(self):
-            try: return msg_struct.pack(*self.args)
-            except AttributeError: pass
-        
-        def pack_size(self):
-            try: return msg_struct.size
-            except AttributeError: return 0
+    def pack_args(self):
+        if self._struct: return self._struct.pack(*self.args)
 
-        def is_retryable(self, err):
-            return retry_policy(err)
+    def pack_size(self):
+        return self._struct.size if self._struct else 0
 
-        def is_reply(self, cmd):
-            return matcher(self, cmd)
+    def pack(self):
+        """
+        Return the complete message (sync, length,
+        id, args, checksum) to be written to hardware.
+        """
+        if self._struct:
+            args = self.args
+            packed_cache = self._packed_cache
+            if packed_cache is not None:
+                try: return packed_cache[args]
+                except KeyError: pass
+            packed_args = self._struct.pack(*args)
+            checksum = self._header_checksum
+            for byte in bytearray(packed_args): checksum ^= byte
+            msg = self._header + packed_args + chr(checksum)
+            if packed_cache is not None and len(packed_cache) < MAX_PACKED_CACHE_SIZE:
+                packed_cache[args] = msg
+            return msg
+
+    def is_retryable(self, err):
+        return self._retry_policy(err)
 
-        def validate_reply(self, cmd):
-            return validator(self, cmd)
+    def is_reply(self, cmd):
+        return self._matcher(cmd)
 
-        def __str__(self):
-            return str(self.args)
+    def validate_reply(self, cmd):
+        return self._validator(cmd)
 
-    return Message
+    def __str__(self):
+        return self._str_format % self.args
+
+def message(direction, name, id, pack_format, arg_names, retry_policy=default_retry_policy, matcher=default_matcher, validator=default_validator, cache_packed=False, retry_backoff=False):
+    """
+    Return a Message class with the given metadata.
+    The class uses __slots__ and has its struct and
+    packed header pre-built. If cache_packed,
+    the packed message is saved for each distinct
+    set of args (for constant config commands), up
+    to MAX_PACKED_CACHE_SIZE sets per message.
+    If retry_backoff, Session waits before each
+    retry (see Session.retry_backoff()).
+    """
+    # pre-create the struct used to pack/unpack this message format
+    if pack_format:
+        byte_order_and_size = ""
+        if pack_format[0] not in ("@", "=", "<", ">", "!"):
+            # apply default by order and size
+            byte_order_and_size = "<"
+        msg_struct = struct.Struct(byte_order_and_size + pack_format)
+    else:
+        msg_struct = None
+
+    arg_names = tuple(arg_names)
+    header = struct.pack("BBB", SYNC, msg_struct.size if msg_struct else 0, id or 0)
+    return type(name, (Message,), {
+        "__slots__": arg_names,
+        "DIRECTION": direction,
+        "NAME": name,
+        "ID": id,
+        "ARG_NAMES": arg_names,
+        "RETRY_BACKOFF": retry_backoff,
+        "_struct": msg_struct,
+        "_header": header,
+        "_header_checksum": generate_checksum(bytearray(header)),
+        "_packed_cache": {} if cache_packed else None,
+        "_str_format": name + "(" + ", ".join(n + "=%r" for n in arg_names) + ")",
+        # matcher and validator are called as methods, retry policy with the error only
+        "_retry_policy": staticmethod(retry_policy),
+        "_matcher": matcher,
+        "_validator": validator,
+    })
 
 # ANT Message Protocol Definitions
-UnassignChannel = message(DIR_OUT, "UNASSIGN_CHANNEL", 0x41, "B", ["channel_number"], retry_policy=timeout_retry_policy)
-AssignChannel = message(DIR_OUT, "ASSIGN_CHANNEL", 0x42, "BBB", ["channel_number", "channel_type", "network_number"], retry_policy=timeout_retry_policy)
-SetChannelId = message(DIR_OUT, "SET_CHANNEL_ID", 0x51, "BHBB", ["channel_number", "device_number", "device_type_id", "trans_type"], retry_policy=timeout_retry_policy)
-SetChannelPeriod = message(DIR_OUT, "SET_CHANNEL_PERIOD", 0x43, "BH", ["channel_number", "messaging_period"], retry_policy=timeout_retry_policy) 
-SetChannelSearchTimeout = message(DIR_OUT, "SET_CHANNEL_SEARCH_TIMEOUT", 0x44, "BB", ["channel_number", "search_timeout"], retry_policy=timeout_retry_policy)
-SetChannelRfFreq = message(DIR_OUT, "SET_CHANNEL_RF_FREQ", 0x45, "BB", ["channel_number", "rf_freq"], retry_policy=timeout_retry_policy)
-SetNetworkKey = message(DIR_OUT, "SET_NETWORK_KEY", 0x46, "B8s", ["network_number", "network_key"], retry_policy=timeout_retry_policy)
-ResetSystem = message(DIR_OUT, "RESET_SYSTEM", 0x4a, "x", [], retry_policy=always_retry_policy, matcher=reset_matcher)
-OpenChannel = message(DIR_OUT, "OPEN_CHANNEL", 0x4b, "B", ["channel_number"], retry_policy=timeout_retry_policy)
-CloseChannel = message(DIR_OUT, "CLOSE_CHANNEL", 0x4c, "B", ["channel_number"], retry_policy=timeout_retry_policy, matcher=close_channel_matcher, validator=close_channel_validator)
-RequestMessage = message(DIR_OUT, "REQUEST_MESSAGE", 0x4d, "BB", ["channel_number", "msg_id"], retry_policy=timeout_retry_policy, matcher=request_message_matcher)
-SetSearchWaveform = message(DIR_OUT, "SET_SEARCH_WAVEFORM", 0x49, "BH", ["channel_number", "waveform"], retry_policy=timeout_retry_policy)
+UnassignChannel = message(DIR_OUT, "UNASSIGN_CHANNEL", 0x41, "B", ["channel_number"], retry_policy=timeout_retry_policy, cache_packed=True)
+AssignChannel = message(DIR_OUT, "ASSIGN_CHANNEL", 0x42, "BBB", ["channel_number", "channel_type", "network_number"], retry_policy=timeout_retry_policy, cache_packed=True)
+SetChannelId = message(DIR_OUT, "SET_CHANNEL_ID", 0x51, "BHBB", ["channel_number", "device_number", "device_type_id", "trans_type"], retry_policy=timeout_retry_policy, cache_packed=True)
+SetChannelPeriod = message(DIR_OUT, "SET_CHANNEL_PERIOD", 0x43, "BH", ["channel_number", "messaging_period"], retry_policy=timeout_retry_policy, cache_packed=True)
+SetChannelSearchTimeout = message(DIR_OUT, "SET_CHANNEL_SEARCH_TIMEOUT", 0x44, "BB", ["channel_number", "search_timeout"], retry_policy=timeout_retry_policy, cache_packed=True)
+SetChannelRfFreq = message(DIR_OUT, "SET_CHANNEL_RF_FREQ", 0x45, "BB", ["channel_number", "rf_freq"], retry_policy=timeout_retry_policy, cache_packed=True)
+SetNetworkKey = message(DIR_OUT, "SET_NETWORK_KEY", 0x46, "B8s", ["network_number", "network_key"], retry_policy=timeout_retry_policy, cache_packed=True)
+ResetSystem = message(DIR_OUT, "RESET_SYSTEM", 0x4a, "x", [], retry_policy=always_retry_policy, matcher=reset_matcher, cache_packed=True)
+OpenChannel = message(DIR_OUT, "OPEN_CHANNEL", 0x4b, "B", ["channel_number"], retry_policy=timeout_retry_policy, cache_packed=True)
+CloseChannel = message(DIR_OUT, "CLOSE_CHANNEL", 0x4c, "B", ["channel_number"], retry_policy=timeout_retry_policy, matcher=close_channel_matcher, validator=close_channel_validator, cache_packed=True)
+RequestMessage = message(DIR_OUT, "REQUEST_MESSAGE", 0x4d, "BB", ["channel_number", "msg_id"], retry_policy=timeout_retry_policy, matcher=request_message_matcher, cache_packed=True)
+SetSearchWaveform = message(DIR_OUT, "SET_SEARCH_WAVEFORM", 0x49, "BH", ["channel_number", "waveform"], retry_policy=timeout_retry_policy, cache_packed=True)
+AddChannelIdToList = message(DIR_OUT, "ADD_CHANNEL_ID_TO_LIST", 0x59, "BHBBB", ["channel_number", "device_number", "device_type_id", "trans_type", "list_index"], retry_policy=timeout_retry_policy)
+ConfigIdList = message(DIR_OUT, "CONFIG_ID_LIST", 0x5a, "BBB", ["channel_number", "list_size", "exclude"], retry_policy=timeout_retry_policy, cache_packed=True)
 SendBroadcastData = message(DIR_OUT, "SEND_BROADCAST_DATA", 0x4e, "B8s", ["channel_number", "data"], matcher=send_data_matcher, validator=send_data_validator)
-SendAcknowledgedData = message(DIR_OUT, "SEND_ACKNOWLEDGED_DATA", 0x4f, "B8s", ["channel_number", "data"], retry_policy=wait_and_retry_policy, matcher=send_data_matcher, validator=send_data_validator)
-SendBurstTransferPacket = message(DIR_OUT, "SEND_BURST_TRANSFER_PACKET", 0x50, "B8s", ["channel_number", "data"], retry_policy=wait_and_retry_policy, matcher=send_data_matcher, validator=send_data_validator)
+SendAcknowledgedData = message(DIR_OUT, "SEND_ACKNOWLEDGED_DATA", 0x4f, "B8s", ["channel_number", "data"], matcher=send_data_matcher, validator=send_data_validator, retry_backoff=True)
+SendBurstTransferPacket = message(DIR_OUT, "SEND_BURST_TRANSFER_PACKET", 0x50, "B8s", ["channel_number", "data"], matcher=send_data_matcher, validator=send_data_validator, retry_backoff=True)
 StartupMessage = message(DIR_IN, "STARTUP_MESSAGE", 0x6f, "B", ["startup_message"])
 SerialError = message(DIR_IN, "SERIAL_ERROR", 0xae, None, ["error_number", "msg_contents"])
 RecvBroadcastData = message(DIR_IN, "RECV_BROADCAST_DATA", 0x4e, "B8s", ["channel_number", "data"])
@@ -349,22 +470,15 @@ ChannelEvent = message(DIR_IN, "CHANNEL_EVENT", 0x40, "BBB", ["channel_number",
 ChannelStatus = message(DIR_IN, "CHANNEL_STATUS", 0x52, "BB", ["channel_number", "channel_status"])
 ChannelId = message(DIR_IN, "CHANNEL_ID", 0x51, "BHBB", ["channel_number", "device_number", "device_type_id", "man_id"])
 AntVersion = message(DIR_IN, "VERSION", 0x3e, "11s", ["ant_version"])
-#Capabilities = message(DIR_IN, "CAPABILITIES", 0x54, "BBBBBx", ["max_channels", "max_networks", "standard_opts", "advanced_opts1", "advanced_opts2"])
+# capabilites may be 4 (AP1) or 6 (AP2) bytes, unpack_from ignores the trailing AP2 options
+Capabilities = message(DIR_IN, "CAPABILITIES", 0x54, "BBBB", ["max_channels", "max_networks", "standard_opts", "advanced_opts1"])
 SerialNumber = message(DIR_IN, "SERIAL_NUMBER", 0x61, "I", ["serial_number"])
 # Synthetic Commands
 UnimplementedCommand = message(None, "UNIMPLEMENTED_COMMAND", None, None, ["msg_id", "msg_contents"])
 
-# hack, capabilites may be 4 (AP1) or 6 (AP2) bytes
-class Capabilities(message(DIR_IN, "CAPABILITIES", 0x54, "BBBB", ["max_channels", "max_networks", "standard_opts", "advanced_opts1"])):
-
-    @classmethod
-    def unpack_args(cls, packed_args):
-        return super(Capabilities, cls).unpack_args(packed_args[:4])
-
-
 ALL_ANT_COMMANDS = [ UnassignChannel, AssignChannel, SetChannelId, SetChannelPeriod, SetChannelSearchTimeout,
                      SetChannelRfFreq, SetNetworkKey, ResetSystem, OpenChannel, CloseChannel, RequestMessage,
-                     SetSearchWaveform, SendBroadcastData, SendAcknowledgedData, SendBurstTransferPacket,
+                     SetSearchWaveform, AddChannelIdToList, ConfigIdList, SendBroadcastData, SendAcknowledgedData, SendBurstTransferPacket,
                      StartupMessage, SerialError, RecvBroadcastData, RecvAcknowledgedData, RecvBurstTransferPacket,
                      ChannelEvent, ChannelStatus, ChannelId, AntVersion, Capabilities, SerialNumber ]
 
@@ -377,11 +491,15 @@ class ReadData(RequestMessage):
     an ugly hack so that channel status causes exceptions in read.
     """
 
+    __slots__ = ("data_type",)
+
+    NAME = "READ_DATA"
+
     def __init__(self, channel_id, data_type):
         super(ReadData, self).__init__(channel_id, ChannelStatus.ID)
         self.data_type = data_type
     
-    def is_retryable(self):
+    def is_retryable(self, err):
         return False
 
     def is_reply(self, cmd):
@@ -394,27 +512,26 @@ class ReadData(RequestMessage):
         return AntChannelClosedError("Channel closed. %s" % cmd)
     
     def __str__(self):
-        return "ReadData(channel_number=%d)" % self.channel_number
+        return "READ_DATA(channel_number=%d)" % self.channel_number
 
 class SendBurstData(SendBurstTransferPacket):
 
-    data = None
-    channel_number = None
+    __slots__ = ("seq_num", "index", "has_more_data", "start_time")
+
+    NAME = "SEND_BURST_DATA"
 
     def __init__(self, channel_number, data):
         if len(data) <= 8: channel_number |= 0x80
         super(SendBurstData, self).__init__(channel_number, data)
 
-    @property
-    def done(self):
-        return self._done
-
-    @done.setter
-    def done(self, value):
-        self._done = value
+    def restart(self):
+        """
+        (re)start the transfer, first packet is sequence 0.
+        """
         self.seq_num = 0
         self.index = 0
-        self.incr_packet_index()
+        self.has_more_data = True
+        self.start_time = time.time()
 
     def create_next_packet(self):
         """
@@ -425,20 +542,98 @@ class SendBurstData(SendBurstTransferPacket):
         data = self.data[self.index:self.index + 8]
         channel_number = self.channel_number | ((self.seq_num & 0x03) << 5) | (0x80 if is_last_packet else 0x00)
         return SendBurstTransferPacket(channel_number, data)
-    
-    def incr_packet_index(self):
+
+    def pack_next_packets(self, max_size):
+        """
+        Return (count, msg), the next count packets of
+        this burst packed back-to-back into a single
+        message no larger than max_size (at least one
+        packet is always returned). Like create_next_packet()
+        the index is not updated until incr_packet_index().
+        """
+        index, seq_num = self.index, self.seq_num
+        packets = []
+        size = 0
+        while True:
+            msg = self.create_next_packet().pack()
+            packets.append(msg)
+            size += len(msg)
+            self.incr_packet_index()
+            if not self.has_more_data or size + len(msg) > max_size: break
+        self.index, self.seq_num, self.has_more_data = index, seq_num, True
+        return len(packets), "".join(packets)
+
+    def incr_packet_index(self, count=1):
         """
         Increment the pointer for data in next packet.
         create_next_packet() will update index until
         this method is called.
         """
-        self.seq_num += 1
-        if not self.seq_num & 0x03: self.seq_num += 1
-        self.index += 8
+        for n in xrange(0, count):
+            # sequence is 0 for first packet, then rolls over 1, 2, 3, 1, ...
+            self.seq_num += 1
+            if not self.seq_num & 0x03: self.seq_num += 1
+            self.index += 8
         self.has_more_data = self.index < len(self.data)
 
     def __str__(self):
-        return "SEND_BURST_COMMAND(channel_number=%d)" % self.channel_number
+        return "SEND_BURST_DATA(channel_number=%d)" % self.channel_number
+
+class CommandBatch(object):
+    """
+    Config commands for one channel, written to the
+    device together (as few writes as possible), with
+    replies collected afterwards. Each reply identifies
+    the command (by message id) it answers. The batch
+    completes once every command is acknowledged, or
+    fails with the first error. Retry resends the whole
+    batch, config commands are idempotent.
+    """
+
+    DIRECTION = DIR_OUT
+    NAME = "COMMAND_BATCH"
+    RETRY_BACKOFF = False
+
+    def __init__(self, channel_number, commands):
+        self.channel_number = channel_number
+        self.commands = commands
+        self.restart()
+
+    def restart(self):
+        self.pending = list(self.commands)
+        self.replies = []
+        self.error = None
+
+    def pack_messages(self, max_size):
+        """
+        Return the packed commands, concatenated into
+        as few messages of at most max_size as possible.
+        """
+        msgs = []
+        for cmd in self.commands:
+            msg = cmd.pack()
+            if msgs and len(msgs[-1]) + len(msg) <= max_size: msgs[-1] += msg
+            else: msgs.append(msg)
+        return msgs
+
+    def is_retryable(self, err):
+        return all(cmd.is_retryable(err) for cmd in self.commands)
+
+    def is_reply(self, reply):
+        for cmd in self.pending:
+            if cmd.is_reply(reply):
+                self.replies.append(reply)
+                self.pending.remove(cmd)
+                self.error = cmd.validate_reply(reply)
+                return self.error is not None or not self.pending
+        return False
+
+    def validate_reply(self, reply):
+        return self.error
+
+    def __str__(self):
+        return "COMMAND_BATCH(channel_number=%d, commands=[%s])" % (
+                self.channel_number, ", ".join(str(cmd) for cmd in self.commands))
 
 
 class Core(object):
@@ -449,6 +644,9 @@ class Core(object):
     def __init__(self, hardware, messages=ALL_ANT_COMMANDS):
         self.hardware = hardware
         self.input_msg_by_id = dict((m.ID, m) for m in messages if m.DIRECTION == DIR_IN)
+        self.tokenizer = MessageTokenizer()
+        # largest message which can be passed to write(), less padding
+        self.max_write_size = getattr(hardware, "max_write_size", 64) - 2
         # per ant protocol doc, writing 15 zeros
         # should reset internal state of device.
         #self.hardware.write([0] * 15, 100)
@@ -458,36 +656,28 @@ class Core(object):
 
     def pack(self, command):
         """
-        Return an array of bytes representing
+        Return a string of bytes representing
         the data which needs to be written to
         hardware to execute the given command.
         """
         if command.ID is not None:
             if command.DIRECTION != DIR_OUT:
                 _log.warning("Request to pack input message. %s", command)
-            msg = [SYNC, command.pack_size(), command.ID]
-            msg_args = command.pack_args()
-            if msg_args is not None:
-                msg.extend(array.array("B", msg_args))
-                msg.append(generate_checksum(msg))
-                return msg
+            return command.pack()
     
-    def unpack(self, msg):
+    def unpack(self, msg_id, msg):
         """
-        Return the command represented by
-        the given byte ANT array.
+        Return the command represented by the given
+        ANT message (as returned by MessageTokenizer).
+        Checksum must already be validated.
         """
-        if not validate_checksum(msg):
-            _log.error("Invalid checksum, mesage discarded. %s", msg_to_string(msg))
-            return None
-        sync, length, msg_id = msg[:3]
         try:
             command_class = self.input_msg_by_id[msg_id]
         except (KeyError):
             _log.warning("Attempt to unpack unkown message (0x%02x). %s", msg_id, msg_to_string(msg))
-            return UnimplementedCommand(msg_id, msg)
+            return UnimplementedCommand(msg_id, msg.tobytes())
         else:
-            return command_class.unpack_args(array.array("B", msg[3:-1]).tostring())
+            return command_class.unpack_args(msg[3:-1])
 
     def send(self, command, timeout=100):
         """
@@ -499,20 +689,46 @@ class Core(object):
         """
         msg = self.pack(command)
         if not msg: return True
-        _trace.debug("SEND: %s", msg_to_string(msg))
+        return self.write(msg, timeout)
+
+    def write(self, msg, timeout=100):
+        """
+        Write one (or more concatenated) packed
+        messages to hardware. Returns false if the
+        device nack'd the write, caller should retry.
+        """
+        if _trace.isEnabledFor(logging.DEBUG): _trace.debug("SEND: %s", msg_to_string(msg))
         # ant protocol states \x00\x00 padding is optional.
         # libusb01 is quirky when using multiple threads?
         # adding the \00's seems to help with occasional issue
         # where read can block indefinitely until more data
         # is received.
-        msg.extend([0] * 2)
         try:
-            self.hardware.write(msg, timeout)
+            self.hardware.write(msg + "\x00\x00", timeout)
             return True
         except IOError as err:
             if is_timeout(err): return False
             else: raise
 
+    def read(self, timeout=1000):
+        """
+        Return the list of commands parsed from a
+        single read of the ant device, or None if
+        the read timed out.
+        """
+        try:
+            data = self.hardware.read(timeout)
+        except IOError as err:
+            if is_timeout(err): return None
+            else: raise
+        result = []
+        # tokenize message (possibly more than on per read)
+        for msg_id, msg in self.tokenizer.tokenize(data):
+            if _trace.isEnabledFor(logging.DEBUG): _trace.debug("RECV: %s", msg_to_string(msg))
+            cmd = self.unpack(msg_id, msg)
+            if cmd: result.append(cmd)
+        return result
+
     def recv(self, timeout=1000):
         """
         A generator which return commands
@@ -520,37 +736,524 @@ class Core(object):
         StopIteration raised when input stream empty.
         """
         while True:
-            try:
-                # tokenize message (possibly more than on per read)
-                for msg in tokenize_message(self.hardware.read(timeout)):
-                    _trace.debug("RECV: %s", msg_to_string(msg))
-                    cmd = self.unpack(msg)
-                    if cmd: yield cmd
-            except IOError as err:
-                # iteration terminates on timeout
-                if is_timeout(err): raise StopIteration()
-                else: raise
+            cmds = self.read(timeout)
+            # iteration terminates on timeout
+            if cmds is None: return
+            for cmd in cmds: yield cmd
+
+
+class RecvBuffer(object):
+    """
+    Data received on a channel, waiting to be read.
+    Acknowledged data and completed bursts are queued
+    separately, tagged with arrival order, so every
+    kind of read is O(1). Burst packets are assembled
+    in a reusable bytearray. Queues are bounded, when
+    full the oldest data is dropped (and counted).
+    """
+
+    def __init__(self, channel_number, max_queued=64, max_burst_size=0x10000):
+        self.channel_number = channel_number
+        self.max_burst_size = max_burst_size
+        self.acks = collections.deque(maxlen=max_queued)
+        self.bursts = collections.deque(maxlen=max_queued)
+        self.dropped = 0
+        # completed bursts, and time from first to last packet
+        self.bursts_received = 0
+        self.burst_bytes_received = 0
+        self.burst_seconds = 0.0
+        self._seq = itertools.count()
+        self._burst = bytearray(1024)
+        self._burst_len = 0
+        self._burst_overflow = False
+        self._burst_start = None
+
+    def add_ack(self, msg):
+        self._append(self.acks, msg)
+
+    def add_burst_packet(self, msg):
+        """
+        Append packet to the burst being received,
+        queuing the burst if this is the last packet.
+        """
+        if not (msg.channel_number & 0x60) and (self._burst_len or self._burst_overflow):
+            _log.warning("Burst transfer restarted, discarding %d bytes. channel_number=%d", self._burst_len, self.channel_number)
+            self.discard_burst()
+        if self._burst_start is None: self._burst_start = time.time()
+        end = self._burst_len + len(msg.data)
+        if end > self.max_burst_size:
+            if not self._burst_overflow:
+                _log.warning("Burst transfer exceeds %d bytes, discarding. channel_number=%d", self.max_burst_size, self.channel_number)
+                self._burst_overflow = True
+                self.dropped += 1
+        elif not self._burst_overflow:
+            if end > len(self._burst):
+                self._burst.extend(bytearray(max(len(self._burst), end - len(self._burst))))
+            self._burst[self._burst_len:end] = msg.data
+            self._burst_len = end
+        # burst complete, make the complete burst available for read.
+        if msg.channel_number & 0x80:
+            if not self._burst_overflow:
+                _log.debug("Burst transfer completed, marking %d bytes available for read.", self._burst_len)
+                data = str(buffer(self._burst, 0, self._burst_len))
+                self._append(self.bursts, RecvBurstTransferPacket(self.channel_number, data))
+                self.bursts_received += 1
+                self.burst_bytes_received += self._burst_len
+                self.burst_seconds += time.time() - self._burst_start
+            self.discard_burst()
+
+    def discard_burst(self):
+        self._burst_len = 0
+        self._burst_overflow = False
+        self._burst_start = None
+
+    def peek(self, data_type):
+        """
+        Return the oldest buffered message of the given
+        type, acknowledged data, burst, or (for ReadData)
+        either. The message remains buffered.
+        """
+        queue = self._queue(data_type)
+        if queue: return queue[0][1]
+
+    def pop(self, data_type):
+        """
+        Remove the message returned by peek().
+        """
+        self._queue(data_type).popleft()
+
+    def _queue(self, data_type):
+        if data_type == RecvAcknowledgedData:
+            return self.acks
+        elif data_type == RecvBurstTransferPacket:
+            return self.bursts
+        elif not self.acks or (self.bursts and self.bursts[0][0] < self.acks[0][0]):
+            return self.bursts
+        else:
+            return self.acks
+
+    def _append(self, queue, msg):
+        if len(queue) == queue.maxlen:
+            self.dropped += 1
+            _log.warning("Receive buffer full, dropping oldest data. channel_number=%d dropped=%d", self.channel_number, self.dropped)
+        queue.append((next(self._seq), msg))
+
+    def __len__(self):
+        return len(self.acks) + len(self.bursts)
+
+
+def command_scope(cmd):
+    """
+    Return the scope in which cmd executes. At most
+    one command per scope is outstanding. Channel
+    commands are scoped to the channel, network
+    commands to the network, anything else to the
+    system (None).
+    """
+    if getattr(cmd, "channel_number", None) is not None:
+        return ("channel", 0x1f & cmd.channel_number)
+    elif getattr(cmd, "network_number", None) is not None:
+        return ("network", cmd.network_number)
+
+
+class PipeEvent(object):
+    """
+    An auto-reset event signaled over a pipe. A timed
+    wait() is a select(), which wakes immediately when
+    set, unlike python2's polling Event.wait(timeout).
+    """
+
+    _r = _w = None
+
+    def __init__(self):
+        self._r, self._w = os.pipe()
+        for fd in (self._r, self._w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def close(self):
+        if self._r is not None:
+            os.close(self._r)
+            os.close(self._w)
+            self._r = self._w = None
+
+    def __del__(self):
+        # e.g. WakeEvent's pipe of a thread which has exited
+        self.close()
+
+    def set(self):
+        try: os.write(self._w, "x")
+        except OSError as e:
+            # pipe full, event is already set
+            if e.errno != errno.EAGAIN: raise
+
+    def wait(self, timeout=None):
+        """
+        Wait up to timeout seconds (forever if None) for
+        set(). Return true, and reset the event, if it was
+        set. May return false early if a signal is handled.
+        """
+        try:
+            if not select.select([self._r], [], [], None if timeout is None else max(0, timeout))[0]:
+                return False
+        except select.error as e:
+            if e.args[0] != errno.EINTR: raise
+            return False
+        try: os.read(self._r, 4096)
+        except OSError as e:
+            if e.errno != errno.EAGAIN: raise
+        return True
+
+
+class WakeEvent(object):
+    """
+    A flag set once, like threading.Event, but waiters
+    block in their thread's PipeEvent, so they wake as
+    soon as set() is called, and an untimed wait can be
+    interrupted (Ctrl-C) on python2.
+    """
+
+    _local = threading.local()
+
+    def __init__(self):
+        self._flag = False
+        self._waiters = []
+        self._lock = threading.Lock()
+
+    def is_set(self):
+        return self._flag
+
+    def set(self):
+        with self._lock:
+            self._flag = True
+            waiters, self._waiters = self._waiters, []
+        for waiter in waiters: waiter.set()
+
+    def wait(self, timeout=None):
+        """
+        Wait until set, or timeout seconds. Return true if set.
+        """
+        # one pipe per thread, reused for every wait, and
+        # closed when the thread exits (see PipeEvent.__del__)
+        waiter = getattr(self._local, "pipe", None)
+        if waiter is None: waiter = self._local.pipe = PipeEvent()
+        deadline = None if timeout is None else time.time() + timeout
+        with self._lock:
+            if self._flag: return True
+            self._waiters.append(waiter)
+        try:
+            while not self._flag:
+                if deadline is None: waiter.wait()
+                elif not waiter.wait(deadline - time.time()) and time.time() >= deadline: break
+        finally:
+            with self._lock:
+                if waiter in self._waiters: self._waiters.remove(waiter)
+        return self._flag
+
+
+class CommandFuture(object):
+    """
+    Pending result of a command submitted to
+    Session. Each attempt to execute the command
+    gets a new done event and expiration. result()
+    blocks until the command completes, retrying
+    failed attempts as allowed by retry policy.
+    """
+
+    def __init__(self, session, cmd, timeout, retry, transform=None):
+        self.session = session
+        self.cmd = cmd
+        self.scope = command_scope(cmd)
+        self.timeout = timeout
+        self.retry = retry
+        self.transform = transform
+        self.tries = 0
+        self.start_time = None
+        self.expiration = None
+        self.done = WakeEvent()
+        self.value = None
+        self.error = None
+        self._finished = WakeEvent()
+        self._callbacks = []
+
+    @property
+    def finished(self):
+        return self._finished.is_set()
+
+    def result(self):
+        """
+        Block until the command has completed (including
+        retries) and return its reply, or raise its error.
+        """
+        return self.session._wait(self)
+
+    def add_done_callback(self, fn):
+        """
+        Call fn(future) once the command has completed,
+        immediately if it already has. Callback may be
+        invoked on the session's loop thread, and must
+        not block.
+        """
+        self._callbacks.append(fn)
+        if self.finished: self._run_callbacks([fn])
+
+    def _outcome(self):
+        if self.error is not None:
+            raise self.error
+        return self.transform(self.value) if self.transform else self.value
+
+    def _finish(self):
+        self._finished.set()
+        self._run_callbacks(self._callbacks)
+
+    def _run_callbacks(self, callbacks):
+        for fn in callbacks:
+            try: fn(self)
+            except Exception: _log.warning("Callback failed. %s", self, exc_info=True)
+
+    def __str__(self):
+        return str(self.cmd)
+
+
+class DeadlineScheduler(object):
+    """
+    Deadlines of running commands, ordered by expiration.
+    Shared by the session loop thread, which bounds each
+    hardware read by the next deadline, and callers, which
+    wait on a command's done event exactly until its deadline.
+    Whichever thread observes a deadline first expires the
+    command, so expiration does not depend on USB read wakeups.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._heap = []
+        self._seq = itertools.count()
+
+    def schedule(self, future):
+        """
+        Track future.expiration. A future is rescheduled
+        for each retry, stale entries are discarded lazily.
+        """
+        if future.expiration is not None:
+            with self._lock:
+                heapq.heappush(self._heap, (future.expiration, next(self._seq), future))
+
+    def next_timeout(self, max_timeout):
+        """
+        Seconds until the next pending deadline,
+        but no greater than max_timeout.
+        """
+        with self._lock:
+            self._discard_stale()
+            if self._heap:
+                return max(0, min(max_timeout, self._heap[0][0] - time.time()))
+        return max_timeout
+
+    def expired(self):
+        """
+        Remove and return all commands which
+        are still running, but past their deadline.
+        """
+        result = []
+        now = time.time()
+        with self._lock:
+            self._discard_stale()
+            while self._heap and self._heap[0][0] <= now:
+                result.append(heapq.heappop(self._heap)[2])
+                self._discard_stale()
+        return result
+
+    def _discard_stale(self):
+        while self._heap:
+            expiration, seq, future = self._heap[0]
+            if future.done.is_set() or future.expiration != expiration:
+                heapq.heappop(self._heap)
+            else:
+                break
+
+
+class LatencyHistogram(object):
+    """
+    Counts of samples (seconds) by upper bound of
+    fixed buckets (milliseconds), with min/max/mean.
+    """
+
+    BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, seconds):
+        self.counts[bisect.bisect_left(self.BUCKETS, seconds * 1000)] += 1
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min: self.min = seconds
+        if self.max is None or seconds > self.max: self.max = seconds
+
+    def percentile(self, p):
+        """
+        Upper bound (seconds) of the bucket containing
+        the p'th percentile, None if no samples.
+        """
+        if not self.count: return None
+        target = self.count * p / 100.
+        seen = 0
+        for bound, count in zip(self.BUCKETS, self.counts):
+            seen += count
+            if seen >= target: return bound / 1000.
+        return self.max
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else None,
+            "min": self.min,
+            "max": self.max,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "buckets": [(bound, count) for bound, count in zip(self.BUCKETS + (None,), self.counts) if count],
+        }
+
+
+class CommandStats(object):
+    """
+    Counters of one type of command executed by Session,
+    kept by the command's NAME.
+    latency is the time from sending until the reply,
+    of each successful attempt.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.retries = 0
+        self.timeouts = 0
+        self.tx_failed = 0
+        self.latency = LatencyHistogram()
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "retries": self.retries,
+            "timeouts": self.timeouts,
+            "tx_failed": self.tx_failed,
+            "latency": self.latency.snapshot(),
+        }
+
+
+class SessionStats(object):
+    """
+    Metrics collected by Session, updated from the
+    loop and caller threads. See Session.stats().
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.commands = collections.defaultdict(CommandStats)
+        # per channel, count of channel events by code
+        self.events = collections.defaultdict(lambda: collections.defaultdict(int))
+        self.bursts_sent = 0
+        self.burst_bytes_sent = 0
+        self.burst_seconds = 0.0
+
+    def attempt_completed(self, cmd, elapsed, err):
+        with self._lock:
+            stats = self.commands[cmd.NAME]
+            if err is None:
+                stats.latency.add(elapsed)
+            elif isinstance(err, AntTimeoutError):
+                stats.timeouts += 1
+            elif isinstance(err, AntTxFailedError):
+                stats.tx_failed += 1
+
+    def retried(self, cmd):
+        with self._lock:
+            self.commands[cmd.NAME].retries += 1
+
+    def finished(self, cmd, err):
+        with self._lock:
+            stats = self.commands[cmd.NAME]
+            stats.count += 1
+            if err is not None: stats.errors += 1
+
+    def burst_sent(self, size, elapsed):
+        with self._lock:
+            self.bursts_sent += 1
+            self.burst_bytes_sent += size
+            self.burst_seconds += elapsed
+
+    def event(self, channel_number, msg_code):
+        with self._lock:
+            self.events[channel_number][EVENT_NAMES.get(msg_code, msg_code)] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "commands": dict((name, stats.snapshot()) for name, stats in self.commands.items()),
+                "bursts_sent": self.bursts_sent,
+                "burst_bytes_sent": self.burst_bytes_sent,
+                "burst_send_rate": self.burst_bytes_sent / self.burst_seconds if self.burst_seconds else None,
+                "events": dict((n, dict(counts)) for n, counts in self.events.items()),
+            }
 
 
 class Session(object):
     """
     Provides synchronous (blocking) API
     on top of basic (Core) ANT impl.
+    Each channel (and network) may have one
+    command outstanding, so work on different
+    channels can overlap using submit().
     """
 
+    # fixed timeouts (seconds), None to derive them from the
+    # channel period and round trip time to device (untested
+    # on real hardware, so not the default).
     default_read_timeout = 5
     default_write_timeout = 5
     default_retry = 9
+    # reset completes on StartupMessage, or this many seconds
+    reset_timeout = 1
+    # adaptive timeouts, in channel periods
+    read_timeout_periods = 40
+    write_timeout_periods = 8
+    # time per burst packet allowed by write timeout
+    burst_packet_time = 0.01
+    # retry backoff starts at this fraction of channel
+    # period, doubles each try, is capped, and jittered
+    retry_backoff_periods = 0.25
+    max_retry_backoff = 1.0
 
     channels = []
     networks = []
+    capabilities = None
+    channel_class = None
+    network_class = None
+    # per channel limits of unread data
+    recv_buffer_size = 64
+    max_burst_size = 0x10000
     _recv_buffer = []
-    _burst_buffer = []
 
     def __init__(self, core):
         self.core = core
         self.running = False
-        self.running_cmd = None
+        self.scheduler = DeadlineScheduler()
+        # outstanding attempt per command scope, guarded by _cond
+        self._running = {}
+        self._cond = threading.Condition()
+        # EVENT_SERIAL_QUE_OVERFLOW reported by device
+        self.serial_queue_overflows = 0
+        self._stats = SessionStats()
+        # smoothed round trip time to device, and its variance
+        self.srtt = None
+        self.rttvar = None
+        # channel period (seconds), as set by Channel.set_period()
+        self._periods = {}
         try:
             self._start()
         except Exception as e:
@@ -569,6 +1272,37 @@ class Session(object):
             self.thread.start()
             self.reset_system()
 
+    def stats(self):
+        """
+        Return a snapshot (dict) of session metrics:
+        per command type counts, retries, timeouts, tx
+        failures and reply latency, burst throughput,
+        and per channel event counts and receive buffer
+        drops. Commands are keyed by NAME (e.g.
+        "SEND_ACKNOWLEDGED_DATA", "READ_DATA").
+        Safe to call from any thread.
+        """
+        stats = self._stats.snapshot()
+        channels = dict((n, {"events": events}) for n, events in stats.pop("events").items())
+        bursts_received = burst_bytes_received = 0
+        burst_seconds = 0.0
+        for recv in list(self._recv_buffer):
+            channel = channels.setdefault(recv.channel_number, {"events": {}})
+            channel["dropped"] = recv.dropped
+            channel["bursts_received"] = recv.bursts_received
+            channel["burst_bytes_received"] = recv.burst_bytes_received
+            bursts_received += recv.bursts_received
+            burst_bytes_received += recv.burst_bytes_received
+            burst_seconds += recv.burst_seconds
+        stats.update({
+            "channels": channels,
+            "bursts_received": bursts_received,
+            "burst_bytes_received": burst_bytes_received,
+            "burst_receive_rate": burst_bytes_received / burst_seconds if burst_seconds else None,
+            "serial_queue_overflows": self.serial_queue_overflows,
+        })
+        return stats
+
     def close(self):
         """
         Stop the message consumer thread.
@@ -576,29 +1310,101 @@ class Session(object):
         try:
             self.reset_system()
             self.running = False
-            self.thread.join(1)
+            # loop may be blocked in a read of up to 1s
+            self.thread.join(2)
             self.core.close()
             assert not self.thread.is_alive()
         except AttributeError: pass
 
+    def dump_trace(self):
+        """
+        Save recently traced ANT traffic, if hardware
+        is traced (see hw.TracingHardware).
+        """
+        dump_trace = getattr(self.core.hardware, "dump_trace", None)
+        if dump_trace:
+            try: return dump_trace()
+            except Exception: _log.warning("Failed to dump ANT trace.", exc_info=True)
+
     def reset_system(self):
         """
         Reset the and device and initialize
         channel/network properties.
         """
-        self._send(ResetSystem(), timeout=.5, retry=5)
+        self._send(ResetSystem(), timeout=self.reset_timeout, retry=5)
         if not self.channels:
             _log.debug("Querying ANT capabilities")
             cap = self.get_capabilities() 
             #ver = self.get_ant_version()
             #sn = self.get_serial_number()
             _log.debug("Device Capabilities: %s", cap)
+            self.capabilities = cap
             #_log.debug("Device ANT Version: %s", ver)
             #_log.debug("Device SN#: %s", sn)
-            self.channels = [Channel(self, n) for n in range(0, cap.max_channels)]
-            self.networks = [Network(self, n) for n in range(0, cap.max_networks)]
-        self._recv_buffer = [[]] * len(self.channels)
-        self._burst_buffer = [[]] * len(self.channels)
+            self.channels = [(self.channel_class or Channel)(self, n) for n in range(0, cap.max_channels)]
+            self.networks = [(self.network_class or Network)(self, n) for n in range(0, cap.max_networks)]
+        self._recv_buffer = [RecvBuffer(n, self.recv_buffer_size, self.max_burst_size) for n in range(0, len(self.channels))]
+        self._periods = {}
+
+    def _reset_channel(self, channel_number):
+        self._recv_buffer[channel_number] = RecvBuffer(channel_number, self.recv_buffer_size, self.max_burst_size)
+        self._periods.pop(channel_number, None)
+
+    def channel_period(self, channel_number):
+        """
+        Return the period (seconds) of given channel,
+        ANT's default of 4hz if it was never set.
+        """
+        return self._periods.get(channel_number, 8192 / 32768.)
+
+    def rto(self):
+        """
+        Retransmission timeout (seconds) for a command
+        answered by the ANT device itself, estimated
+        from the round trip time of completed commands.
+        """
+        if self.srtt is None: return 1.0
+        return max(0.05, self.srtt + 4 * self.rttvar)
+
+    def read_timeout(self, channel_number):
+        """
+        Timeout for a read of data from a peer on given
+        channel. default_read_timeout, if set, otherwise
+        derived from channel period.
+        """
+        if self.default_read_timeout is not None: return self.default_read_timeout
+        return self.rto() + self.read_timeout_periods * self.channel_period(channel_number)
+
+    def write_timeout(self, channel_number, size=8):
+        """
+        Timeout for transmitting size bytes to a peer on
+        given channel. default_write_timeout, if set,
+        otherwise derived from channel period, and for
+        bursts, the number of packets.
+        """
+        if self.default_write_timeout is not None: return self.default_write_timeout
+        packets = (size + 7) // 8 if size > 8 else 0
+        return (self.rto() + self.write_timeout_periods * self.channel_period(channel_number)
+                + packets * self.burst_packet_time)
+
+    def retry_backoff(self, future):
+        """
+        Seconds to wait before retrying future, starts at
+        a fraction of channel period, and doubles with each
+        try, up to max_retry_backoff. Jittered so peers
+        which collided do not retry in lock step.
+        """
+        period = self.channel_period(0x1f & getattr(future.cmd, "channel_number", 0))
+        backoff = min(self.max_retry_backoff, self.retry_backoff_periods * period * 2 ** (future.tries - 1))
+        return backoff * random.uniform(0.5, 1.0)
+
+    @property
+    def search_list_supported(self):
+        """
+        True if device supports inclusion / exclusion
+        lists (AP2), see Channel.set_id_list().
+        """
+        return bool(self.capabilities and self.capabilities.advanced_opts1 & CAPABILITIES_SEARCH_LIST_ENABLED)
 
     def get_capabilities(self):
         """
@@ -618,69 +1424,168 @@ class Session(object):
         """
         return self._send(RequestMessage(0, SerialNumber.ID))
 
-    def _send(self, cmd, timeout=1, retry=0):
+    def submit(self, cmd, timeout=1, retry=0, transform=None):
         """
-        Execute the given command. An exception will
-        be raised if reply is not received in timeout
-        seconds. If retry is non-zero, commands returning
-        EAGAIN will be retried. retry also appleis to
-        RESET_SYSTEM commands. This method blocks until
-        a response if received from hardware or timeout.
-        Care should be taken to ensure timeout is sufficiently
-        large. Care should be taken to ensure timeout is
-        at least as large as a on message period.
+        Start executing the given command and return a
+        CommandFuture for its result. If another command
+        is outstanding on the same channel (or network)
+        this method blocks until that command completes,
+        commands on different channels run concurrently.
+        timeout (seconds) applies to each attempt, retry
+        is the number of times retryable errors are retried.
+        Care should be taken to ensure timeout is at least
+        as large as a on message period. If provided, result
+        of the future is transform(reply).
         """
         _log.debug("Executing Command. %s", cmd)
-        for t in range(0, retry + 1):
-            # invalid to send command while another is running
-            # (except for reset system)
-            assert not self.running_cmd or isinstance(cmd, ResetSystem)
-            # HACK, need to clean this up. not all devices support sending
-            # a response message for ResetSystem, so don't bother waiting for it
-            if not isinstance(cmd, ResetSystem):
-                # set expiration and event on command. Once self.runnning_cmd
-                # is set access to this command from this thread is invalid 
-                # until event object is set.
-                cmd.expiration = time.time() + timeout if timeout > 0 else None
-                cmd.done = threading.Event()
-                self.running_cmd = cmd
-            else:
-                # reset is done without waiting
-                cmd.done = threading.Event()
-                cmd.result = StartupMessage(0)
-            # continue trying to commit command until session closed or command timeout 
-            while self.running and not cmd.done.is_set() and not self.core.send(cmd):
+        future = CommandFuture(self, cmd, timeout, retry, transform)
+        self._transmit(future)
+        return future
+
+    def _send(self, cmd, timeout=1, retry=0):
+        """
+        Execute the given command, blocking until
+        a reply is received or error is raised.
+        see submit().
+        """
+        return self.submit(cmd, timeout, retry).result()
+
+    def _transmit(self, future):
+        """
+        Start a new attempt of future's command.
+        Claims the command's scope, and writes
+        command to hardware.
+        """
+        cmd = future.cmd
+        future.tries += 1
+        future.done = WakeEvent()
+        future.value = None
+        future.error = None
+        if self._claim(future):
+            self._write(future)
+
+    def _claim(self, future):
+        """
+        Register future as the running command of its
+        scope, waiting for the scope's current command
+        to complete. Return false if session is closed.
+        """
+        while True:
+            with self._cond:
+                if not self.running:
+                    return False
+                current = self._running.get(future.scope)
+                if current is None:
+                    # set expiration and event on future. Once registered as running
+                    # the loop thread may complete it at any time.
+                    future.start_time = time.time()
+                    future.expiration = future.start_time + future.timeout if future.timeout > 0 else None
+                    self._running[future.scope] = future
+                    break
+                done = current.done
+            # woken as soon as scope's attempt completes (or session closes)
+            done.wait()
+        self.scheduler.schedule(future)
+        return True
+
+    def _write(self, future):
+        """
+        Write the command of a running future to hardware.
+        """
+        cmd = future.cmd
+        if isinstance(cmd, SendBurstData):
+            # continue writing packets until data empty.
+            # as many packets as fit the endpoint are
+            # batched into each write. usb will nack the
+            # write in case where we're overflowing the ant
+            # device, and the same packets are tried again.
+            # ant does not ack individual packets, so nack'd
+            # writes are the only flow control. if the transfer
+            # fails, retry restarts it from sequence 0.
+            cmd.restart()
+            while self.running and not future.done.is_set() and cmd.has_more_data:
+                count, msg = cmd.pack_next_packets(self.core.max_write_size)
+                if self.core.write(msg): cmd.incr_packet_index(count)
+                else: _log.warning("Device write timeout. Will keep trying.")
+        elif isinstance(cmd, CommandBatch):
+            cmd.restart()
+            for msg in cmd.pack_messages(self.core.max_write_size):
+                while self.running and not future.done.is_set() and not self.core.write(msg):
+                    _log.warning("Device write timeout. Will keep trying.")
+        else:
+            # continue trying to commit command until session closed or command completes
+            while self.running and not future.done.is_set() and not self.core.send(cmd):
                 _log.warning("Device write timeout. Will keep trying.")
-            if isinstance(cmd, ResetSystem):
-                # sleep to give time for reset to execute
-                time.sleep(1)
-                cmd.done.set()
+
+    def _wait(self, future):
+        """
+        Wait for future to complete, retrying as
+        permitted by command's retry policy. Returns
+        the command's result or raises its error.
+        """
+        while not future.finished:
+            cmd = future.cmd
             # continue waiting for command completion until session closed
-            while self.running and not cmd.done.is_set():
-                if isinstance(cmd, SendBurstData) and cmd.has_more_data:
-                    # if the command being executed is burst
-                    # continue writing packets until data empty.
-                    # usb will nack packed it case where we're
-                    # overflowing the ant device. and packet will
-                    # be tring next time.
-                    packet = cmd.create_next_packet()
-                    if self.core.send(packet): cmd.incr_packet_index()
-                else:
-                    cmd.done.wait(1)
-            # cmd.done guarantees a result is available
-            if cmd.done.is_set():
-                try:
-                    return cmd.result
-                except AttributeError:
-                    # must have failed, check if error is retryable
-                    if t < retry and cmd.is_retryable(cmd.error):
-                        _log.warning("Retryable error. %d try(s) remaining. %s", retry - t, cmd.error)
-                    else:
-                        # not retryable, or too many retries
-                        raise cmd.error
-            else:
-                self.running_cmd = None
-                raise AntError("Session closed.")
+            while self.running and not future.done.is_set():
+                if future.expiration is None:
+                    future.done.wait()
+                elif not future.done.wait(max(0, future.expiration - time.time())):
+                    # deadline passed, don't wait for loop thread to notice
+                    self._expire(future)
+            if not future.done.is_set():
+                future.error = AntError("Session closed.")
+            if not self._retry(future):
+                self._finish(future)
+        return future._outcome()
+
+    def _retry(self, future):
+        """
+        Start another attempt of future if it failed
+        with an error allowed by its retry policy.
+        Returns true if command was retried.
+        """
+        if future.error is not None and future.tries <= future.retry and future.cmd.is_retryable(future.error):
+            _log.warning("Retryable error. %d try(s) remaining. %s", future.retry - future.tries + 1, future.error)
+            self._stats.retried(future.cmd)
+            self._retransmit(future, self.retry_backoff(future) if future.cmd.RETRY_BACKOFF else 0)
+            return True
+        return False
+
+    def _retransmit(self, future, delay):
+        """
+        Start the next attempt of future after delay
+        seconds. Retries run on the thread waiting for
+        the result, so the delay is slept inline.
+        """
+        if delay: time.sleep(delay)
+        self._transmit(future)
+
+    def _finish(self, future):
+        """
+        Mark future complete, no more retries.
+        """
+        cmd = future.cmd
+        if future.error is None and isinstance(cmd, SendBurstData):
+            elapsed = time.time() - cmd.start_time
+            _log.debug("Burst transfer complete. %d bytes in %.3fs, %.0f bytes/sec.",
+                    len(cmd.data), elapsed, len(cmd.data) / max(elapsed, 1e-6))
+            self._stats.burst_sent(len(cmd.data), elapsed)
+        self._stats.finished(cmd, future.error)
+        future._finish()
+
+    def _route(self, msg):
+        """
+        Return the running futures which msg may be a
+        reply to. Messages for a channel are routed to that
+        channel's command, and to the command of the network
+        with the same number (network replies report network
+        number as channel number). Others go to all commands.
+        """
+        with self._cond:
+            if getattr(msg, "channel_number", None) is None:
+                return list(self._running.values())
+            number = 0x1f & msg.channel_number
+            return [f for f in (self._running.get(("channel", number)), self._running.get(("network", number))) if f]
 
     def _handle_reply(self, cmd):
         """
@@ -689,21 +1594,33 @@ class Session(object):
         applicable.
         """
         _log.debug("Processing reply. %s", cmd)
-        if self.running_cmd and self.running_cmd.is_reply(cmd):
-            err = self.running_cmd.validate_reply(cmd)
-            if err:
-                self._set_error(err)
-            else:
-                self._set_result(cmd)
+        for future in self._route(cmd):
+            if future.cmd.is_reply(cmd):
+                err = future.cmd.validate_reply(cmd)
+                if err:
+                    self._set_error(future, err)
+                else:
+                    self._set_result(future, cmd)
 
     def _handle_timeout(self):
         """
         Update the status of running command
         if the message has expired.
         """
-        # if a command is currently running, check for timeout condition
-        if self.running_cmd and self.running_cmd.expiration and time.time() > self.running_cmd.expiration:
-            self._set_error(AntTimeoutError("No reply to command. %s" %  self.running_cmd))
+        for future in self.scheduler.expired():
+            self._expire(future)
+
+    def _expire(self, future):
+        """
+        Fail future with timeout, if it is still running.
+        """
+        if isinstance(future.cmd, ResetSystem):
+            # not all devices send StartupMessage after reset,
+            # assume reset has completed by the deadline.
+            if self._set_result(future, StartupMessage(0)):
+                _log.debug("No startup message after %.1fs, assuming reset complete.", future.timeout)
+        else:
+            self._set_error(future, AntTimeoutError("No reply to command. %s" % future))
 
     def _handle_read(self, cmd=None):
         """
@@ -716,55 +1633,49 @@ class Session(object):
             # acknowledged data is immediately made avalible to client
             # (and buffered if no read is currently running)
             if isinstance(cmd, RecvAcknowledgedData):
-                self._recv_buffer[cmd.channel_number].append(cmd)
+                self._recv_buffer[cmd.channel_number].add_ack(cmd)
             # burst data double-buffered. it is not made available to
             # client until the complete transfer is completed.
             elif isinstance(cmd, RecvBurstTransferPacket):
-                channel_number = 0x1f & cmd.channel_number
-                self._burst_buffer[channel_number].append(cmd)
-                # burst complete, make the complete burst available for read.
-                if cmd.channel_number & 0x80:
-                    _log.debug("Burst transfer completed, marking %d packets available for read.", len(self._burst_buffer[channel_number]))
-                    self._recv_buffer[channel_number].extend(self._burst_buffer[channel_number])
-                    self._burst_buffer[channel_number] = []
+                self._recv_buffer[0x1f & cmd.channel_number].add_burst_packet(cmd)
             # a burst transfer failed, any data currently read is discarded.
             # we assume the sender will retransmit the entire payload.
             elif isinstance(cmd, ChannelEvent) and cmd.msg_id == 1 and cmd.msg_code == EVENT_TRANSFER_RX_FAILED:
                 _log.warning("Burst transfer failed, discarding data. %s", cmd)
-                self._burst_buffer[cmd.channel_number] = []
+                self._recv_buffer[cmd.channel_number].discard_burst()
         except IndexError:
             _log.warning("Ignoring data, buffers not initialized. %s", cmd)
 
-        # dispatcher data if running command is ReadData and something available
-        if self.running_cmd and isinstance(self.running_cmd, ReadData):
-            if isinstance(cmd, RecvBroadcastData) and self.running_cmd.data_type == RecvBroadcastData:
-                # read broadcast is unbuffered, and blocks until a broadcast is received
-                # if a broadcast is received and nobody is listening it is discarded.
-                self._set_result(cmd)
-            elif self._recv_buffer[self.running_cmd.channel_number]:
-                if self.running_cmd.data_type == RecvAcknowledgedData:
-                    # return the most recent acknowledged data packet if one exists
-                    for ack_msg in [msg for msg in self._recv_buffer[self.running_cmd.channel_number] if isinstance(msg, RecvAcknowledgedData)]:
-                        self._set_result(ack_msg)
-                        self._recv_buffer[self.running_cmd.channel_number].remove(ack_msg)
-                        break
-                elif self.running_cmd.data_type in (RecvBurstTransferPacket, ReadData):
-                    # select in a single entire burst transfer or ACK
-                    data = []
-                    for pkt in list(self._recv_buffer[self.running_cmd.channel_number]):
-                        if isinstance(pkt, RecvBurstTransferPacket) or self.running_cmd.data_type == ReadData:
-                            data.append(pkt)
-                            self._recv_buffer[self.running_cmd.channel_number].remove(pkt)
-                            if pkt.channel_number & 0x80 or isinstance(pkt, RecvAcknowledgedData): break
-                    # append all text to data of first packet
-                    if data:
-                        result = data[0]
-                        for pkt in data[1:]:
-                            result.data += pkt.data
-                        self._set_result(result)
+        # dispatcher data if running command on the channel is ReadData and something available
+        if cmd is None:
+            with self._cond:
+                reads = [f for f in self._running.values() if isinstance(f.cmd, ReadData)]
+        else:
+            reads = [f for f in self._route(cmd) if isinstance(f.cmd, ReadData)]
+        for future in reads:
+            self._dispatch_read(future, cmd)
+
+    def _dispatch_read(self, future, cmd):
+        """
+        Complete the ReadData future with received
+        or buffered data, if any is available.
+        """
+        read = future.cmd
+        if isinstance(cmd, RecvBroadcastData) and read.data_type == RecvBroadcastData:
+            # read broadcast is unbuffered, and blocks until a broadcast is received
+            # if a broadcast is received and nobody is listening it is discarded.
+            self._set_result(future, cmd)
+        else:
+            # an ack, complete burst, or either (for ReadData), oldest first.
+            # data is only removed from buffer if the read is still running.
+            recv = self._recv_buffer[read.channel_number]
+            msg = recv.peek(read.data_type)
+            if msg is not None and self._set_result(future, msg):
+                recv.pop(read.data_type)
 
     def _handle_log(self, msg):
         if isinstance(msg, ChannelEvent) and msg.msg_id == 1:
+            self._stats.event(msg.channel_number, msg.msg_code)
             if msg.msg_code == EVENT_RX_SEARCH_TIMEOUT:
                 _log.warning("RF channel timed out searching for device. channel_number=%d", msg.channel_number)
             elif msg.msg_code == EVENT_RX_FAIL:
@@ -774,32 +1685,66 @@ class Session(object):
             elif msg.msg_code == EVENT_CHANNEL_COLLISION:
                 _log.warning("Channel collision, another RF device intefered with channel. channel_number=%d", msg.channel_number)
             elif msg.msg_code == EVENT_SERIAL_QUE_OVERFLOW:
-                _log.error("USB Serial buffer overflow. PC reading too slow.")
+                self.serial_queue_overflows += 1
+                _log.error("USB Serial buffer overflow. PC reading too slow. overflows=%d", self.serial_queue_overflows)
 
-    def _set_result(self, result):
+    def _set_result(self, future, result):
         """
-        Update the running command with given result,
+        Update the running future with given result,
         and set flag to indicate to caller that command
-        is done.
+        is done. Ignored (returns false) if future is
+        no longer running.
         """
-        if self.running_cmd:
-            cmd = self.running_cmd
-            self.running_cmd = None
-            cmd.result = result
-            cmd.done.set()
+        return self._complete(future, result, None)
 
-    def _set_error(self, err):
+    def _set_error(self, future, err):
         """
-        Update the running command with 
+        Update the running future with 
         given exception. The exception will
         be raised to thread which invoked 
         synchronous command.
         """
-        if self.running_cmd:
-            cmd = self.running_cmd
-            self.running_cmd = None
-            cmd.error = err
-            cmd.done.set()
+        return self._complete(future, None, err)
+
+    def _complete(self, future, result, err):
+        """
+        Complete the current attempt of future, returns
+        false if the attempt was already complete.
+        """
+        with self._cond:
+            if self._running.get(future.scope) is future:
+                del self._running[future.scope]
+                future.value = result
+                future.error = err
+                future.done.set()
+                self._cond.notify_all()
+            else:
+                return False
+        elapsed = time.time() - future.start_time
+        self._stats.attempt_completed(future.cmd, elapsed, err)
+        if err is None and not isinstance(future.cmd, (SendBroadcastData, SendAcknowledgedData,
+                SendBurstTransferPacket, CloseChannel, ResetSystem, ReadData, CommandBatch)):
+            # replied by device itself, not after rf activity
+            self._update_rtt(elapsed)
+        self._on_complete(future)
+        return True
+
+    def _update_rtt(self, rtt):
+        """
+        Update smoothed round trip time and variance
+        (the usual tcp estimator, rfc 6298).
+        """
+        if self.srtt is None:
+            self.srtt, self.rttvar = rtt, rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+    def _on_complete(self, future):
+        """
+        Called after an attempt of future completes.
+        (callers of result() handle retry in this class)
+        """
 
     def loop(self):
         """
@@ -809,21 +1754,47 @@ class Session(object):
         """
         try:
             while self.running:
-                for cmd in self.core.recv():
+                # wake no later than the next command deadline
+                timeout = max(1, int(1000 * self.scheduler.next_timeout(1)))
+                for cmd in self.core.recv(timeout):
                     if not self.running: break
-                    self._handle_log(cmd)
-                    self._handle_read(cmd)
-                    self._handle_reply(cmd)
-                    self._handle_timeout()
+                    self._handle_message(cmd)
                 else:
                     if not self.running: break
-                    self._handle_read()
-                    self._handle_timeout()
+                    self._handle_idle()
         except Exception:
             _log.error("Caught Exception handling message, session closing.", exc_info=True)
+            self.dump_trace()
         finally:
-            self.running_cmd = None
-            self.running = False
+            self._shutdown()
+
+    def _handle_message(self, cmd):
+        """
+        Process one message received from device.
+        """
+        self._handle_log(cmd)
+        self._handle_read(cmd)
+        self._handle_reply(cmd)
+        self._handle_timeout()
+
+    def _handle_idle(self):
+        """
+        Process buffered data and timeouts
+        when no messages were received.
+        """
+        self._handle_read()
+        self._handle_timeout()
+
+    def _shutdown(self):
+        """
+        Mark session closed, and release any caller still
+        waiting (without a deadline, or for scope).
+        """
+        self.running = False
+        with self._cond:
+            for future in list(self._running.values()):
+                self._set_error(future, AntError("Session closed."))
+            self._cond.notify_all()
 
 
 class Channel(object):
@@ -833,53 +1804,104 @@ class Channel(object):
         self.channel_number = channel_number
 
     def open(self):
-        self._session._send(OpenChannel(self.channel_number))
+        return self._execute(OpenChannel(self.channel_number))
 
     def close(self):
-        self._session._send(CloseChannel(self.channel_number))
+        return self._execute(CloseChannel(self.channel_number))
+
+    def reset(self):
+        """
+        Close and unassign this channel, and discard any
+        data buffered for read. Unlike Session.reset_system()
+        other channels are not affected.
+        """
+        state = self.get_status().channel_status & 0x03
+        if state in (CHANNEL_STATUS_SEARCHING, CHANNEL_STATUS_TRACKING):
+            # channel may have closed on its own since status
+            try: self.close()
+            except AntChannelClosedError: pass
+        if state != CHANNEL_STATUS_UNASSIGNED:
+            self.unassign()
+        self._session._reset_channel(self.channel_number)
 
     def assign(self, channel_type, network_number):
-        self._session._send(AssignChannel(self.channel_number, channel_type, network_number))
+        return self._execute(AssignChannel(self.channel_number, channel_type, network_number))
 
     def unassign(self):
-        self._session._send(UnassignChannel(self.channel_number))
+        return self._execute(UnassignChannel(self.channel_number))
 
     def set_id(self, device_number=0, device_type_id=0, trans_type=0):
-        self._session._send(SetChannelId(self.channel_number, device_number, device_type_id, trans_type))
+        return self._execute(SetChannelId(self.channel_number, device_number, device_type_id, trans_type))
 
     def set_period(self, messaging_period=8192):
-        self._session._send(SetChannelPeriod(self.channel_number, messaging_period))
+        result = self._execute(SetChannelPeriod(self.channel_number, messaging_period))
+        self._session._periods[self.channel_number] = messaging_period / 32768.
+        return result
 
     def set_search_timeout(self, search_timeout=12):
-        self._session._send(SetChannelSearchTimeout(self.channel_number, search_timeout))
+        return self._execute(SetChannelSearchTimeout(self.channel_number, search_timeout))
 
     def set_rf_freq(self, rf_freq=66):
-        self._session._send(SetChannelRfFreq(self.channel_number, rf_freq))
+        return self._execute(SetChannelRfFreq(self.channel_number, rf_freq))
 
     def set_search_waveform(self, search_waveform=None):
         if search_waveform is not None:
-            self._session._send(SetSearchWaveform(self.channel_number, search_waveform))
+            return self._execute(SetSearchWaveform(self.channel_number, search_waveform))
+
+    def configure(self, channel_type=None, network_number=0, device_number=None, device_type_id=0, trans_type=0,
+                  messaging_period=None, search_timeout=None, rf_freq=None, search_waveform=None):
+        """
+        Apply the given settings (those which are not None)
+        with a single pipelined batch of commands, rather
+        than waiting for each one's reply in turn.
+        """
+        n = self.channel_number
+        cmds = []
+        if channel_type is not None: cmds.append(AssignChannel(n, channel_type, network_number))
+        if device_number is not None: cmds.append(SetChannelId(n, device_number, device_type_id, trans_type))
+        if messaging_period is not None: cmds.append(SetChannelPeriod(n, messaging_period))
+        if search_timeout is not None: cmds.append(SetChannelSearchTimeout(n, search_timeout))
+        if rf_freq is not None: cmds.append(SetChannelRfFreq(n, rf_freq))
+        if search_waveform is not None: cmds.append(SetSearchWaveform(n, search_waveform))
+        if cmds:
+            result = self._execute(CommandBatch(n, cmds))
+            if messaging_period is not None: self._session._periods[n] = messaging_period / 32768.
+            return result
+
+    def set_id_list(self, device_ids, exclude=False):
+        """
+        Restrict search to (or if exclude, away from) the
+        given (device_number, device_type_id, trans_type),
+        zero is a wildcard. An empty list disables filtering.
+        AP2 only, at most MAX_ID_LIST_SIZE devices.
+        """
+        assert len(device_ids) <= MAX_ID_LIST_SIZE
+        n = self.channel_number
+        cmds = [AddChannelIdToList(n, device_number, device_type_id, trans_type, index)
+                for index, (device_number, device_type_id, trans_type) in enumerate(device_ids)]
+        cmds.append(ConfigIdList(n, len(device_ids), 1 if exclude else 0))
+        return self._execute(CommandBatch(n, cmds))
 
     def get_status(self):
-        return self._session._send(RequestMessage(self.channel_number, ChannelStatus.ID))
+        return self._execute(RequestMessage(self.channel_number, ChannelStatus.ID))
 
     def get_id(self):
-        return self._session._send(RequestMessage(self.channel_number, ChannelId.ID))
+        return self._execute(RequestMessage(self.channel_number, ChannelId.ID))
 
     def send_broadcast(self, data, timeout=None):
-        if timeout is None: timeout = self._session.default_write_timeout
+        if timeout is None: timeout = self._session.write_timeout(self.channel_number)
         data = data_tostring(data)
         assert len(data) <= 8
-        self._session._send(SendBroadcastData(self.channel_number, data), timeout=timeout)
+        return self._execute(SendBroadcastData(self.channel_number, data), timeout=timeout)
 
     def send_acknowledged(self, data, timeout=None, retry=None, direct=False):
-        if timeout is None: timeout = self._session.default_write_timeout
+        if timeout is None: timeout = self._session.write_timeout(self.channel_number)
         if retry is None: retry = self._session.default_retry
         data = data_tostring(data)
         assert len(data) <= 8
         cmd = SendAcknowledgedData(self.channel_number, data)
         if not direct:
-            self._session._send(cmd, timeout=timeout, retry=retry)
+            return self._execute(cmd, timeout=timeout, retry=retry)
         else:
             # force message tx regardless of command queue
             # state, and ignore result. usefully for best
@@ -887,35 +1909,42 @@ class Channel(object):
             self._session.core.send(cmd)
 
     def send_burst(self, data, timeout=None, retry=None):
-        if timeout is None: timeout = self._session.default_write_timeout
-        if retry is None: retry = self._session.default_retry
         data = data_tostring(data)
-        self._session._send(SendBurstData(self.channel_number, data), timeout=timeout, retry=retry)
+        if timeout is None: timeout = self._session.write_timeout(self.channel_number, len(data))
+        if retry is None: retry = self._session.default_retry
+        return self._execute(SendBurstData(self.channel_number, data), timeout=timeout, retry=retry)
 
     def recv_broadcast(self, timeout=None):
-        if timeout is None: timeout = self._session.default_read_timeout
-        return self._session._send(ReadData(self.channel_number, RecvBroadcastData), timeout=timeout).data
+        if timeout is None: timeout = self._session.read_timeout(self.channel_number)
+        return self._execute(ReadData(self.channel_number, RecvBroadcastData), timeout=timeout, data=True)
 
     def recv_acknowledged(self, timeout=None):
-        if timeout is None: timeout = self._session.default_read_timeout
-        return self._session._send(ReadData(self.channel_number, RecvAcknowledgedData), timeout=timeout).data
+        if timeout is None: timeout = self._session.read_timeout(self.channel_number)
+        return self._execute(ReadData(self.channel_number, RecvAcknowledgedData), timeout=timeout, data=True)
 
     def recv_burst(self, timeout=None):
-        if timeout is None: timeout = self._session.default_read_timeout
-        return self._session._send(ReadData(self.channel_number, RecvBurstTransferPacket), timeout=timeout).data 
+        if timeout is None: timeout = self._session.read_timeout(self.channel_number)
+        return self._execute(ReadData(self.channel_number, RecvBurstTransferPacket), timeout=timeout, data=True)
 
     def write(self, data, timeout=None, retry=None):
-        if timeout is None: timeout = self._session.default_write_timeout
         if retry is None: retry = self._session.default_retry
         data = data_tostring(data)
         if len(data) <= 8:
-            self.send_acknowledged(data, timeout=timeout, retry=retry)
+            return self.send_acknowledged(data, timeout=timeout, retry=retry)
         else:
-            self.send_burst(data, timeout=timeout, retry=retry)
+            return self.send_burst(data, timeout=timeout, retry=retry)
     
     def read(self, timeout=None):
-        if timeout is None: timeout = self._session.default_read_timeout
-        return self._session._send(ReadData(self.channel_number, ReadData), timeout=timeout).data 
+        if timeout is None: timeout = self._session.read_timeout(self.channel_number)
+        return self._execute(ReadData(self.channel_number, ReadData), timeout=timeout, data=True)
+
+    def _execute(self, cmd, timeout=1, retry=0, data=False):
+        """
+        Execute cmd, blocking until complete. Returns
+        the reply, or if data is true the reply's data.
+        """
+        result = self._session._send(cmd, timeout=timeout, retry=retry)
+        return result.data if data else result
     
 class Network(object):
 
@@ -924,7 +1953,10 @@ class Network(object):
         self.network_number = network_number
 
     def set_key(self, network_key="\x00" * 8):
-        self._session._send(SetNetworkKey(self.network_number, network_key))
+        return self._execute(SetNetworkKey(self.network_number, network_key))
+
+    def _execute(self, cmd):
+        return self._session._send(cmd)
 
 
 # vim: ts=4 sts=4 et
@@ -34,6 +34,7 @@ import logging
 import time
 import os
 import socket
+import threading
 import binascii
 import ConfigParser
 
@@ -93,20 +94,20 @@ class Disconnect(Command):
     
     COMMAND_ID = Command.DISCONNECT
 
-    __struct = struct.Struct("<BB6x")
+    __packed = struct.pack("<BB6x", Command.DATA_PAGE_ID, COMMAND_ID)
 
     def pack(self):
-        return self.__struct.pack(self.DATA_PAGE_ID, self.COMMAND_ID)
+        return self.__packed
 
 
 class Ping(Command):
     
     COMMAND_ID = Command.PING
 
-    __struct = struct.Struct("<BB6x")
+    __packed = struct.pack("<BB6x", Command.DATA_PAGE_ID, COMMAND_ID)
 
     def pack(self):
-        return self.__struct.pack(self.DATA_PAGE_ID, self.COMMAND_ID)
+        return self.__packed
 
 
 class Link(Command):
@@ -180,6 +181,8 @@ class KnownDeviceDb(object):
         self.file = file
         self.key_by_device_id = dict()
         self.device_id_by_ant_device_number = dict()
+        # hosts of each ANT stick share db
+        self.lock = threading.RLock()
         self.cfg = ConfigParser.SafeConfigParser()
         if file: self.cfg.read([file])
         for section in self.cfg.sections():
@@ -198,26 +201,111 @@ class KnownDeviceDb(object):
     def get_device_id(self, ant_device_number):
         return self.device_id_by_ant_device_number.get(ant_device_number, None)
 
+    def get_ant_device_numbers(self, device_id):
+        return [n for n, d in self.device_id_by_ant_device_number.items() if d == device_id]
+
     def add_device_id(self, ant_device_number, device_id):
         self.add_to_cfg(device_id, "device_number", hex(ant_device_number))
 
     def delete_device(self, device_id):
         section = "0x%08x" % device_id 
-        try: self.cfg.remove_section(section)
-        except ConfigParser.NoSectionError: pass
-        else:
-            if self.file:
-                with open(self.file, "w") as file:
-                    self.cfg.write(file)
+        with self.lock:
+            try: self.cfg.remove_section(section)
+            except ConfigParser.NoSectionError: pass
+            else:
+                if self.file:
+                    with open(self.file, "w") as file:
+                        self.cfg.write(file)
         
     def add_to_cfg(self, device_id, key, value):
         section = "0x%08x" % device_id 
-        try: self.cfg.add_section(section)
-        except ConfigParser.DuplicateSectionError: pass
-        self.cfg.set(section, key, value)
-        if self.file:
-            with open(self.file, "w") as file:
-                self.cfg.write(file)
+        with self.lock:
+            try: self.cfg.add_section(section)
+            except ConfigParser.DuplicateSectionError: pass
+            self.cfg.set(section, key, value)
+            if self.file:
+                with open(self.file, "w") as file:
+                    self.cfg.write(file)
+
+
+class LinkQualityDb(object):
+    """
+    Statistics of past links by transport frequency:
+    links, failed links, RX_FAIL events, failed bursts,
+    bytes received and seconds linked. Older links are
+    decayed so stats follow a changing RF environment.
+    """
+
+    FIELDS = ["links", "failures", "rx_fails", "burst_failures", "bytes", "seconds"]
+
+    # weight of previous stats, when adding a link
+    decay = 0.9
+    # probability of choosing any frequency, rather than one of the best
+    exploration = 0.1
+    # number of best frequencies to choose from
+    best = 3
+
+    def __init__(self, file=None):
+        self.file = file
+        self.stats_by_freq = dict()
+        self.lock = threading.RLock()
+        self.random = random.Random()
+        self.cfg = ConfigParser.SafeConfigParser()
+        if file: self.cfg.read([file])
+        for section in self.cfg.sections():
+            self.stats_by_freq[int(section, 0)] = dict(
+                    (key, self.cfg.getfloat(section, key) if self.cfg.has_option(section, key) else 0.0)
+                    for key in self.FIELDS)
+
+    def get_stats(self, freq):
+        return self.stats_by_freq.get(freq, None)
+
+    def cost(self, freq):
+        """
+        Errors per second linked on freq, a failed link
+        counts as many failed bursts. 0 if never used.
+        """
+        stats = self.stats_by_freq.get(freq)
+        if not stats: return 0.0
+        errors = stats["rx_fails"] + 4 * stats["burst_failures"] + 16 * stats["failures"]
+        return errors / max(1.0, stats["seconds"])
+
+    def throughput(self, freq):
+        """
+        Bytes received per second linked on freq,
+        None if never used.
+        """
+        stats = self.stats_by_freq.get(freq)
+        if stats and stats["seconds"]: return stats["bytes"] / stats["seconds"]
+
+    def choose(self, freqs):
+        """
+        Return one of the best of the given frequencies,
+        least errors then highest throughput, frequencies
+        never used first. Sometimes any frequency, so
+        stats of those not chosen are kept up to date.
+        """
+        with self.lock:
+            freqs = list(freqs)
+            self.random.shuffle(freqs)
+            if self.random.random() < self.exploration: return freqs[0]
+            ranked = sorted(freqs, key=lambda f: (self.cost(f), -(self.throughput(f) or float("inf"))))
+            return self.random.choice(ranked[:self.best])
+
+    def add_link(self, freq, failed, rx_fails=0, burst_failures=0, bytes=0, seconds=0.0):
+        sample = dict(links=1, failures=1 if failed else 0, rx_fails=rx_fails,
+                      burst_failures=burst_failures, bytes=bytes, seconds=seconds)
+        with self.lock:
+            stats = self.stats_by_freq.setdefault(freq, dict.fromkeys(self.FIELDS, 0.0))
+            section = "%d" % freq
+            try: self.cfg.add_section(section)
+            except ConfigParser.DuplicateSectionError: pass
+            for key in self.FIELDS:
+                stats[key] = stats[key] * self.decay + sample[key]
+                self.cfg.set(section, key, "%.3f" % stats[key])
+            if self.file:
+                with open(self.file, "w") as file:
+                    self.cfg.write(file)
 
 
 class Host(object):
@@ -231,14 +319,39 @@ class Host(object):
     transport_freqs = [3, 7, 15, 20, 25, 29, 34, 40, 45, 49, 54, 60, 65, 70, 75, 80]
     transport_period = 0b100
     transport_timeout = 2
+    # seconds a device rejected by search only because it
+    # was busy (or claimed by another host) stays excluded
+    busy_exclusion_timeout = 10
 
-    def __init__(self, ant_session, known_client_keys=None):
+    # guards transport_freqs_in_use, shared by hosts of one ANT device
+    _transport_lock = threading.Lock()
+
+    def __init__(self, ant_session, known_client_keys=None, channel_number=None, transport_freqs_in_use=None):
+        """
+        If channel_number is None, ANT-FS runs on channel 0
+        and the ANT device is reset before each search. Otherwise
+        only the given channel is used (and reset), so hosts
+        on different channels can share ant_session, each linked
+        to its own device. Hosts sharing a session should share
+        transport_freqs_in_use, so each link is on its own frequency.
+        """
         self.ant_session = ant_session
+        self.channel_number = channel_number
         self.known_client_keys = known_client_keys if known_client_keys is not None else KnownDeviceDb()
+        self.transport_freqs_in_use = transport_freqs_in_use if transport_freqs_in_use is not None else set()
+        self.transport_freq = None
+        self.link_quality = LinkQualityDb()
 
     def close(self):
-        self.channel.send_acknowledged(Disconnect().pack(), direct=True)
-        self.ant_session.close()
+        # already closed, e.g. by Dispatcher.close()
+        if not self.ant_session.running: return
+        # channel is unset if search() was never called
+        if hasattr(self, "channel"):
+            self.channel.send_acknowledged(Disconnect().pack(), direct=True)
+        self._release_transport_freq()
+        # a shared session is closed by its owner
+        if self.channel_number is None:
+            self.ant_session.close()
 
     def disconnect(self):
         try:
@@ -248,11 +361,14 @@ class Host(object):
         else:
             self.channel.send_acknowledged(Disconnect().pack(), direct=True)
             self.channel.close()
+        finally:
+            self._release_transport_freq(failed=False)
 
     def ping(self):
         self.channel.write(Ping().pack())
 
-    def search(self, search_timeout=60, device_id=None, include_unpaired_devices=False, include_devices_with_no_data=False):
+    def search(self, search_timeout=60, device_id=None, include_unpaired_devices=False, include_devices_with_no_data=False,
+               claim=None, device_number=None):
         """
         Search for devices. If device_id is None return the first device
         which has data available. Unless include_unpaired_devices = True
@@ -262,57 +378,91 @@ class Host(object):
         ANT device_id matchers the requested value. If found the device
         is returned regardless of whether it has data or not.
         include_unpaired_devices is ignored when device_id is provided.
+
+        If claim is provided, claim(device_number) is called before a
+        device is returned, a device is skipped unless claim returns True.
+        (see Dispatcher.)
+
+        On AP2 rejected devices are excluded from search, busy devices
+        for busy_exclusion_timeout seconds. Once more devices than fit
+        the exclusion list are rejected, search falls back to resetting
+        the channel, as on AP1. A search for a device_id whose ANT device
+        numbers are known only includes those numbers, less any rejected.
+
+        If device_number is provided (e.g. of a device found by Scanner)
+        the channel is opened on that ANT device number, so only that
+        device is tracked, and None is returned if it is rejected.
         """
         timeout = time.time() + search_timeout
+        self._release_transport_freq()
+        # on AP2 the search channel stays open, devices which are rejected
+        # are excluded from search. AP1 has no search lists, the channel
+        # is reset and reopened hoping another device in range is found.
+        self._open_antfs_search_channel(device_number)
+        use_search_list = self.ant_session.search_list_supported and device_number is None
+        # excluded device number -> time exclusion expires, None if never
+        excluded = collections.OrderedDict()
+        included = []
+        if use_search_list and device_id is not None:
+            included = self.known_client_keys.get_ant_device_numbers(device_id)[:ant.MAX_ID_LIST_SIZE]
+            if included:
+                self._set_antfs_search_list([(n, 0, 0) for n in included])
         while time.time() < timeout:
+            expired = [n for n, t in excluded.items() if t is not None and t <= time.time()]
+            if expired:
+                for n in expired: del excluded[n]
+                self._update_antfs_search_list(included, excluded)
             try:
-                # if we didn't find a device, maybe another is in range?
-                # restart search every time. Once a device is tracking
-                # we don't get any more hits. So, just keep re-openning
-                # channel until we find device we're looking for.
-                # TODO could implement AP2 filters, but this logic maintains
-                # support for older devices.
-                self._open_antfs_search_channel()
-                # wait to recv beacon from device
-                beacon = Beacon.unpack(self.channel.recv_broadcast(timeout=timeout - time.time()))
+                # wait to recv beacon from device, or until an exclusion expires
+                wait = min([timeout] + [t for t in excluded.values() if t is not None]) - time.time()
+                beacon = Beacon.unpack(self.channel.recv_broadcast(timeout=max(0.01, wait)))
             except ant.AntTimeoutError:
                 # ignore timeout error
-                pass
+                continue
+            tracking_device_number = self.channel.get_id().device_number
+            tracking_device_id = self.known_client_keys.get_device_id(tracking_device_number)
+            busy = False
+            # check if event was a beacon
+            if beacon:
+                _log.debug("Got ANT-FS Beacon. device_number=0x%04x %s", tracking_device_number, beacon)
+                # and if device is a state which will accept our link
+                if  beacon.device_state != Beacon.STATE_LINK:
+                    _log.warning("Device busy, not ready for link. device_number=0x%04x state=%d.",
+                            tracking_device_number, beacon.device_state)
+                    busy = True
+                # are we looking for a sepcific device
+                if device_id is not None and device_id != tracking_device_id:
+                    # a specific device id was request, but is not the one
+                    # currently linked, try again.
+                    _log.debug("Found device, but device_id does not match. 0x%08x != 0x%08x", tracking_device_id or 0, device_id)
+                elif device_id is None and not include_unpaired_devices and tracking_device_id is None:
+                    # requested not to return unpared devices
+                    # but the one linked is unkown.
+                    _log.debug("Found device, but paring not enabled. device_number=0x%04x", tracking_device_number)
+                elif device_id is None and not beacon.data_available and not include_devices_with_no_data:
+                    _log.debug("Found device, but no new data for download. device_number=0x%04x", tracking_device_number)
+                elif claim and not claim(tracking_device_number):
+                    _log.debug("Found device, but claimed by another host. device_number=0x%04x", tracking_device_number)
+                    busy = True
+                else:
+                    self.beacon = beacon
+                    self.device_id = tracking_device_id # may be None
+                    self.device_number = tracking_device_number
+                    return beacon
+            if device_number is not None:
+                return None
+            # continue searching for another device
+            if (use_search_list and not included and len(excluded) >= ant.MAX_ID_LIST_SIZE
+                    and tracking_device_number not in excluded):
+                # dropping an entry would let search lock onto it again
+                _log.debug("Search exclusion list full, resetting channel for remainder of search.")
+                use_search_list = False
+                excluded.clear()
+            if use_search_list:
+                excluded[tracking_device_number] = time.time() + self.busy_exclusion_timeout if busy else None
+                self._update_antfs_search_list(included, excluded)
             else:
-                tracking_device_number = self.channel.get_id().device_number
-                tracking_device_id = self.known_client_keys.get_device_id(tracking_device_number)
-                # check if event was a beacon
-                if beacon:
-                    _log.debug("Got ANT-FS Beacon. device_number=0x%04x %s", tracking_device_number, beacon)
-                    # and if device is a state which will accept our link
-                    if  beacon.device_state != Beacon.STATE_LINK:
-                        _log.warning("Device busy, not ready for link. device_number=0x%04x state=%d.",
-                                tracking_device_number, beacon.device_state)
-                    # are we looking for a sepcific device
-                    if device_id is not None:
-                        if device_id == tracking_device_id:
-                            # the device exactly matches the one we're looking for
-                            self.beacon = beacon
-                            self.device_id = tracking_device_id
-                            return beacon
-                        else:
-                            # a specific device id was request, but is not the one
-                            # currently linked, try again. FIXME should really implement
-                            # AP2 filters
-                            _log.debug("Found device, but device_id does not match. 0x%08x != 0x%08x", tracking_device_id or 0, device_id)
-                            continue
-                    elif not include_unpaired_devices and tracking_device_id is None:
-                        # requested not to return unpared devices
-                        # but the one linked is unkown.
-                        # FIXME add device to AP2 filter and contiue search
-                        _log.debug("Found device, but paring not enabled. device_number=0x%04x", tracking_device_number)
-                        continue
-                    elif not beacon.data_available and not include_devices_with_no_data:
-                        _log.debug("Found device, but no new data for download. device_number=0x%04x", tracking_device_number)
-                    else:
-                        self.beacon = beacon
-                        self.device_id = tracking_device_id # may be None
-                        return beacon
+                self._open_antfs_search_channel()
         
     def link(self):
         """
@@ -330,7 +480,7 @@ class Host(object):
         # wait for channel to sync
         Beacon.unpack(self.channel.recv_broadcast(0))
         # send the link commmand
-        link = Link(freq=random.choice(self.transport_freqs), period=self.transport_period)
+        link = Link(freq=self._acquire_transport_freq(), period=self.transport_period)
         _log.debug("Linking with device. freq=24%02dmhz", link.frequency)
         self.channel.send_acknowledged(link.pack())
         # change this channels frequency to match link
@@ -409,31 +559,356 @@ class Host(object):
         direct_reply = GarminSendDirect.unpack(self.channel.read())
         return direct_reply.data if direct_reply else None
 
-    def _open_antfs_search_channel(self):
-        self.ant_session.reset_system()
-        self.channel = self.ant_session.channels[0]
+    def _open_antfs_search_channel(self, device_number=None):
+        self._reset_antfs_channel()
+        self._configure_antfs_search_channel(device_number)
+        self.channel.open()
+
+    def _reset_antfs_channel(self):
+        if self.channel_number is None:
+            self.ant_session.reset_system()
+            self.channel = self.ant_session.channels[0]
+        else:
+            self.channel = self.ant_session.channels[self.channel_number]
+            self.channel.reset()
         self.network = self.ant_session.networks[0]
-        self._configure_antfs_search_channel()
+
+    def _acquire_transport_freq(self):
+        # prefer a frequency not used by another host on this ANT device
+        with self._transport_lock:
+            freqs = [f for f in self.transport_freqs if f not in self.transport_freqs_in_use]
+            self.transport_freq = self.link_quality.choose(freqs or self.transport_freqs)
+            self.transport_freqs_in_use.add(self.transport_freq)
+        self._link_start = (time.time(), self._link_counters())
+        return self.transport_freq
+
+    def _release_transport_freq(self, failed=True):
+        """
+        Record the quality of the current link, if
+        any, and free its frequency. Unless released by
+        disconnect(), the link is assumed to have failed.
+        """
+        with self._transport_lock:
+            freq, self.transport_freq = self.transport_freq, None
+            if freq is None: return
+            self.transport_freqs_in_use.discard(freq)
+        start_time, start_counters = self._link_start
+        rx_fails, burst_failures, bytes = [max(0, end - start) for end, start in zip(self._link_counters(), start_counters)]
+        _log.debug("Link finished. freq=24%02dmhz failed=%s rx_fails=%d burst_failures=%d bytes=%d",
+                freq, failed, rx_fails, burst_failures, bytes)
+        self.link_quality.add_link(freq, failed, rx_fails, burst_failures, bytes, time.time() - start_time)
+
+    def _link_counters(self):
+        # (RX_FAIL events, failed bursts, burst bytes received) of this host's channel
+        channel = self.ant_session.stats()["channels"].get(self.channel.channel_number, {})
+        events = channel.get("events", {})
+        return (events.get("EVENT_RX_FAIL", 0),
+                events.get("EVENT_TRANSFER_RX_FAILED", 0) + events.get("EVENT_TRANSFER_TX_FAILED", 0),
+                channel.get("burst_bytes_received", 0))
+
+    def _set_antfs_search_list(self, device_ids, exclude=False):
+        # lists are only applied when the channel is (re)opened
+        self.channel.close()
+        self.channel.set_id_list(device_ids, exclude)
         self.channel.open()
 
-    def _configure_antfs_search_channel(self):
-        self.network.set_key(self.search_network_key)
-        self.channel.assign(channel_type=0x00, network_number=self.network.network_number)
-        self.channel.set_id(device_number=0, device_type_id=0, trans_type=0)
-        self.channel.set_period(self.search_period)
-        self.channel.set_search_timeout(self.search_timeout)
-        self.channel.set_rf_freq(self.search_freq)
-        self.channel.set_search_waveform(self.search_waveform)
+    def _exclude_antfs_devices(self, device_numbers):
+        _log.debug("Excluding device(s) from search. device_numbers=%s", ", ".join("0x%04x" % n for n in device_numbers))
+        self._set_antfs_search_list([(n, 0, 0) for n in device_numbers], exclude=True)
+
+    def _update_antfs_search_list(self, included, excluded):
+        if included:
+            # keep searching only for the requested device, an empty
+            # list would include every device, so if all are rejected
+            # go back to including all of them.
+            device_numbers = [n for n in included if n not in excluded] or included
+            _log.debug("Including device(s) in search. device_numbers=%s", ", ".join("0x%04x" % n for n in device_numbers))
+            self._set_antfs_search_list([(n, 0, 0) for n in device_numbers])
+        else:
+            self._exclude_antfs_devices(excluded.keys())
+
+    def _configure_antfs_search_channel(self, device_number=None):
+        # network key and channel config are written without waiting
+        # for each reply, network and channel commands run concurrently.
+        set_key = self.ant_session.submit(ant.SetNetworkKey(self.network.network_number, self.search_network_key))
+        self.channel.configure(channel_type=0x00, network_number=self.network.network_number,
+                device_number=device_number or 0, device_type_id=0, trans_type=0,
+                messaging_period=self.search_period,
+                search_timeout=self.search_timeout,
+                rf_freq=self.search_freq,
+                search_waveform=self.search_waveform)
+        set_key.result()
 
     def _configure_antfs_transport_channel(self, link):
-        self.channel.set_rf_freq(link.frequency)
-        self.channel.set_search_timeout(self.transport_timeout)
-        self._configure_antfs_period(link.period)
+        self.channel.configure(rf_freq=link.frequency, search_timeout=self.transport_timeout,
+                messaging_period=self._antfs_channel_period(link.period))
 
     def _configure_antfs_period(self, period):
+        self.channel.set_period(self._antfs_channel_period(period))
+
+    def _antfs_channel_period(self, period):
         period_hz = 2 ** (period - 1)
-        channel_period = 0x8000 / period_hz
-        self.channel.set_period(channel_period)
+        return 0x8000 / period_hz
+
+
+
+class Dispatcher(object):
+    """
+    Runs a function for each of several hosts (one per
+    ANT stick) in parallel, and assigns each device in
+    range to at most one host. Hosts claim a device
+    before linking (see Host.search()) and release it
+    when done, a device claimed by one host is skipped
+    by the others.
+    """
+
+    def __init__(self, hosts):
+        self.hosts = hosts
+        self.running = False
+        self._claimed = {}
+        self._lock = threading.Lock()
+
+    def claim(self, host, device_number):
+        """
+        Assign device to host, return False if
+        it is already assigned to another host.
+        """
+        with self._lock:
+            owner = self._claimed.setdefault(device_number, host)
+            return owner is host
+
+    def release(self, host):
+        """
+        Release any device assigned to host.
+        """
+        with self._lock:
+            for device_number, owner in self._claimed.items():
+                if owner is host: del self._claimed[device_number]
+
+    def run(self, target):
+        """
+        Call target(host) for every host, each from its
+        own thread, and wait for all of them to return.
+        """
+        self.running = True
+        threads = [threading.Thread(target=target, args=(host,), name="Host-%d" % n)
+                   for n, host in enumerate(self.hosts)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        # join with a timeout, so ctrl-c interrupts the main thread
+        try:
+            for thread in threads:
+                while thread.is_alive(): thread.join(1)
+        except KeyboardInterrupt:
+            # host threads are daemons, and would not clean up before
+            # exit. closing each host disconnects its device and resets
+            # its stick, and stops the host's thread with an error.
+            # target should return once running is false.
+            _log.info("Interrupted, closing hosts.")
+            self.running = False
+            self.close()
+            for thread in threads: thread.join(1)
+            raise
+        finally:
+            self.running = False
+
+    def close(self):
+        for host in self.hosts:
+            try: host.close()
+            except Exception: _log.warning("Failed to close host.", exc_info=True)
+
+
+class ScannedDevice(object):
+    """
+    An ANT-FS device seen by Scanner.
+    """
+
+    __slots__ = ["device_number", "device_id", "paired", "first_seen", "last_seen", "beacon", "raw"]
+
+    def __init__(self, device_number, device_id, paired, now):
+        self.device_number = device_number
+        self.device_id = device_id
+        self.paired = paired
+        self.first_seen = now
+        self.last_seen = now
+        self.beacon = None
+        self.raw = None
+
+    @property
+    def device_state(self):
+        return self.beacon.device_state
+
+    @property
+    def data_available(self):
+        return bool(self.beacon.data_available)
+
+    @property
+    def pairing_enabled(self):
+        return bool(self.beacon.pairing_enabled)
+
+    def copy(self):
+        result = ScannedDevice(self.device_number, self.device_id, self.paired, self.first_seen)
+        result.last_seen, result.beacon, result.raw = self.last_seen, self.beacon, self.raw
+        return result
+
+    def __str__(self):
+        return "ScannedDevice(device_number=0x%04x, device_id=%s, paired=%s, state=%d, data_available=%s, age=%.1fs)" % (
+                self.device_number, "0x%08x" % self.device_id if self.device_id else None, self.paired,
+                self.device_state, self.data_available, time.time() - self.last_seen)
+
+
+class Scanner(object):
+    """
+    Listens for ANT-FS beacons from a background thread
+    and keeps a table of devices in range. The search
+    channel tracks each device for dwell seconds, then
+    moves on (on AP2 by excluding it from search) so
+    every device in range is revisited. The scanner uses
+    (and resets) host's channel, it must be stopped while
+    host is in use.
+    """
+
+    # seconds to track one device before moving on
+    dwell = 1.0
+    # wake this often to check for stop()
+    poll = 0.25
+
+    def __init__(self, host):
+        self.host = host
+        self.running = False
+        self.thread = None
+        self.error = None
+        self._devices = {}
+        self._cond = threading.Condition()
+
+    def start(self):
+        if not self.running:
+            self.running = True
+            self.error = None
+            self.thread = threading.Thread(target=self._run, name="Scanner")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        """
+        Stop scanning, and raise the error which
+        stopped the scanner early, if any.
+        """
+        self.running = False
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        if self.error:
+            error, self.error = self.error, None
+            raise error
+
+    def devices(self, max_age=None):
+        """
+        Return copies of devices seen in the last max_age
+        seconds (or ever), most recently seen first.
+        """
+        now = time.time()
+        with self._cond:
+            result = [d.copy() for d in self._devices.values()
+                    if d.beacon and (max_age is None or now - d.last_seen <= max_age)]
+        return sorted(result, key=lambda d: d.last_seen, reverse=True)
+
+    def wait_for(self, predicate, timeout, max_age=10):
+        """
+        Wait up to timeout seconds for a device, seen in
+        the last max_age seconds, for which predicate(device)
+        is true. Returns a copy of the device, or None.
+        """
+        deadline = time.time() + timeout
+        with self._cond:
+            while True:
+                for device in self.devices(max_age):
+                    if predicate(device): return device
+                remaining = deadline - time.time()
+                if remaining <= 0 or not self.running: return None
+                self._cond.wait(min(remaining, self.poll))
+
+    def _run(self):
+        try:
+            self.host._reset_antfs_channel()
+            channel = self.host.channel
+            try:
+                self._scan(self.host.ant_session, channel)
+            finally:
+                try: channel.close()
+                except ant.AntError: pass
+        except Exception as e:
+            _log.warning("Scanner failed, stopping.", exc_info=True)
+            self.error = e
+        finally:
+            self.running = False
+            with self._cond:
+                self._cond.notify_all()
+
+    def _scan(self, session, channel):
+        host = self.host
+        network = host.network
+        network.set_key(host.search_network_key)
+        channel.configure(channel_type=0x00, network_number=network.network_number,
+                device_number=0, device_type_id=0, trans_type=0,
+                messaging_period=host.search_period,
+                search_timeout=0xFF,
+                rf_freq=host.search_freq,
+                search_waveform=host.search_waveform)
+        channel.open()
+        use_search_list = session.search_list_supported
+        excluded = collections.deque(maxlen=ant.MAX_ID_LIST_SIZE)
+        device = None
+        idle_since = time.time()
+        while self.running:
+            try:
+                data = channel.recv_broadcast(timeout=self.poll)
+            except ant.AntTimeoutError:
+                # every device in range has been excluded (or none are),
+                # clear the list so known devices are refreshed
+                if excluded and time.time() - idle_since > self.dwell:
+                    excluded.clear()
+                    self._set_search_list(channel, excluded)
+                    idle_since = time.time()
+                continue
+            now = time.time()
+            if device is None:
+                device = self._acquire(channel.get_id().device_number, now)
+                idle_since = now
+            # most beacons repeat the last, only decode changes
+            if data != device.raw:
+                beacon = Beacon.unpack(data)
+                if beacon:
+                    with self._cond:
+                        device.beacon, device.raw, device.last_seen = beacon, data, now
+                        self._cond.notify_all()
+            else:
+                device.last_seen = now
+            if now - idle_since > self.dwell:
+                # move on to next device, without search lists
+                # reopening the channel finds any device in range
+                if use_search_list: excluded.append(device.device_number)
+                self._set_search_list(channel, excluded)
+                device = None
+                idle_since = time.time()
+
+    def _acquire(self, device_number, now):
+        with self._cond:
+            device = self._devices.get(device_number)
+            if device is None:
+                device_id = self.host.known_client_keys.get_device_id(device_number)
+                paired = device_id is not None and self.host.known_client_keys.get_key(device_id) is not None
+                device = self._devices[device_number] = ScannedDevice(device_number, device_id, paired, now)
+                _log.debug("Scanner found device. device_number=0x%04x device_id=%s", device_number, device_id)
+            return device
+
+    def _set_search_list(self, channel, device_numbers):
+        # reopen channel to apply list, and search again
+        channel.close()
+        if self.host.ant_session.search_list_supported:
+            channel.set_id_list([(n, 0, 0) for n in device_numbers], exclude=True)
+        channel.open()
         
 
 # vim: ts=4 sts=4 et
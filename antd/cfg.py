@@ -32,6 +32,8 @@ import os
 import binascii
 import logging
 import sys
+import time
+import signal
 import pkg_resources
 import logging
 
@@ -83,38 +85,138 @@ def init_loggers(force_level=None, out=sys.stdin):
         pass
 
 def create_hardware():
+    return create_hardware_pool(max_sticks=1)[0]
+
+def create_hardware_pool(max_sticks=None):
+    """
+    Return a list of all available ANT sticks, up
+    to max_sticks (default [antd.hw] max_sticks,
+    0 for all).
+    """
+    import antd.hw as hw
+    if max_sticks is None:
+        max_sticks = int(_cfg.get("antd.hw", "max_sticks"), 0) if _cfg.has_option("antd.hw", "max_sticks") else 1
+    if _cfg.has_section("antd.emulator") and _cfg.getboolean("antd.emulator", "enabled"):
+        pool = create_emulated_hardware_pool(max_sticks)
+    else:
+        pool = create_ant_sticks(max_sticks)
+    pool = [_wrap_hardware(hardware, n) for n, hardware in enumerate(pool)]
+    tracing = [hardware for hardware in pool if isinstance(hardware, hw.TracingHardware)]
+    if tracing:
+        # kill -USR1 to dump the trace of a running downloader
+        signal.signal(signal.SIGUSR1, lambda signum, frame: [hardware.dump_trace() for hardware in tracing])
+    return pool
+
+def _wrap_hardware(hardware, n):
+    import antd.hw as hw
+    if _cfg.has_option("antd.hw", "capture_file") and _cfg.get("antd.hw", "capture_file"):
+        capture_file = time.strftime(_stick_path(_cfg.get("antd.hw", "capture_file"), n))
+        _log.info("Recording all ANT traffic to %s.", capture_file)
+        hardware = hw.RecordingHardware(hardware, capture_file)
+    if _cfg.has_option("antd.hw", "trace_buffer") and int(_cfg.get("antd.hw", "trace_buffer"), 0):
+        hardware = hw.TracingHardware(hardware, int(_cfg.get("antd.hw", "trace_buffer"), 0),
+                _stick_path(_cfg.get("antd.hw", "trace_file"), n))
+    return hardware
+
+def _stick_path(path, n):
+    # files of all but the first stick get a suffix, e.g. trace-1.antcap
+    path = os.path.expanduser(path)
+    if not n: return path
+    base, ext = os.path.splitext(path)
+    return "%s-%d%s" % (base, n, ext)
+
+def create_ant_stick():
     import antd.hw as hw
     try:
-        id_vendor = int(_cfg.get("antd.hw", "id_vendor"), 0)
-        id_product = int(_cfg.get("antd.hw", "id_product"), 0)
-        bulk_endpoint = int(_cfg.get("antd.hw", "bulk_endpoint"), 0)
-        return hw.UsbHardware(id_vendor, id_product, bulk_endpoint)
+        hardware = create_usb_stick()
     except hw.NoUsbHardwareFound:
         _log.warning("Failed to find Garmin nRF24AP2 (newer) USB Stick.", exc_info=True)
         _log.warning("Looking for nRF24AP1 (older) Serial USB Stick.")
         tty = _cfg.get("antd.hw", "serial_device")
-        return hw.SerialHardware(tty, 115200)
+        hardware = hw.SerialHardware(tty, 115200)
+    return hardware
+
+def create_ant_sticks(max_sticks=0):
+    """
+    Open every available USB stick, up to max_sticks,
+    or 0 for all. Falls back to one serial stick.
+    """
+    import antd.hw as hw
+    sticks = [create_ant_stick()]
+    if isinstance(sticks[0], hw.SerialHardware): return sticks
+    while not max_sticks or len(sticks) < max_sticks:
+        try: sticks.append(create_usb_stick())
+        except hw.NoUsbHardwareFound: break
+    _log.info("Using %d ANT stick(s).", len(sticks))
+    return sticks
+
+def create_usb_stick():
+    import antd.hw as hw
+    id_vendor = int(_cfg.get("antd.hw", "id_vendor"), 0)
+    id_product = int(_cfg.get("antd.hw", "id_product"), 0)
+    bulk_endpoint = int(_cfg.get("antd.hw", "bulk_endpoint"), 0)
+    hardware = hw.UsbHardware(id_vendor, id_product, bulk_endpoint)
+    if _cfg.has_option("antd.hw", "read_ahead") and _cfg.getboolean("antd.hw", "read_ahead"):
+        hardware = hw.ReadAheadHardware(hardware)
+    return hardware
+
+def create_emulated_hardware():
+    return create_emulated_hardware_pool(1)[0]
 
-def create_ant_core():
+def create_emulated_hardware_pool(max_sticks=0):
+    import antd.emulator as emulator
+    _log.warning("Using emulated ANT hardware and device.")
+    sticks = int(_cfg.get("antd.emulator", "sticks"), 0) if _cfg.has_option("antd.emulator", "sticks") else 1
+    watches = int(_cfg.get("antd.emulator", "watches"), 0) if _cfg.has_option("antd.emulator", "watches") else 1
+    noise = {}
+    if _cfg.has_option("antd.emulator", "noise") and _cfg.get("antd.emulator", "noise"):
+        for entry in _cfg.get("antd.emulator", "noise").split(","):
+            freq, drop_rate = entry.split(":")
+            noise[int(freq, 0)] = float(drop_rate)
+    return emulator.create_hardware_pool(
+            sticks=min(sticks, max_sticks) if max_sticks else sticks,
+            watches=watches,
+            speed=float(_cfg.get("antd.emulator", "speed")),
+            drop_rate=float(_cfg.get("antd.emulator", "drop_rate")),
+            burst_failure_rate=float(_cfg.get("antd.emulator", "burst_failure_rate")),
+            noise=noise,
+            runs=int(_cfg.get("antd.emulator", "runs"), 0),
+            trackpoints=int(_cfg.get("antd.emulator", "trackpoints"), 0),
+            packets_per_reply=int(_cfg.get("antd.emulator", "packets_per_reply"), 0)
+                    if _cfg.has_option("antd.emulator", "packets_per_reply") else 1)
+
+def create_ant_core(hardware=None):
     import antd.ant as ant
-    return ant.Core(create_hardware())
+    return ant.Core(hardware or create_hardware())
 
-def create_ant_session():
+def create_ant_session(hardware=None):
     import antd.ant as ant
-    session = ant.Session(create_ant_core())
-    session.default_read_timeout = int(_cfg.get("antd.ant", "default_read_timeout"), 0)
-    session.default_write_timeout = int(_cfg.get("antd.ant", "default_write_timeout"), 0)
+    session = ant.Session(create_ant_core(hardware))
+    session.default_read_timeout = get_timeout("antd.ant", "default_read_timeout")
+    session.default_write_timeout = get_timeout("antd.ant", "default_write_timeout")
     session.default_retry = int(_cfg.get("antd.ant", "default_retry"), 0)
     return session
 
-def create_antfs_host():
+def create_known_device_db():
     import antd.antfs as antfs
     keys_file = _cfg.get("antd.antfs", "auth_pairing_keys")
     keys_file = os.path.expanduser(keys_file)
     keys_dir = os.path.dirname(keys_file)
     if not os.path.exists(keys_dir): os.makedirs(keys_dir)
-    keys = antfs.KnownDeviceDb(keys_file)
-    host = antfs.Host(create_ant_session(), keys)
+    return antfs.KnownDeviceDb(keys_file)
+
+def create_link_quality_db():
+    import antd.antfs as antfs
+    if not _cfg.has_option("antd.antfs", "link_quality") or not _cfg.get("antd.antfs", "link_quality"):
+        return antfs.LinkQualityDb()
+    return antfs.LinkQualityDb(os.path.expanduser(_cfg.get("antd.antfs", "link_quality")))
+
+def create_antfs_host(hardware=None, keys=None, session=None, channel_number=None, transport_freqs_in_use=None,
+                      link_quality=None):
+    import antd.antfs as antfs
+    host = antfs.Host(session or create_ant_session(hardware), keys or create_known_device_db(),
+            channel_number, transport_freqs_in_use)
+    host.link_quality = link_quality or create_link_quality_db()
     host.search_network_key = binascii.unhexlify(_cfg.get("antd.antfs", "search_network_key"))
     host.search_freq = int(_cfg.get("antd.antfs", "search_freq"), 0)
     host.search_period = int(_cfg.get("antd.antfs", "search_period"), 0)
@@ -125,6 +227,29 @@ def create_antfs_host():
     host.transport_timeout = int(_cfg.get("antd.antfs", "transport_timeout"), 0)
     return host
 
+def create_antfs_hosts():
+    """
+    Return an ANTFS host for every ANT stick in the
+    hardware pool, or if [antd.antfs] channels > 1, a
+    host for each of that many channels of every stick.
+    All share one database of known devices, and of
+    link quality.
+    """
+    keys = create_known_device_db()
+    link_quality = create_link_quality_db()
+    channels = int(_cfg.get("antd.antfs", "channels"), 0) if _cfg.has_option("antd.antfs", "channels") else 1
+    hosts = []
+    for hardware in create_hardware_pool():
+        if channels > 1:
+            session = create_ant_session(hardware)
+            transport_freqs_in_use = set()
+            hosts.extend(create_antfs_host(keys=keys, session=session, channel_number=n,
+                                           transport_freqs_in_use=transport_freqs_in_use, link_quality=link_quality)
+                         for n in range(0, min(channels, len(session.channels))))
+        else:
+            hosts.append(create_antfs_host(hardware, keys, link_quality=link_quality))
+    return hosts
+
 def create_garmin_connect_plugin():
     try:
         if _cfg.getboolean("antd.connect", "enabled"):
@@ -183,12 +308,44 @@ def get_path(section, key, file="", tokens={}):
     if not os.path.exists(path): os.makedirs(path)
     return os.path.sep.join([path, file]) if file else path
 
+def create_checkpoint(device_id):
+    import antd.garmin as garmin
+    if _cfg.has_option("antd", "checkpoint_dir") and _cfg.get("antd", "checkpoint_dir"):
+        return garmin.Checkpoint(get_path("antd", "checkpoint_dir", tokens={"device_id": hex(device_id)}))
+
+def create_download_history(device_id):
+    import antd.garmin as garmin
+    if _cfg.has_option("antd", "download_history") and _cfg.get("antd", "download_history"):
+        file = os.path.expanduser(_cfg.get("antd", "download_history")) % {"device_id": hex(device_id)}
+        dir = os.path.dirname(file)
+        if not os.path.exists(dir): os.makedirs(dir)
+        return garmin.DownloadHistory(file)
+
+def get_raw_sync():
+    try:
+        return _cfg.getint("antd", "raw_sync")
+    except ConfigParser.NoOptionError:
+        return 0
+
+def get_batch_acks():
+    try:
+        return _cfg.getboolean("antd", "batch_acks")
+    except ConfigParser.NoOptionError:
+        return False
+
 def get_delete_from_device():
     try:
         return _cfg.getboolean("antd", "delete_from_device")
     except ConfigParser.NoOptionError:
         return False
 
+def get_timeout(section, key):
+    """
+    Timeout in seconds, or None if "auto".
+    """
+    value = _cfg.get(section, key)
+    return None if value.strip().lower() == "auto" else float(value)
+
 def get_retry():
     return int(_cfg.get("antd", "retry"), 0)
 
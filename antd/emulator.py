@@ -0,0 +1,1017 @@
+# Copyright (c) 2012, Braiden Kindt.
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 
+#   1. Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+# 
+#   2. Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDER AND CONTRIBUTORS
+# ''AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY
+# WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+
+"""
+Emulated ANT hardware and a virtual Garmin ANT-FS device.
+EmulatedStick implements the same interface as UsbHardware,
+so Core/Session can run against it unchanged. Any number
+of sticks, and VirtualWatch devices, share an in-process
+Air. Channels of a stick may be masters or slaves, the air
+models channel period, frequency, collisions and loss.
+VirtualWatch speaks ANT-FS (beacon, link, auth) and the
+Garmin L001/A1000 download protocol. Emulation runs in
+virtual time on one thread, speed may be increased to
+benchmark without waiting on real RF timing.
+"""
+
+import threading
+import logging
+import random
+import struct
+import heapq
+import itertools
+import collections
+import time
+import errno
+
+import antd.ant as ant
+import antd.antfs as antfs
+import antd.garmin as garmin
+import antd.hw as hw
+
+_log = logging.getLogger("antd.emulator")
+
+# ant burst rate is ~20kbps, 8 bytes per packet
+BURST_PACKET_INTERVAL = 1. / 300
+# time on air of a single message
+MESSAGE_AIRTIME = 0.0005
+# crystal tolerance, masters with the same period drift
+# past each other rather than colliding forever
+CLOCK_DRIFT = 50e-6
+# packets delivered by each burst event
+_BURST_CHUNK = 8
+
+
+class Scheduler(object):
+    """
+    Runs emulation events in virtual time, on a single
+    thread. Virtual time advances at speed x real time.
+    Events run holding lock, which must also be held by
+    any other thread which modifies emulator state.
+    """
+
+    def __init__(self, speed=1.0):
+        self.speed = float(speed)
+        self.lock = threading.RLock()
+        self.running = False
+        self.thread = None
+        self._events = []
+        self._seq = itertools.count()
+        self._wakeup = hw.PipeEvent()
+        self._start = time.time()
+        self._time = None
+
+    def now(self):
+        return (time.time() - self._start) * self.speed
+
+    def clock(self):
+        """
+        Virtual time. Within an event, the time it was
+        scheduled for, so periodic events do not drift
+        when the emulator thread runs late.
+        """
+        if self._time is not None and threading.current_thread() is self.thread:
+            return self._time
+        return self.now()
+
+    def call_later(self, delay, fn, *args):
+        """
+        Run fn(*args) after delay seconds of virtual time.
+        Returns a handle which can be passed to cancel().
+        """
+        event = [self.clock() + delay, next(self._seq), fn, args]
+        with self.lock:
+            heapq.heappush(self._events, event)
+        self._wakeup.set()
+        return event
+
+    def cancel(self, event):
+        if event: event[2] = None
+
+    def start(self):
+        if not self.running:
+            self.running = True
+            self.thread = threading.Thread(target=self._run, name="Emulator")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        if self.running:
+            self.running = False
+            self._wakeup.set()
+            self.thread.join(1)
+            self._wakeup.close()
+
+    def _run(self):
+        while self.running:
+            with self.lock:
+                now = self.now()
+                while self._events and self._events[0][0] <= now:
+                    t, seq, fn, args = heapq.heappop(self._events)
+                    if fn is None: continue
+                    self._time = t
+                    try:
+                        fn(*args)
+                    except Exception:
+                        _log.error("Caught exception running emulator event.", exc_info=True)
+                    finally:
+                        self._time = None
+                timeout = (self._events[0][0] - now) / self.speed if self._events else 1
+            self._wakeup.wait(timeout)
+
+
+class Air(object):
+    """
+    The RF environment shared by emulated sticks and
+    devices. Each period a master transmits a broadcast,
+    acknowledged data or a burst. Slave channels which
+    are listening on the same frequency, network and
+    period receive, and reply in the same slot with any
+    pending data. Transmissions which overlap on a
+    frequency collide, the later one is lost.
+
+    Nodes (slave or master channels, devices) implement
+    receive_broadcast(), which returns a pending reply,
+    receive_acknowledged(), receive_burst_packets(),
+    receive_burst() and receive_burst_failed().
+    Masters have rf_freq, network_key, channel_period,
+    the channel id, and are busy while receiving a burst.
+    noise maps rf_freq to a drop rate added to drop_rate
+    for messages on that frequency.
+    """
+
+    def __init__(self, scheduler, drop_rate=0.0, burst_failure_rate=0.0, burst_packet_interval=BURST_PACKET_INTERVAL,
+                 message_airtime=MESSAGE_AIRTIME, clock_drift=CLOCK_DRIFT, seed=None, noise=None):
+        self.scheduler = scheduler
+        self.drop_rate = drop_rate
+        self.noise = noise or {}
+        self.burst_failure_rate = burst_failure_rate
+        self.burst_packet_interval = burst_packet_interval
+        self.message_airtime = message_airtime
+        self.clock_drift = clock_drift
+        self.random = random.Random(seed)
+        self.channels = []
+        self.sticks = []
+        self.collisions = 0
+        self.drops = 0
+        # (start, end, sender) of recent transmissions by frequency
+        self._on_air = collections.defaultdict(list)
+
+    def attach(self, stick):
+        with self.scheduler.lock:
+            self.sticks.append(stick)
+        self.scheduler.start()
+
+    def detach(self, stick):
+        with self.scheduler.lock:
+            self.sticks.remove(stick)
+            self.channels = [c for c in self.channels if c.stick is not stick]
+            last = not self.sticks
+        if last: self.scheduler.stop()
+
+    def open(self, channel):
+        self.channels.append(channel)
+
+    def close(self, channel):
+        if channel in self.channels: self.channels.remove(channel)
+
+    def dropped(self, freq=None):
+        drop_rate = self.drop_rate + self.noise.get(freq, 0.0)
+        if drop_rate and self.random.random() < drop_rate:
+            self.drops += 1
+            return True
+
+    def listeners(self, master):
+        return [c for c in self.channels if c is not master and c.can_receive(master)]
+
+    def transmit(self, master, kind, data, on_done):
+        """
+        Master transmits data in its slot. kind is one of
+        "broadcast", "ack", or "burst". on_done(success)
+        is called once the transmission is complete.
+        """
+        if kind == "burst":
+            receivers = [c for c in self.listeners(master) if c.is_tracking(master)]
+            packets = self._packets(data)
+            collided = self._occupy(master, len(packets) * self.burst_packet_interval)
+            def done(success):
+                for channel in receivers:
+                    if success: channel.receive_burst(master, data)
+                    else: channel.receive_burst_failed(master)
+                on_done(success)
+            self.burst(packets, bool(receivers) and not collided,
+                    lambda chunk: [c.receive_burst_packets(master, chunk) for c in receivers], done, master.rf_freq)
+            return
+        received = False
+        if not self._occupy(master, self.message_airtime):
+            for channel in self.listeners(master):
+                if self.dropped(master.rf_freq): continue
+                received = True
+                if kind == "ack":
+                    channel.receive_acknowledged(master, data)
+                else:
+                    pending = channel.receive_broadcast(master, data)
+                    if pending: self._reply(channel, master, *pending)
+        on_done(received or kind == "broadcast")
+
+    def burst(self, packets, deliverable, on_packets, on_done, freq=None):
+        """
+        Deliver packets with on_packets([(flags, data), ...])
+        at the burst rate, and finally on_done(success).
+        """
+        fail_at = None
+        if not deliverable:
+            fail_at = 0
+        elif self.burst_failure_rate and self.random.random() < self.burst_failure_rate:
+            fail_at = self.random.randrange(len(packets))
+        if (self.drop_rate or freq in self.noise) and fail_at is None:
+            # index of first dropped packet, if any
+            for n in xrange(0, len(packets)):
+                if self.dropped(freq):
+                    fail_at = n
+                    break
+        self._burst_chunk(packets, 0, fail_at, on_packets, on_done)
+
+    def _packets(self, data):
+        return [data[n:n + 8].ljust(8, "\x00") for n in xrange(0, len(data), 8)] or ["\x00" * 8]
+
+    def _burst_chunk(self, packets, index, fail_at, on_packets, on_done):
+        end = min(len(packets), index + _BURST_CHUNK)
+        if fail_at is not None and fail_at < end:
+            end = fail_at
+        chunk = []
+        for n in xrange(index, end):
+            seq = 0 if not n else (n - 1) % 3 + 1
+            chunk.append(((seq << 5) | (0x80 if n == len(packets) - 1 else 0x00), packets[n]))
+        if chunk: on_packets(chunk)
+        if end == len(packets):
+            on_done(True)
+        elif end == fail_at:
+            on_done(False)
+        else:
+            self.scheduler.call_later(len(chunk) * self.burst_packet_interval,
+                    self._burst_chunk, packets, end, fail_at, on_packets, on_done)
+
+    def _occupy(self, sender, duration):
+        """
+        Mark sender's frequency in use for duration.
+        Returns true if this overlaps (collides with)
+        another transmission.
+        """
+        now = self.scheduler.clock()
+        on_air = [t for t in self._on_air[sender.rf_freq] if t[1] > now]
+        others = [other for start, end, other in on_air if other is not sender]
+        on_air.append((now, now + duration, sender))
+        self._on_air[sender.rf_freq] = on_air
+        if others:
+            self.collisions += 1
+            # a stick detects collisions between its own channels
+            stick = getattr(sender, "stick", None)
+            if stick and any(getattr(other, "stick", None) is stick for other in others):
+                stick.emit_event(sender.channel_number, 1, ant.EVENT_CHANNEL_COLLISION)
+            return True
+
+    def _reply(self, channel, master, kind, data):
+        """
+        Deliver the data channel had pending in the
+        reverse direction of the slot just received.
+        """
+        if kind == "broadcast":
+            if not self.dropped(master.rf_freq): master.receive_broadcast(channel, data)
+            channel.transmit_done(True)
+        elif kind == "ack":
+            if self.dropped(master.rf_freq):
+                channel.transmit_done(False)
+            else:
+                master.receive_acknowledged(channel, data)
+                channel.transmit_done(True)
+        else:
+            packets = self._packets(data)
+            def done(success):
+                master.busy = False
+                if success: master.receive_burst(channel, data)
+                else: master.receive_burst_failed(channel)
+                channel.transmit_done(success)
+            # reverse burst occupies the master's slot
+            master.busy = True
+            self._occupy(master, len(packets) * self.burst_packet_interval)
+            self.burst(packets, True, lambda chunk: master.receive_burst_packets(channel, chunk), done, master.rf_freq)
+
+
+class EmulatedChannel(object):
+    """
+    A channel of an emulated ANT stick. Master channels
+    (channel type 0x10) transmit each period. Slave
+    channels search for, then track, a master.
+    """
+
+    def __init__(self, stick, channel_number):
+        self.stick = stick
+        self.air = stick.air
+        self.scheduler = stick.air.scheduler
+        self.channel_number = channel_number
+        self._timer = None
+        self._tick_event = None
+        self.reset()
+
+    def reset(self):
+        self.state = ant.CHANNEL_STATUS_UNASSIGNED
+        self.channel_type = 0
+        self.network_number = 0
+        self.device_number = 0
+        self.device_type_id = 0
+        self.trans_type = 0
+        self.period = 0x2000
+        self.search_timeout = 12
+        self.rf_freq = 66
+        self.master = None
+        self.pending = None
+        self.busy = False
+        self.misses = 0
+        self.broadcast_data = "\x00" * 8
+        self.id_list = [(0, 0, 0)] * ant.MAX_ID_LIST_SIZE
+        self.id_list_size = 0
+        self.id_list_exclude = False
+        self._burst = []
+        self._cancel_timer()
+        self.scheduler.cancel(self._tick_event)
+        self.air.close(self)
+
+    @property
+    def is_master(self):
+        return bool(self.channel_type & 0x10)
+
+    @property
+    def is_open(self):
+        return self.state in (ant.CHANNEL_STATUS_SEARCHING, ant.CHANNEL_STATUS_TRACKING)
+
+    @property
+    def network_key(self):
+        return self.stick.network_keys[self.network_number]
+
+    @property
+    def channel_period(self):
+        return self.period
+
+    @property
+    def period_seconds(self):
+        return self.period / 32768.
+
+    @property
+    def status(self):
+        return self.state | (self.network_number << 2) | (self.channel_type & 0xF0)
+
+    def can_receive(self, master):
+        if (self.is_master or self.rf_freq != master.rf_freq or self.network_key != master.network_key
+                or master.channel_period % self.period):
+            return False
+        elif self.state == ant.CHANNEL_STATUS_TRACKING:
+            return self.master is master
+        elif self.state == ant.CHANNEL_STATUS_SEARCHING:
+            return (self._id_matches((self.device_number, self.device_type_id, self.trans_type), master)
+                and self._id_list_allows(master))
+
+    def _id_matches(self, channel_id, master):
+        device_number, device_type_id, trans_type = channel_id
+        return ((not device_number or device_number == master.device_number)
+            and (not device_type_id or device_type_id == master.device_type_id)
+            and (not trans_type or trans_type == master.trans_type))
+
+    def _id_list_allows(self, master):
+        if not self.id_list_size: return True
+        listed = any(self._id_matches(channel_id, master) for channel_id in self.id_list[:self.id_list_size])
+        return listed != self.id_list_exclude
+
+    def is_tracking(self, master):
+        return self.state == ant.CHANNEL_STATUS_TRACKING and self.master is master
+
+    def receive_broadcast(self, peer, data):
+        """
+        Handle a broadcast from peer, returns
+        (kind, data) if a slave reply is pending.
+        """
+        if not self.is_master: self._track(peer)
+        self.stick.emit(ant.RecvBroadcastData(self.channel_number, data))
+        if not self.is_master and self.pending and self.pending[0] != "sending":
+            pending, self.pending = self.pending, ("sending", self.pending[0])
+            return pending
+
+    def receive_acknowledged(self, peer, data):
+        if not self.is_master: self._track(peer)
+        self.stick.emit(ant.RecvAcknowledgedData(self.channel_number, data))
+
+    def receive_burst_packets(self, peer, packets):
+        if not self.is_master: self._track(peer)
+        for flags, data in packets:
+            self.stick.emit(ant.RecvBurstTransferPacket(self.channel_number | flags, data))
+
+    def receive_burst(self, peer, data):
+        pass
+
+    def receive_burst_failed(self, peer):
+        self.stick.emit_event(self.channel_number, 1, ant.EVENT_TRANSFER_RX_FAILED)
+
+    def transmit_done(self, success):
+        kind = self.pending and self.pending[1]
+        self.pending = None
+        # master was busy receiving, not missed
+        if self.master: self._track(self.master)
+        if kind == "broadcast":
+            self.stick.emit_event(self.channel_number, 1, ant.EVENT_TX)
+        elif success:
+            self.stick.emit_event(self.channel_number, 1, ant.EVENT_TRANSFER_TX_COMPLETED)
+        else:
+            self.stick.emit_event(self.channel_number, 1, ant.EVENT_TRANSFER_TX_FAILED)
+
+    def open(self):
+        self.air.open(self)
+        if self.is_master:
+            # masters are always "tracking", first transmission at a random phase
+            self.state = ant.CHANNEL_STATUS_TRACKING
+            if not self.device_number: self.device_number = self.stick.serial_number & 0xFFFF
+            self._skew = 1 + self.air.random.uniform(-1, 1) * self.air.clock_drift
+            self._tick_event = self.scheduler.call_later(self.air.random.random() * self.period_seconds, self._tick)
+        else:
+            self.state = ant.CHANNEL_STATUS_SEARCHING
+            self._start_search()
+
+    def close(self):
+        if self.is_open:
+            if self.pending:
+                self.pending = None
+                self.stick.emit_event(self.channel_number, 1, ant.EVENT_TRANSFER_TX_FAILED)
+            self.state = ant.CHANNEL_STATUS_ASSIGNED
+            self.master = None
+            self._cancel_timer()
+            self.scheduler.cancel(self._tick_event)
+            self.air.close(self)
+            self.stick.emit_event(self.channel_number, 1, ant.EVENT_CHANNEL_CLOSED)
+
+    def send(self, kind, data):
+        if not self.is_open or self.pending:
+            return ant.CHANNEL_IN_WRONG_STATE
+        if self.is_master and kind == "broadcast":
+            # master re-transmits most recent broadcast data every period
+            self.broadcast_data = data
+        else:
+            self.pending = (kind, data)
+        return ant.RESPONSE_NO_ERROR
+
+    def send_burst_packet(self, channel_number, data):
+        if not self.is_open or self.pending:
+            return ant.CHANNEL_IN_WRONG_STATE
+        if not channel_number & 0x60: self._burst = []
+        self._burst.append(data)
+        if channel_number & 0x80:
+            self.pending = ("burst", "".join(self._burst))
+            self._burst = []
+        return ant.RESPONSE_NO_ERROR
+
+    def _tick(self):
+        """
+        Master transmits pending acknowledged or
+        burst data, otherwise broadcast data.
+        """
+        if not self.is_open: return
+        if self.busy:
+            self._tick_event = self.scheduler.call_later(self.period_seconds * self._skew, self._tick)
+        elif self.pending and self.pending[0] in ("ack", "burst"):
+            kind, data = self.pending
+            self.pending = ("sending", kind)
+            self.air.transmit(self, kind, data, self._transmitted)
+        else:
+            self.pending = ("sending", "broadcast")
+            self.air.transmit(self, "broadcast", self.broadcast_data, self._transmitted)
+
+    def _transmitted(self, success):
+        self.transmit_done(success)
+        if self.is_open:
+            self._tick_event = self.scheduler.call_later(self.period_seconds * self._skew, self._tick)
+
+    def _track(self, master):
+        self.state = ant.CHANNEL_STATUS_TRACKING
+        self.master = master
+        self.misses = 0
+        self._set_timer(self.period_seconds * 1.5, self._missed)
+
+    def _missed(self):
+        self.misses += 1
+        self.stick.emit_event(self.channel_number, 1, ant.EVENT_RX_FAIL)
+        if self.misses >= 8:
+            self.stick.emit_event(self.channel_number, 1, ant.EVENT_RX_FAIL_GO_TO_SEARCH)
+            self.state = ant.CHANNEL_STATUS_SEARCHING
+            self.master = None
+            self._start_search()
+        else:
+            self._set_timer(self.period_seconds, self._missed)
+
+    def _start_search(self):
+        # search timeout is in 2.5 second increments, 255 is infinite
+        if self.search_timeout != 0xFF:
+            self._set_timer(self.search_timeout * 2.5, self._search_timed_out)
+        else:
+            self._cancel_timer()
+
+    def _search_timed_out(self):
+        self.stick.emit_event(self.channel_number, 1, ant.EVENT_RX_SEARCH_TIMEOUT)
+        self.close()
+
+    def _set_timer(self, delay, fn):
+        self._cancel_timer()
+        self._timer = self.scheduler.call_later(delay, fn)
+
+    def _cancel_timer(self):
+        self.scheduler.cancel(self._timer)
+        self._timer = None
+
+
+class EmulatedStick(object):
+    """
+    An emulated ANT USB stick, usable in place of
+    UsbHardware. Host commands are executed immediately,
+    RF traffic is exchanged over the given Air.
+    """
+
+    max_write_size = 64
+
+    def __init__(self, air, max_channels=8, max_networks=3, serial_number=0x12345678, search_list=True):
+        self.air = air
+        self.serial_number = serial_number
+        # inclusion / exclusion lists (AP2)
+        self.search_list = search_list
+        self.channels = [EmulatedChannel(self, n) for n in xrange(0, max_channels)]
+        self.network_keys = ["\x00" * 8] * max_networks
+        self._output = collections.deque()
+        self._ready = hw.PipeEvent()
+        self._lock = threading.Lock()
+        self._reading = False
+        self.closed = False
+        air.attach(self)
+
+    def close(self):
+        with self.air.scheduler.lock:
+            for channel in self.channels: channel.reset()
+        self.air.detach(self)
+        with self._lock:
+            self.closed = True
+            # a blocked reader is woken, and closes the pipe
+            if self._reading: self._ready.set()
+            else: self._ready.close()
+
+    def write(self, data, timeout):
+        data = str(data)
+        with self.air.scheduler.lock:
+            offset = 0
+            while offset < len(data):
+                if ord(data[offset]) not in (0xa4, 0xa5):
+                    # padding
+                    offset += 1
+                    continue
+                length = ord(data[offset + 1])
+                msg = data[offset:offset + length + 4]
+                offset += length + 4
+                if not ant.validate_checksum(bytearray(msg)):
+                    self.emit(ant.SerialError(0, msg))
+                else:
+                    self._execute(ord(msg[2]), msg[3:-1])
+
+    def read(self, timeout):
+        deadline = time.time() + timeout / 1000.
+        with self._lock:
+            if self.closed: raise IOError(errno.EBADF, "Hardware closed")
+            self._reading = True
+        try:
+            while not self._output and not self.closed:
+                if not self._ready.wait(deadline - time.time()): break
+        finally:
+            with self._lock:
+                self._reading = False
+                if self.closed: self._ready.close()
+        frames = []
+        try:
+            while True: frames.append(self._output.popleft())
+        except IndexError:
+            pass
+        if not frames: raise IOError(errno.ETIMEDOUT, "Timeout")
+        return "".join(frames)
+
+    def emit(self, msg):
+        self._output.append(msg.pack())
+        self._ready.set()
+
+    def emit_event(self, channel_number, msg_id, msg_code):
+        self.emit(ant.ChannelEvent(channel_number, msg_id, msg_code))
+
+    def _execute(self, msg_id, args):
+        if msg_id == ant.ResetSystem.ID:
+            for channel in self.channels: channel.reset()
+            self.network_keys = ["\x00" * 8] * len(self.network_keys)
+            # reset reason, command
+            self.emit(ant.StartupMessage(0x20))
+            return
+        elif msg_id == ant.SetNetworkKey.ID:
+            cmd = ant.SetNetworkKey.unpack_args(args)
+            if cmd.network_number < len(self.network_keys):
+                self.network_keys[cmd.network_number] = cmd.network_key
+                self.emit_event(cmd.network_number, msg_id, ant.RESPONSE_NO_ERROR)
+            else:
+                self.emit_event(cmd.network_number, msg_id, ant.INVALID_NETWORK_NUMBER)
+            return
+        channel_number = ord(args[0])
+        try:
+            channel = self.channels[channel_number & 0x1f]
+        except IndexError:
+            self.emit_event(channel_number, msg_id, ant.INVALID_MESSAGE)
+            return
+        code = ant.RESPONSE_NO_ERROR
+        if msg_id == ant.AssignChannel.ID:
+            cmd = ant.AssignChannel.unpack_args(args)
+            channel.channel_type, channel.network_number = cmd.channel_type, cmd.network_number
+            channel.state = ant.CHANNEL_STATUS_ASSIGNED
+        elif msg_id == ant.UnassignChannel.ID:
+            channel.reset()
+        elif msg_id == ant.SetChannelId.ID:
+            cmd = ant.SetChannelId.unpack_args(args)
+            channel.device_number, channel.device_type_id, channel.trans_type = cmd.device_number, cmd.device_type_id, cmd.trans_type
+        elif msg_id == ant.SetChannelPeriod.ID:
+            channel.period = ant.SetChannelPeriod.unpack_args(args).messaging_period
+        elif msg_id == ant.SetChannelSearchTimeout.ID:
+            channel.search_timeout = ant.SetChannelSearchTimeout.unpack_args(args).search_timeout
+            if channel.state == ant.CHANNEL_STATUS_SEARCHING and not channel.is_master: channel._start_search()
+        elif msg_id == ant.SetChannelRfFreq.ID:
+            channel.rf_freq = ant.SetChannelRfFreq.unpack_args(args).rf_freq
+        elif msg_id == ant.SetSearchWaveform.ID:
+            pass
+        elif msg_id == ant.AddChannelIdToList.ID and self.search_list:
+            cmd = ant.AddChannelIdToList.unpack_args(args)
+            if cmd.list_index < ant.MAX_ID_LIST_SIZE:
+                channel.id_list[cmd.list_index] = (cmd.device_number, cmd.device_type_id, cmd.trans_type)
+            else:
+                code = ant.INVALID_PARAMETER_PROVIDED
+        elif msg_id == ant.ConfigIdList.ID and self.search_list:
+            cmd = ant.ConfigIdList.unpack_args(args)
+            if cmd.list_size <= ant.MAX_ID_LIST_SIZE:
+                channel.id_list_size, channel.id_list_exclude = cmd.list_size, bool(cmd.exclude)
+            else:
+                code = ant.INVALID_PARAMETER_PROVIDED
+        elif msg_id == ant.OpenChannel.ID:
+            if channel.state != ant.CHANNEL_STATUS_ASSIGNED: code = ant.CHANNEL_IN_WRONG_STATE
+        elif msg_id == ant.CloseChannel.ID:
+            if channel.state not in (ant.CHANNEL_STATUS_SEARCHING, ant.CHANNEL_STATUS_TRACKING): code = ant.CHANNEL_NOT_OPENED
+        elif msg_id == ant.RequestMessage.ID:
+            self._request(channel, ant.RequestMessage.unpack_args(args).msg_id)
+            return
+        elif msg_id in (ant.SendBroadcastData.ID, ant.SendAcknowledgedData.ID):
+            data = ant.SendAcknowledgedData.unpack_args(args).data
+            code = channel.send("ack" if msg_id == ant.SendAcknowledgedData.ID else "broadcast", data)
+            if code == ant.RESPONSE_NO_ERROR: return
+        elif msg_id == ant.SendBurstTransferPacket.ID:
+            code = channel.send_burst_packet(channel_number, args[1:9])
+            if code == ant.RESPONSE_NO_ERROR: return
+        else:
+            code = ant.INVALID_MESSAGE
+        self.emit_event(channel_number & 0x1f, msg_id, code)
+        # state changes which generate events are applied after the response
+        if code == ant.RESPONSE_NO_ERROR:
+            if msg_id == ant.OpenChannel.ID: channel.open()
+            elif msg_id == ant.CloseChannel.ID: channel.close()
+
+    def _request(self, channel, msg_id):
+        n = channel.channel_number
+        if msg_id == ant.ChannelId.ID:
+            master = channel.master
+            if master:
+                self.emit(ant.ChannelId(n, master.device_number, master.device_type_id, master.trans_type))
+            else:
+                self.emit(ant.ChannelId(n, channel.device_number, channel.device_type_id, channel.trans_type))
+        elif msg_id == ant.ChannelStatus.ID:
+            self.emit(ant.ChannelStatus(n, channel.status))
+        elif msg_id == ant.Capabilities.ID:
+            self.emit(ant.Capabilities(len(self.channels), len(self.network_keys), 0,
+                    ant.CAPABILITIES_SEARCH_LIST_ENABLED if self.search_list else 0))
+        elif msg_id == ant.AntVersion.ID:
+            self.emit(ant.AntVersion("EMULATED\x00\x00\x00"))
+        elif msg_id == ant.SerialNumber.ID:
+            self.emit(ant.SerialNumber(self.serial_number))
+        else:
+            self.emit_event(n, ant.RequestMessage.ID, ant.INVALID_MESSAGE)
+
+
+def _garmin_packet(pid, data=""):
+    return struct.pack("<HH", pid, len(data)) + data
+
+class VirtualWatch(object):
+    """
+    An ANT-FS client which serves runs using the Garmin
+    L001/A1000 protocols (like a Forerunner 405). History
+    is generated on demand, runs/trackpoints are totals.
+    """
+
+    product_id = 484
+    software_version = 250
+    description = "Forerunner405 Software Version 2.50"
+    protocol_array = ["P000", "L001", "A010", "A1000", "D1009", "A906", "D1015", "A302", "D311", "D1018"]
+
+    device_type_id = 1
+    trans_type = 5
+    manufacturer_id = 1
+    search_freq = 50
+    network_key = antfs.Host.search_network_key
+    # beacon period 2^(n-1) hz
+    search_beacon_period = 4
+    # return to link state, if host is silent. in real (not virtual)
+    # seconds, since host timeouts and retry delays are real time.
+    link_timeout = 10
+    # first run starts at, garmin epoch
+    history_start = 662688000
+
+    def __init__(self, air, serial_number=3860000001, runs=10, trackpoints=10000, laps_per_run=1,
+                 trackpoints_per_packet=32, packets_per_reply=1, pairing_enabled=True, passkey=None):
+        self.air = air
+        self.scheduler = air.scheduler
+        self.serial_number = serial_number
+        self.device_number = serial_number & 0xFFFF
+        self.runs = runs
+        self.trackpoints = trackpoints
+        self.laps_per_run = laps_per_run
+        self.trackpoints_per_packet = trackpoints_per_packet
+        self.packets_per_reply = packets_per_reply
+        self.pairing_enabled = pairing_enabled
+        # derived from serial, so a watch paired in one run is still paired in the next
+        self.passkey = passkey or struct.pack("<Q", random.Random(serial_number).getrandbits(64))
+        self.running = False
+        self._link()
+
+    def start(self):
+        with self.scheduler.lock:
+            if not self.running:
+                self.running = True
+                self.busy = False
+                self._tick_event = self.scheduler.call_later(self.air.random.random() / 8, self._tick)
+
+    def stop(self):
+        with self.scheduler.lock:
+            self.running = False
+            self.scheduler.cancel(self._tick_event)
+
+    @property
+    def channel_period(self):
+        return 0x8000 >> (self.beacon_period - 1)
+
+    def receive_broadcast(self, peer, data):
+        pass
+
+    def receive_acknowledged(self, peer, data):
+        self.receive(peer, data)
+
+    def receive_burst_packets(self, peer, packets):
+        pass
+
+    def receive_burst(self, peer, data):
+        self.receive(peer, data)
+
+    def receive_burst_failed(self, peer):
+        pass
+
+    def receive(self, channel, data):
+        """
+        Handle ANT-FS command received from a host.
+        """
+        self._last_rx = time.time()
+        if len(data) < 8 or ord(data[0]) != antfs.Command.DATA_PAGE_ID:
+            return
+        command_id = ord(data[1])
+        if command_id == antfs.Command.LINK and self.state == antfs.Beacon.STATE_LINK:
+            page, command_id, self.rf_freq, self.beacon_period, self.host_id = struct.unpack("<BBBBI", data[:8])
+            _log.debug("Linked. freq=24%02dmhz", self.rf_freq)
+            self.state = antfs.Beacon.STATE_AUTH
+        elif command_id == antfs.Command.DISCONNECT:
+            _log.debug("Host disconnected.")
+            self._link()
+        elif command_id == antfs.Command.AUTH and self.state == antfs.Beacon.STATE_AUTH:
+            page, command_id, op_id, length, host_id = struct.unpack("<BBBBI", data[:8])
+            self._auth(op_id, data[8:8 + length])
+        elif command_id == antfs.Command.DIRECT and self.state == antfs.Beacon.STATE_TRANSPORT:
+            self._direct(data[8:])
+
+    @property
+    def data_available(self):
+        return self.runs > 0
+
+    def beacon(self):
+        status_1 = self.beacon_period | (0x20 if self.data_available else 0) | (0x80 if self.pairing_enabled else 0)
+        if self.state == antfs.Beacon.STATE_LINK:
+            descriptor = self.device_type_id | self.manufacturer_id << 16
+        else:
+            descriptor = self.host_id
+        return struct.pack("<BBBBI", antfs.Beacon.DATA_PAGE_ID, status_1, self.state, 3, descriptor)
+
+    def _link(self):
+        self.state = antfs.Beacon.STATE_LINK
+        self.rf_freq = self.search_freq
+        self.beacon_period = self.search_beacon_period
+        self.host_id = 0
+        self._reply = None
+        self._replies = iter(())
+        self._unacked = 0
+        self._last_rx = time.time()
+
+    def _tick(self):
+        """
+        Transmit once per period, a pending reply as a burst,
+        otherwise a beacon. Silent while receiving a burst.
+        """
+        if not self.running: return
+        if self.state != antfs.Beacon.STATE_LINK and time.time() - self._last_rx > self.link_timeout:
+            _log.debug("Host timed out, returning to link state.")
+            self._link()
+        if self.busy:
+            self._tick_event = self.scheduler.call_later(self._period_seconds(), self._tick)
+        elif self._reply is not None:
+            # next period starts once burst is complete
+            self.air.transmit(self, "burst", self.beacon() + self._reply, self._reply_done)
+        else:
+            self.air.transmit(self, "broadcast", self.beacon(), self._transmitted)
+
+    def _period_seconds(self):
+        return 1. / 2 ** (self.beacon_period - 1)
+
+    def _transmitted(self, success):
+        self._tick_event = self.scheduler.call_later(self._period_seconds(), self._tick)
+
+    def _reply_done(self, success):
+        self._tick_event = self.scheduler.call_later(self._period_seconds(), self._tick)
+        if success:
+            self._reply = None
+        else:
+            _log.debug("Burst transfer failed, will retry.")
+
+    def _auth(self, op_id, auth_string):
+        if op_id == antfs.Auth.OP_CLIENT_SN:
+            self._auth_reply(antfs.Auth.RESPONSE_NA, garmin.abbrev(self.description, 8)[:8])
+        elif op_id == antfs.Auth.OP_PAIR:
+            if self.pairing_enabled:
+                _log.debug("Paired with host. %s", auth_string)
+                self._auth_reply(antfs.Auth.RESPONSE_ACCEPT, self.passkey)
+                self.state = antfs.Beacon.STATE_TRANSPORT
+            else:
+                self._auth_reply(antfs.Auth.RESPONSE_REJECT)
+        elif op_id == antfs.Auth.OP_PASSKEY:
+            if auth_string == self.passkey:
+                self._auth_reply(antfs.Auth.RESPONSE_ACCEPT)
+                self.state = antfs.Beacon.STATE_TRANSPORT
+            else:
+                self._auth_reply(antfs.Auth.RESPONSE_REJECT)
+
+    def _auth_reply(self, response_type, auth_string=""):
+        header = struct.pack("<BBBBI", antfs.Command.DATA_PAGE_ID, antfs.Command.AUTH | 0x80,
+                response_type, len(auth_string), self.serial_number)
+        self._reply = header + self._pad(auth_string)
+
+    def _direct(self, data):
+        reply = False
+        for pid, length, payload in garmin.tokenize(data):
+            if pid == garmin.P000.PID_ACK:
+                self._unacked -= 1
+                reply = self._unacked <= 0
+            else:
+                self._replies = self._garmin_replies(pid, payload)
+                reply = True
+        if reply:
+            packets = list(itertools.islice(self._replies, self.packets_per_reply))
+            self._unacked = len(packets)
+            data = self._pad("".join(packets))
+            header = struct.pack("<BBHHH", antfs.Command.DATA_PAGE_ID, antfs.Command.DIRECT | 0x80,
+                    0xFFFF, 0, len(data) // 8)
+            self._reply = header + data
+
+    def _pad(self, data):
+        return data + "\x00" * (-len(data) % 8)
+
+    def _garmin_replies(self, pid, data):
+        L001, A010 = garmin.L001, garmin.A010
+        if pid == garmin.L000.PID_PRODUCT_RQST:
+            yield _garmin_packet(garmin.L000.PID_PRODUCT_DATA,
+                    struct.pack("<Hh", self.product_id, self.software_version) + self.description + "\x00")
+            yield _garmin_packet(garmin.L000.PID_PROTOCOL_ARRAY,
+                    "".join(struct.pack("<cH", p[0], int(p[1:])) for p in self.protocol_array))
+        elif pid == L001.PID_COMMAND_DATA:
+            (command,) = struct.unpack("<H", data[:2])
+            if command == A010.CMND_TRANSFER_RUNS:
+                yield _garmin_packet(L001.PID_RECORDS, struct.pack("<H", self.runs))
+                for run in xrange(0, self.runs): yield _garmin_packet(L001.PID_RUN, self._run(run))
+                yield _garmin_packet(L001.PID_XFER_CMPLT, struct.pack("<H", command))
+            elif command == A010.CMND_TRANSFER_LAPS:
+                yield _garmin_packet(L001.PID_RECORDS, struct.pack("<H", self.runs * self.laps_per_run))
+                for lap in xrange(0, self.runs * self.laps_per_run): yield _garmin_packet(L001.PID_LAP, self._lap(lap))
+                yield _garmin_packet(L001.PID_XFER_CMPLT, struct.pack("<H", command))
+            elif command == A010.CMND_TRANSFER_TRK:
+                yield _garmin_packet(L001.PID_RECORDS, struct.pack("<H", (self.runs + self.trackpoints) & 0xFFFF))
+                for run in xrange(0, self.runs):
+                    yield _garmin_packet(L001.PID_TRK_HDR, struct.pack("<H", run))
+                    first, count = self._run_trackpoints(run)
+                    for n in xrange(first, first + count, self.trackpoints_per_packet):
+                        yield _garmin_packet(L001.PID_TRK_DATA_ARRAY,
+                                self._trackpoints(run, n, min(self.trackpoints_per_packet, first + count - n)))
+                yield _garmin_packet(L001.PID_XFER_CMPLT, struct.pack("<H", command))
+            elif command == A010.CMND_ABORT_TRANSFER:
+                _log.debug("Transfer aborted.")
+            elif command == 0x02a5:
+                _log.debug("Deleting runs.")
+                self.runs = 0
+                self.trackpoints = 0
+
+    def _run_trackpoints(self, run):
+        """
+        Return (first, count) of run's trackpoints.
+        """
+        per_run, extra = divmod(self.trackpoints, self.runs)
+        return run * per_run + min(run, extra), per_run + (1 if run < extra else 0)
+
+    def _run_start(self, run):
+        return self.history_start + run * 86400
+
+    def _run(self, run):
+        first_lap = run * self.laps_per_run
+        return (struct.pack("<HHHBBBx2x", run, first_lap, first_lap + self.laps_per_run - 1, 0, 0, 0)
+                + struct.pack("<If", self._run_start(run), self._run_trackpoints(run)[1] * 3.0)
+                + struct.pack("<I16sb", 0, "", 0))
+
+    def _lap(self, lap):
+        run, n = divmod(lap, self.laps_per_run)
+        first, count = self._run_trackpoints(run)
+        lap_points = count // self.laps_per_run
+        start = self._run_start(run) + n * lap_points
+        return (struct.pack("<H2xIIffiiii", lap, start, lap_points * 100, lap_points * 3.0, 4.0,
+                    self._lat(0), self._lon(0), self._lat(lap_points), self._lon(lap_points))
+                + struct.pack("HBBBBB", lap_points // 10, 140, 170, 0, 0xFF, 0)
+                + struct.pack("BBBBB", 0, 0, 0, 0, 0))
+
+    def _trackpoints(self, run, first, count):
+        start = self._run_start(run) - self._run_trackpoints(run)[0]
+        points = [struct.pack("<I", count)]
+        for n in xrange(first, first + count):
+            points.append(struct.pack("<iiIffBBBx", self._lat(n), self._lon(n), start + n, 100.0, n * 3.0, 140, 0xFF, 0))
+        return "".join(points)
+
+    def _lat(self, n):
+        return 0x20000000 + n * 100
+
+    def _lon(self, n):
+        return -0x30000000 + n * 100
+
+
+def create_hardware(speed=1.0, drop_rate=0.0, burst_failure_rate=0.0, seed=None, noise=None, **watch_args):
+    """
+    Return an EmulatedStick, with a VirtualWatch in range.
+    watch_args are passed to VirtualWatch.
+    """
+    air = Air(Scheduler(speed), drop_rate, burst_failure_rate, seed=seed, noise=noise)
+    stick = EmulatedStick(air)
+    stick.watch = VirtualWatch(air, **watch_args)
+    stick.watch.start()
+    return stick
+
+def create_hardware_pool(sticks=1, watches=1, speed=1.0, drop_rate=0.0, burst_failure_rate=0.0, seed=None, noise=None,
+                         **watch_args):
+    """
+    Return a list of EmulatedSticks sharing the air
+    with the given number of VirtualWatches in range.
+    watch_args are passed to VirtualWatch.
+    """
+    air = Air(Scheduler(speed), drop_rate, burst_failure_rate, seed=seed, noise=noise)
+    result = [EmulatedStick(air, serial_number=0x12345678 + n) for n in range(0, sticks)]
+    for n in range(0, watches):
+        watch = VirtualWatch(air, serial_number=3860000001 + n, **watch_args)
+        watch.start()
+    return result
+
+
+# vim: ts=4 sts=4 et
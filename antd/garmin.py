@@ -40,6 +40,8 @@ import logging
 import struct
 import time
 import collections
+import os
+import glob
 
 import antd.ant as ant
 
@@ -178,6 +180,17 @@ def pack(pid, data_type=None):
     """
     return struct.pack("<HHHxx", pid, 0 if data_type is None else 2, data_type or 0)
 
+def pack_list(requests):
+    """
+    Pack (pid, data_type) requests into a single
+    message. Unlike pack() each request is unpadded,
+    so tokenize() can split them, only the message
+    is padded to 8-bytes.
+    """
+    msg = "".join(struct.pack("<HHH", pid, 2, data_type) if data_type is not None else struct.pack("<HH", pid, 0)
+                  for pid, data_type in requests)
+    return msg + "\x00" * (-len(msg) % 8)
+
 def unpack(msg):
     """
     Unpack a garmin device communication packet.
@@ -297,6 +310,129 @@ def extract_runs(protocols, get_runs_pkts):
     return runs
 
 
+class Checkpoint(object):
+    """
+    Packets of finished transfers, saved to a directory
+    so a download retried after a dropped link can skip
+    them. Checkpoints older than max_age seconds are
+    ignored, the device's data may have changed since.
+    Age alone does not tell a retry from a new download,
+    clear() before a download which is not a retry.
+    """
+
+    max_age = 3600
+
+    __header = struct.Struct("<HH")
+
+    def __init__(self, dir):
+        self.dir = dir
+        if not os.path.exists(dir): os.makedirs(dir)
+
+    def load(self, key):
+        """
+        Return the list of (pid, length, data) saved
+        for key, or None if there is no recent checkpoint.
+        """
+        path = self._path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.max_age: return None
+            with open(path, "rb") as file: data = file.read()
+        except (IOError, OSError):
+            return None
+        packets = []
+        offset = 0
+        while offset < len(data):
+            pid, length = self.__header.unpack_from(data, offset)
+            offset += self.__header.size
+            packets.append((pid, length, data[offset:offset + length]))
+            offset += length
+        return packets
+
+    def save(self, key, packets):
+        path = self._path(key)
+        with open(path + ".tmp", "wb") as file:
+            for pid, length, data in packets:
+                file.write(self.__header.pack(pid, length))
+                file.write(data)
+        # rename is atomic, a partial checkpoint is never loaded
+        os.rename(path + ".tmp", path)
+
+    def clear(self):
+        for path in glob.glob(os.path.join(self.dir, "*.pkts")):
+            os.unlink(path)
+
+    def _path(self, key):
+        return os.path.join(self.dir, key + ".pkts")
+
+
+class RawSink(object):
+    """
+    Writes packets to file as they are received, in the
+    format of dump(). file should be opened buffered, it is
+    flushed and fsync'd every sync_packets packets, so a
+    crash loses at most that many. 0 to sync only when
+    sync() is called.
+    """
+
+    __header = struct.Struct("<HH")
+
+    def __init__(self, file, sync_packets=0):
+        self.file = file
+        self.sync_packets = sync_packets
+        self.count = 0
+
+    def write(self, pid, length, data):
+        self.file.write(self.__header.pack(pid, length))
+        if data: self.file.write(data)
+        self.count += 1
+        if self.sync_packets and not self.count % self.sync_packets:
+            self.sync()
+
+    def write_packets(self, packets):
+        """
+        Write decoded (pid, length, data) packets.
+        """
+        for pid, length, data in packets:
+            self.write(pid, length, data.raw if data else None)
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+
+class DownloadHistory(object):
+    """
+    Runs already downloaded from a device, by start time,
+    with the index of each run's track. Saved to file, one
+    run per line, so later downloads transfer only new runs.
+    """
+
+    def __init__(self, file=None):
+        self.file = file
+        self.track_index_by_time = {}
+        try:
+            with open(file) as f:
+                for line in f:
+                    start_time, track_index = line.split()
+                    self.track_index_by_time[int(start_time)] = int(track_index)
+        except (IOError, TypeError, ValueError):
+            pass
+
+    def is_known(self, start_time):
+        return start_time in self.track_index_by_time
+
+    def add(self, runs):
+        """
+        Record the given (start_time, track_index) runs.
+        """
+        runs = [(t, i) for t, i in runs if not self.is_known(t)]
+        self.track_index_by_time.update(runs)
+        if self.file and runs:
+            with open(self.file, "a") as file:
+                for start_time, track_index in runs:
+                    file.write("%d %d\n" % (start_time, track_index))
+
+
 class Device(object):
     """
     Class represents a garmin gps device.
@@ -304,11 +440,19 @@ class Device(object):
     the specific protocols impelemnted by this
     device. They may raise DeviceNotSupportedError
     if the device does not implement a specific
-    operation.
+    operation. If checkpoint is provided, transfers
+    (runs, laps, tracks) completed by an earlier,
+    failed, attempt are loaded rather than downloaded.
+    If history is provided, get_runs returns only runs
+    not in history. If batch_acks is true, all packets
+    received in one read are ACK'd with a single write.
     """
     
-    def __init__(self, stream):
+    def __init__(self, stream, checkpoint=None, history=None, batch_acks=False):
         self.stream = stream
+        self.checkpoint = checkpoint
+        self.history = history
+        self.batch_acks = batch_acks
         self.init_device_api()
 
     def get_product_data(self):
@@ -317,12 +461,15 @@ class Device(object):
         """
         return self.execute(A000())[0]
 
-    def get_runs(self):
+    def get_runs(self, sink=None, decode=True):
         """
-        Get new runs from device.
+        Get new runs from device. With history, the
+        (start_time, track_index) of each new run is
+        saved to run_proto.new_runs. See execute() for
+        sink and decode.
         """
         if self.run_proto:
-            return self.execute(self.run_proto)
+            return self.execute(self.run_proto, sink, decode)
         else:
             raise DeviceNotSupportedError("Device does not support get_runs.")
 
@@ -398,30 +545,95 @@ class Device(object):
             except Exception:
                 _log.warning("Download may Fail. Failed to ceate protocol %s.", function_name, exc_info=True)
 
-    def execute(self, protocol):
+    def execute(self, protocol, sink=None, decode=True):
         """
         Execute the give garmin Applection protcol.
-        e.g. one of the Annn classes.
+        e.g. one of the Annn classes. If sink is provided,
+        raw packets are written to it as they are received.
+        If decode is False, transfers of protocols with
+        decode_optional are not kept, their PacketList
+        in the result is empty.
         """
         result = []
         for next in protocol.execute():
             if hasattr(next, "execute"):
-                result.extend(self.execute(next))
+                result.extend(self.execute(next, sink, decode))
+            elif isinstance(next, PacketList):
+                # packets held back by protocol, see Protocol.hold_raw
+                if sink: sink.write_packets(next)
             else:
                 pid, data = next
+                key = "%s-%d-%d" % (protocol.__class__.__name__, pid, data or 0)
+                save = self.checkpoint and protocol.checkpoint
+                keep = decode or not protocol.decode_optional
+                out = sink if not protocol.hold_raw else None
+                raw_packets = self.checkpoint.load(key) if save else None
+                if raw_packets is not None:
+                    _log.info("%s: Loaded %d packet(s) from checkpoint.", protocol.__class__.__name__, len(raw_packets))
+                    packets = ((pid, length, data, protocol.decode_packet(pid, length, data))
+                               for pid, length, data in raw_packets)
+                    save = False
+                else:
+                    packets = self._transfer(protocol, pid, data)
+                raw_packets = []
                 in_packets = []
-                self.stream.write(pack(pid, data))
-                while True:
-                    pkt = self.stream.read()
-                    if not pkt: break
-                    for pid, length, data in tokenize(pkt):
-                        in_packets.append((pid, length, protocol.decode_packet(pid, length, data)))
-                        self.stream.write(pack(P000.PID_ACK, pid))
+                for pid, length, data, decoded in packets:
+                    if out: out.write(pid, length, data)
+                    if save: raw_packets.append((pid, length, data))
+                    if keep: in_packets.append((pid, length, decoded))
+                if save: self.checkpoint.save(key, raw_packets)
+                if out: out.write(0, 0, None)
                 in_packets.append((0, 0, None))
                 result.append(protocol.decode_list(in_packets))
 
         return protocol.decode_result(result)
 
+    def _transfer(self, protocol, pid, data):
+        """
+        Send the given command, generate the (pid, length,
+        data, decoded_data) received in reply. Each packet
+        is ACK'd once the caller is done with it, or with
+        batch_acks, once the caller is done with every
+        packet of the read which returned them.
+        """
+        aborted = False
+        self.stream.write(pack(pid, data))
+        while True:
+            try:
+                pkt = self.stream.read()
+            except ant.AntTimeoutError:
+                if not aborted: raise
+                # not every device replies to an abort
+                _log.debug("No reply after abort, assuming transfer complete.")
+                break
+            if not pkt: break
+            replies = []
+            abort = False
+            for pid, length, data in tokenize(pkt):
+                if not aborted:
+                    decoded = protocol.decode_packet(pid, length, data)
+                    if protocol.abort_transfer(pid, decoded):
+                        _log.info("%s: Aborting download, remaining records already downloaded.",
+                                protocol.__class__.__name__)
+                        aborted = abort = True
+                    else:
+                        yield pid, length, data, decoded
+                elif not abort:
+                    # records sent before the device saw the abort, they
+                    # are not ACK'd, an ACK would ask for more records.
+                    continue
+                if self.batch_acks:
+                    replies.append((P000.PID_ACK, pid))
+                else:
+                    self.stream.write(pack(P000.PID_ACK, pid))
+            if abort:
+                # every packet of the read is ACK'd before the abort
+                replies.append((self.link_proto.PID_COMMAND_DATA, self.cmd_proto.CMND_ABORT_TRANSFER))
+            if self.batch_acks and replies:
+                self.stream.write(pack_list(replies))
+            else:
+                for pid, data in replies: self.stream.write(pack(pid, data))
+
 
 class MockHost(object):
     """
@@ -463,6 +675,14 @@ class Protocol(object):
     a specific function.
     """
 
+    # transfers are saved to Device.checkpoint
+    checkpoint = False
+    # transfers are not written to sink as received, the
+    # protocol yields the PacketLists to write instead
+    hold_raw = False
+    # transfers may be dropped from result, Device.execute(decode=False)
+    decode_optional = False
+
     def __init__(self, protocols):
         self.link_proto = protocols.link_proto
         self.cmd_proto = protocols.cmd_proto
@@ -487,6 +707,13 @@ class Protocol(object):
             data_cls = self.data_type_by_pid.get(pid, DataType)
             return data_cls(data)
 
+    def abort_transfer(self, pid, data):
+        """
+        True to stop the current transfer before
+        the given packet, remaining records are not needed.
+        """
+        return False
+
     def decode_list(self, pkts):
         return PacketList(pkts)
 
@@ -499,7 +726,10 @@ class DownloadProtocol(Protocol):
     Can be extended/ehnanced for GUI use.
     """
 
+    checkpoint = True
     pid_data = []
+    # result of most recent transfer
+    packets = None
 
     def decode_packet(self, pid, length, data):
         data = super(DownloadProtocol, self).decode_packet(pid, length, data)
@@ -518,6 +748,10 @@ class DownloadProtocol(Protocol):
             return data
             
 
+    def decode_list(self, pkts):
+        self.packets = super(DownloadProtocol, self).decode_list(pkts)
+        return self.packets
+
     def on_start(self, pid, data):
         _log.info("%s: Starting download. %d record(s)", self.__class__.__name__, data.count)
         self.expected = data.count
@@ -562,7 +796,9 @@ class DeleteRuns(Protocol):
 
 class A1000(DownloadProtocol):
     """
-    Get runs.
+    Get runs. Runs in history, if any, are removed from
+    the result, and the track transfer is aborted once
+    only their tracks remain.
     """
 
     def __init__(self, protocols, run_type):
@@ -571,6 +807,9 @@ class A1000(DownloadProtocol):
             raise DeviceNotSupportedError("A1000 required device to supoprt lap and track protocols.")
         self.lap_proto = protocols.lap_proto
         self.trk_proto = protocols.trk_proto
+        self.history = protocols.history
+        # known runs are dropped before runs and laps are written
+        self.hold_raw = self.lap_proto.hold_raw = bool(self.history)
         self.data_type_by_pid.update({
             self.link_proto.PID_RUN: run_type,
         })
@@ -580,8 +819,49 @@ class A1000(DownloadProtocol):
         _log.debug("A1000: executing transfer runs")
         yield (self.link_proto.PID_COMMAND_DATA, self.cmd_proto.CMND_TRANSFER_RUNS)
         yield self.lap_proto
+        if self.history:
+            self._find_new_runs()
+            self.trk_proto.wanted_tracks = set(track_index for start_time, track_index in self.new_runs)
+            yield self.new_run_list
+            yield self.lap_proto.packets
+        else:
+            self.new_runs = None
+            self.trk_proto.wanted_tracks = None
         yield self.trk_proto
 
+    def decode_result(self, list):
+        if not self.history: return list
+        runs, laps, trks = list
+        return [self.new_run_list, laps, trks]
+
+    def _find_new_runs(self):
+        """
+        Set new_runs, the (start_time, track_index) of
+        each run not in history, and new_run_list, the
+        runs transfer with only those runs.
+        """
+        laps = [lap.data for lap in self.lap_proto.packets.by_pid[self.link_proto.PID_LAP]]
+        self.new_runs = []
+        new_run_pkts = []
+        run_pkts = self.packets.by_pid[self.link_proto.PID_RUN]
+        for pkt in run_pkts:
+            # run start time is start of its first lap, as in extract_runs()
+            run_laps = [l for l in laps if pkt.data.first_lap_index <= l.index <= pkt.data.last_lap_index]
+            if not run_laps:
+                # can not be told apart from runs already downloaded,
+                # and extract_runs() needs at least one lap.
+                _log.warning("A1000: Skipping run without laps. track_index=%d", pkt.data.track_index)
+                continue
+            start_time = run_laps[0].start_time.time
+            if not self.history.is_known(start_time):
+                self.new_runs.append((start_time, pkt.data.track_index))
+                new_run_pkts.append(pkt)
+        _log.info("A1000: %d of %d run(s) are new.", len(self.new_runs), len(run_pkts))
+        # keep record count consistent, so replay of raw file does not warn
+        self.new_run_list = PacketList(
+                [(self.link_proto.PID_RECORDS, 2, RecordsType(struct.pack("<H", len(new_run_pkts))))]
+                + new_run_pkts + self.packets.by_pid[self.link_proto.PID_XFER_CMPLT] + [(0, 0, None)])
+
 
 class A301(DownloadProtocol):
     """
@@ -601,10 +881,26 @@ class A301(DownloadProtocol):
             self.link_proto.PID_TRK_DATA_ARRAY,
         ]
 
+    decode_optional = True
+    # indexes of tracks to download, None for all. the
+    # transfer is aborted once only other tracks remain.
+    wanted_tracks = None
+
     def execute(self):
         _log.debug("A301: executing transfer tracks")
+        self.remaining_tracks = set(self.wanted_tracks or ())
         yield (self.link_proto.PID_COMMAND_DATA, self.cmd_proto.CMND_TRANSFER_TRK)
 
+    def abort_transfer(self, pid, data):
+        """
+        Tracks follow their header, abort on the header of an
+        unwanted track, if every wanted track has been received.
+        """
+        if self.wanted_tracks is None or pid != self.link_proto.PID_TRK_HDR: return False
+        index = getattr(data, "index", None)
+        self.remaining_tracks.discard(index)
+        return index not in self.wanted_tracks and not self.remaining_tracks
+
     def on_data(self, pid, data):
         """
         PID_TRK_DATA_ARRAY return multiple data objects per
@@ -30,9 +30,17 @@
 import usb.core
 import usb.util
 import errno
-import logging
 import struct
 import array
+import logging
+import threading
+import collections
+import itertools
+import os
+import time
+import binascii
+
+from antd.ant import is_timeout, validate_checksum, PipeEvent, MAX_MSG_LENGTH
 
 _log = logging.getLogger("antd.usb")
 
@@ -51,6 +59,7 @@ class UsbHardware(object):
                 usb.util.claim_interface(dev, 0)
                 self.dev = dev
                 self.ep = ep
+                self.max_write_size = self._get_max_packet_size(ep | usb.util.ENDPOINT_OUT)
                 break
             except IOError as (err, msg):
                 if err == errno.EBUSY or "Device or resource busy" in msg: #libusb10 or libusb01
@@ -63,6 +72,19 @@ class UsbHardware(object):
     def close(self):
         usb.util.release_interface(self.dev, 0)
 
+    def _get_max_packet_size(self, address, default=64):
+        """
+        Return wMaxPacketSize of the given endpoint,
+        the limit for the size of a single write.
+        """
+        try:
+            intf = self.dev.get_active_configuration()[(0, 0)]
+            ep = usb.util.find_descriptor(intf, bEndpointAddress=address)
+            return ep.wMaxPacketSize if ep else default
+        except (usb.core.USBError, IndexError, KeyError):
+            _log.warning("Failed to read wMaxPacketSize, assuming %d.", default, exc_info=True)
+            return default
+
     def write(self, data, timeout):
         transfered = self.dev.write(self.ep | usb.util.ENDPOINT_OUT, data, timeout=timeout)
         if transfered != len(data):
@@ -74,32 +96,390 @@ class UsbHardware(object):
 
 class NoUsbHardwareFound(IOError): pass
 
+class ReadAheadHardware(object):
+    """
+    Wraps hardware with a reader thread which keeps a
+    bulk-IN read outstanding at all times, independent
+    of how quickly the session consumes input. Reads
+    are queued in a bounded ring, read() drains all
+    queued data at once. If the consumer falls behind
+    the oldest data is dropped and counted in overflows.
+    pyusb exposes no async transfer API, and concurrent
+    synchronous reads would complete out of order, so
+    a single reader re-submits as soon as a read returns.
+    """
+
+    # ms, how long reader blocks in hardware before checking for close
+    reader_timeout = 1000
+
+    def __init__(self, hardware, max_queued=256):
+        self.hardware = hardware
+        self.max_write_size = getattr(hardware, "max_write_size", 64)
+        self.overflows = 0
+        self.error = None
+        # deque append/popleft are atomic, no lock required
+        self._ring = collections.deque(maxlen=max_queued)
+        self._ready = PipeEvent()
+        self.running = True
+        self.thread = threading.Thread(target=self._read_loop, name="ReadAhead")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.running = False
+        self.thread.join(self.reader_timeout / 1000. + 1)
+        self.hardware.close()
+        self._ready.close()
+
+    def write(self, data, timeout):
+        self.hardware.write(data, timeout)
+
+    def read(self, timeout):
+        deadline = time.time() + timeout / 1000.
+        while not self._ring and self.error is None:
+            if not self._ready.wait(deadline - time.time()): break
+        chunks = []
+        try:
+            while True: chunks.append(self._ring.popleft())
+        except IndexError:
+            pass
+        if not chunks:
+            if self.error is not None: raise self.error
+            raise IOError(errno.ETIMEDOUT, "Timeout")
+        elif len(chunks) == 1:
+            return chunks[0]
+        else:
+            data = bytearray()
+            for chunk in chunks: data += buffer(chunk)
+            return data
+
+    def _read_loop(self):
+        while self.running:
+            try:
+                data = self.hardware.read(self.reader_timeout)
+            except IOError as e:
+                if is_timeout(e): continue
+                _log.error("Read ahead failed, error will be raised to reader.", exc_info=True)
+                self.error = e
+                self._ready.set()
+                return
+            if len(self._ring) == self._ring.maxlen:
+                self.overflows += 1
+                _log.warning("Read ahead buffer full, dropping oldest data. overflows=%d", self.overflows)
+            self._ring.append(data)
+            self._ready.set()
+
+CAPTURE_MAGIC = "ANTCAP\x01\n"
+CAPTURE_IN = "I"
+CAPTURE_OUT = "O"
+# usec since start of capture, direction, length
+_CAPTURE_RECORD = struct.Struct("<QcH")
+
+def read_capture(file):
+    """
+    Generator of (usec, direction, data) tuples
+    read from a capture written by RecordingHardware.
+    """
+    if file.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+        raise IOError(errno.EINVAL, "Not an ANT capture file. %s" % getattr(file, "name", file))
+    while True:
+        header = file.read(_CAPTURE_RECORD.size)
+        if not header: return
+        usec, direction, length = _CAPTURE_RECORD.unpack(header)
+        data = file.read(length)
+        if len(data) != length:
+            _log.warning("Capture file truncated, ignoring last record.")
+            return
+        yield usec, direction, data
+
+class RecordingHardware(object):
+    """
+    Wraps hardware and records all data read (IN) or
+    written (OUT) with a timestamp to a capture file,
+    which can be served back by ReplayHardware.
+    """
+
+    def __init__(self, hardware, path):
+        self.hardware = hardware
+        self.max_write_size = getattr(hardware, "max_write_size", 64)
+        self._file = open(path, "wb")
+        self._file.write(CAPTURE_MAGIC)
+        self._lock = threading.Lock()
+        self._start = time.time()
+
+    def close(self):
+        try:
+            self.hardware.close()
+        finally:
+            with self._lock:
+                self._file.close()
+
+    def write(self, data, timeout):
+        # record before writing, a reply can be read (and
+        # recorded) as soon as the command reaches the device.
+        with self._lock:
+            self._record(CAPTURE_OUT, data)
+            self.hardware.write(data, timeout)
+
+    def read(self, timeout):
+        data = self.hardware.read(timeout)
+        with self._lock:
+            self._record(CAPTURE_IN, data)
+        return data
+
+    def _record(self, direction, data):
+        data = str(bytearray(data))
+        usec = int((time.time() - self._start) * 1000000)
+        self._file.write(_CAPTURE_RECORD.pack(usec, direction, len(data)))
+        self._file.write(data)
+
+class TracingHardware(object):
+    """
+    Wraps hardware and keeps the most recent reads and
+    writes in a fixed size in-memory ring. Recording is
+    a timestamp and a reference to the data, nothing
+    is formatted or written until dump_trace(), which
+    saves the ring in capture format (see read_capture).
+    """
+
+    def __init__(self, hardware, size=4096, path=None):
+        self.hardware = hardware
+        self.max_write_size = getattr(hardware, "max_write_size", 64)
+        self.path = path
+        self._records = [None] * size
+        self._count = itertools.count()
+
+    def close(self):
+        self.hardware.close()
+
+    def write(self, data, timeout):
+        self._record(CAPTURE_OUT, data)
+        self.hardware.write(data, timeout)
+
+    def read(self, timeout):
+        data = self.hardware.read(timeout)
+        self._record(CAPTURE_IN, data)
+        return data
+
+    def _record(self, direction, data):
+        seq = next(self._count)
+        self._records[seq % len(self._records)] = (seq, time.time(), direction, data)
+
+    def records(self):
+        """
+        Return the traced (time, direction, data), oldest first.
+        """
+        return [r[1:] for r in sorted(r for r in list(self._records) if r)]
+
+    def dump_trace(self, path=None):
+        """
+        Write the ring to path (default self.path, strftime()
+        patterns are expanded). Returns the file written.
+        """
+        path = time.strftime(os.path.expanduser(path or self.path))
+        records = self.records()
+        with open(path, "wb") as file:
+            file.write(CAPTURE_MAGIC)
+            # wall clock may step, keep timestamps monotonic
+            start = last = records[0][0] if records else 0
+            for t, direction, data in records:
+                last = max(t, last)
+                data = str(bytearray(data))
+                file.write(_CAPTURE_RECORD.pack(int((last - start) * 1000000), direction, len(data)))
+                file.write(data)
+        _log.info("Wrote %d traced record(s) to %s.", len(records), path)
+        return path
+
+class ReplayHardware(object):
+    """
+    Serves data from a capture file. Input which was
+    recorded after a write is not returned until the
+    session makes the corresponding write, so commands
+    and replies stay in step. With realtime=True input
+    is delayed to match recorded timing, otherwise it
+    is returned as fast as the session reads. Writes
+    which differ from the recording are counted in
+    mismatches, but do not stop the replay: a repeated
+    write is ignored, and a write found later in the
+    capture skips the replay ahead to it.
+    """
+
+    max_write_size = 64
+    # records searched ahead for a write which differs from capture
+    resync_window = 64
+
+    def __init__(self, path, realtime=False):
+        with open(path, "rb") as file:
+            self.records = list(read_capture(file))
+        self.realtime = realtime
+        self.mismatches = 0
+        self._index = 0
+        self._last_write = None
+        self._written = collections.deque()
+        self._ready = PipeEvent()
+        self._lock = threading.Lock()
+        self._last_usec = 0
+        self._last_time = time.time()
+
+    def close(self):
+        self._ready.close()
+
+    @property
+    def remaining(self):
+        """
+        Number of records not yet replayed.
+        """
+        return len(self.records) - self._index
+
+    @property
+    def done(self):
+        return not self.remaining
+
+    def write(self, data, timeout):
+        self._written.append(str(data))
+        self._ready.set()
+
+    def read(self, timeout):
+        deadline = time.time() + timeout / 1000.
+        while True:
+            with self._lock:
+                self._match_writes()
+                if not self.done and self.records[self._index][1] == CAPTURE_IN:
+                    usec, direction, data = self.records[self._index]
+                    if not self._wait_until(usec, deadline): break
+                    self._advance(usec)
+                    return array.array("B", data)
+            if not self._ready.wait(deadline - time.time()): break
+        raise IOError(errno.ETIMEDOUT, "Timeout")
+
+    def _match_writes(self):
+        while self._written and not self.done and self.records[self._index][1] == CAPTURE_OUT:
+            usec, direction, expected = self.records[self._index]
+            data = self._written.popleft()
+            if data == expected:
+                self._advance(usec)
+                self._last_write = data
+            elif data == self._last_write:
+                # retry of a write already replayed, e.g. after
+                # a read timeout which did not happen in capture.
+                _log.warning("Replay write repeated, ignoring. %s", binascii.hexlify(data))
+                self.mismatches += 1
+            else:
+                self.mismatches += 1
+                index = self._find_write(data)
+                if index is None:
+                    _log.warning("Replay write differs from capture. expected=%s actual=%s",
+                            binascii.hexlify(expected), binascii.hexlify(data))
+                    self._advance(usec)
+                else:
+                    # capture has writes the session did not make,
+                    # skip them and their replies.
+                    _log.warning("Replay write found %d record(s) ahead in capture, resyncing. %s",
+                            index - self._index, binascii.hexlify(data))
+                    self._index = index
+                    self._advance(self.records[index][0])
+                self._last_write = data
+
+    def _find_write(self, data):
+        """
+        Index of the first write of data among the next
+        resync_window records, None if not found.
+        """
+        end = min(len(self.records), self._index + self.resync_window)
+        for index in xrange(self._index + 1, end):
+            usec, direction, recorded = self.records[index]
+            if direction == CAPTURE_OUT and recorded == data:
+                return index
+
+    def _wait_until(self, usec, deadline):
+        """
+        In realtime mode, sleep until recorded delay since
+        the previous record has elapsed. False if it would
+        not elapse before deadline.
+        """
+        if self.realtime:
+            ready = self._last_time + (usec - self._last_usec) / 1000000.
+            if ready > deadline:
+                time.sleep(max(0, deadline - time.time()))
+                return False
+            time.sleep(max(0, ready - time.time()))
+        return True
+
+    def _advance(self, usec):
+        self._index += 1
+        self._last_usec = usec
+        self._last_time = time.time()
+
 class SerialHardware(object):
+    """
+    Provides access to serial (nRF24AP1 + FTDI) ANT chips.
+    Input is read in large chunks, and only complete frames
+    with valid checksum are returned. Corrupt or misaligned
+    input is skipped to the next sync byte, so a stick
+    which loses sync can recover without a reset.
+    """
+
+    max_write_size = 64
+    # largest single read from the serial port
+    max_read_size = 4096
+    # port timeout is fixed, changing it reconfigures the port.
+    # read() polls in steps of this many seconds until its deadline.
+    poll_interval = .05
 
     def __init__(self, dev="/dev/ttyUSB0", baudrate=115200):
         import serial
-        self.dev = serial.Serial(port=dev, baudrate=baudrate, timeout=1)
+        self.dev = serial.Serial(port=dev, baudrate=baudrate, timeout=self.poll_interval)
+        self._buf = bytearray()
 
     def close(self):
         self.dev.close()
 
     def write(self, data, timeout):
-        arr = array.array("B", data)
-        self.dev.write(arr.tostring())
+        self.dev.write(data)
 
     def read(self, timeout):
-        # attempt to read the start of packet
-        header = self.dev.read(2)
-        if header:
-            sync, length = struct.unpack("2B", header)
-            if sync not in (0xa4, 0xa5):
-                raise IOError(-1, "ANT packet did not start with expected SYNC packet. Remove USB device and try again?")
-            length += 2 # checksum & msg_id
-            data = self.dev.read(length)
-            if len(data) != length:
-                raise IOError(-1, "ANT packet short?")
-            return array.array("B", header + data)
-        else:
-            raise IOError(errno.ETIMEDOUT, "Timeout")
+        deadline = time.time() + timeout / 1000.
+        while True:
+            # block for first byte, then take anything else already buffered by driver
+            data = self.dev.read(1)
+            if data:
+                self._buf += data
+                waiting = self.dev.inWaiting()
+                if waiting: self._buf += self.dev.read(min(waiting, self.max_read_size))
+                frames = self._take_frames()
+                if frames: return frames
+            if time.time() >= deadline:
+                raise IOError(errno.ETIMEDOUT, "Timeout")
+
+    def _take_frames(self):
+        """
+        Remove and return all complete, valid frames at the
+        start of buffer. Bytes which are not the start of a
+        valid frame are discarded.
+        """
+        buf = self._buf
+        frames = bytearray()
+        offset = 0
+        end = len(buf)
+        while offset < end:
+            if buf[offset] not in (0xa4, 0xa5):
+                offset += 1
+                continue
+            if offset + 2 > end: break
+            if buf[offset + 1] > MAX_MSG_LENGTH:
+                _log.warning("Discarding serial input with invalid length, resyncing.")
+                offset += 1
+                continue
+            length = buf[offset + 1] + 4
+            if offset + length > end: break
+            frame = buf[offset:offset + length]
+            if validate_checksum(frame):
+                frames += frame
+                offset += length
+            else:
+                _log.warning("Discarding corrupt serial input, resyncing. %s", binascii.hexlify(frame))
+                offset += 1
+        del buf[:offset]
+        return str(frames)
 
 # vim: ts=4 sts=4 et
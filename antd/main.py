@@ -71,51 +71,119 @@ def downloader():
         antd.cfg.create_notification_plugin()
     )
     
-    # create an ANTFS host from configuration
-    host = antd.cfg.create_antfs_host()
+    # create an ANTFS host for each ANT stick from configuration,
+    # each stick downloads from a different device in parallel.
+    hosts = antd.cfg.create_antfs_hosts()
+    dispatcher = antd.Dispatcher(hosts)
+
+    def download(host):
+        # in daemon mode, devices in range are tracked in the background,
+        # and we search only for a device known to be ready for download.
+        # we do not attempt to pair with unkown devices (it requires gps
+        # watch to wake up and would drain battery of any un-paired devices
+        # in range.)
+        scanner = antd.Scanner(host) if args.daemon else None
+        claim = lambda device_number: dispatcher.claim(host, device_number)
+        def stop_scanner():
+            # an unexpected scanner error must not end this host's thread,
+            # scanning is restarted on the next attempt.
+            try: scanner.stop()
+            except antd.AntError: raise
+            except Exception: _log.warning("Scanner failed, will retry.", exc_info=True)
+        try:
+            failed_count = 0
+            # device whose download failed, and may be resumed from checkpoint
+            resume_device_id = None
+            while dispatcher.running and failed_count <= antd.cfg.get_retry():
+                try:
+                    if scanner:
+                        scanner.start()
+                        _log.info("Scanning for ANT devices.")
+                        target = scanner.wait_for(lambda d: d.paired and d.device_state == antd.Beacon.STATE_LINK
+                                                  and (d.data_available or args.force)
+                                                  and claim(d.device_number), timeout=60)
+                        stop_scanner()
+                        if not target: continue
+                        _log.info("Found device with data. device_id=0x%08x", target.device_id)
+                        # open the channel on the scanned device, rather than searching again
+                        beacon = host.search(device_id=target.device_id, include_devices_with_no_data=args.force,
+                                             claim=claim, device_number=target.device_number)
+                    else:
+                        _log.info("Searching for ANT devices.")
+                        beacon = host.search(include_unpaired_devices=True,
+                                             include_devices_with_no_data=True, claim=claim)
+                    if beacon and (beacon.data_available or args.force):
+                        _log.info("Device has data. Linking.")
+                        host.link()
+                        _log.info("Pairing with device.")
+                        client_id = host.auth(pair=not args.daemon)
+                        raw_name = time.strftime("%Y%m%d-%H%M%S.raw")
+                        raw_full_path = antd.cfg.get_path("antd", "raw_output_dir", raw_name, 
+                                                          {"device_id": hex(host.device_id)})
+                        # transfers completed before a failed attempt are not repeated,
+                        # a checkpoint of an earlier download may not match the device.
+                        checkpoint = antd.cfg.create_checkpoint(host.device_id)
+                        if checkpoint and resume_device_id != host.device_id: checkpoint.clear()
+                        resume_device_id = host.device_id
+                        # only runs not downloaded before are transfered
+                        history = antd.cfg.create_download_history(host.device_id)
+                        with open(raw_full_path, "wb", 1 << 16) as file:
+                            _log.info("Saving raw data to %s.", file.name)
+                            # create a garmin device, and initialize its
+                            # ant initialize its capabilities.
+                            dev = antd.Device(host, checkpoint, history, antd.cfg.get_batch_acks())
+                            antd.garmin.dump(file, dev.get_product_data())
+                            # download runs, written to file as received,
+                            # tracks are not kept in memory.
+                            sink = antd.garmin.RawSink(file, antd.cfg.get_raw_sync())
+                            dev.get_runs(sink, decode=False)
+                            sink.sync()
+                            if checkpoint: checkpoint.clear()
+                            if antd.cfg.get_delete_from_device(): dev.delete_runs()
+                        _log.info("Closing session.")
+                        host.disconnect()
+                        if history and not dev.run_proto.new_runs:
+                            _log.info("No new runs.")
+                            os.unlink(raw_full_path)
+                        else:
+                            _log.info("Excuting plugins.")
+                            # dispatcher data to plugins, runs are only recorded as
+                            # downloaded once every plugin has processed them.
+                            if antd.plugin.publish_data(host.device_id, "raw", [raw_full_path]):
+                                if history: history.add(dev.run_proto.new_runs)
+                            elif history:
+                                _log.warning("Plugin failed, runs will be downloaded again.")
+                    elif not args.daemon and beacon:
+                        _log.info("Found device, but no data available for download.")
+                    elif not args.daemon:
+                        _log.info("No device found.")
+                    if not args.daemon: break
+                    failed_count = 0
+                    resume_device_id = None
+                except antd.AntError:
+                    # host was closed on ctrl-c
+                    if not dispatcher.running: break
+                    _log.warning("Caught error while communicating with device, will retry.", exc_info=True) 
+                    host.ant_session.dump_trace()
+                    failed_count += 1
+                finally:
+                    dispatcher.release(host)
+        finally:
+            if scanner:
+                try: scanner.stop()
+                except Exception: _log.warning("Scanner failed.", exc_info=True)
+            # on ctrl-c the dispatcher closes the host
+            if dispatcher.running:
+                try: host.close()
+                except Exception: _log.warning("Failed to cleanup resources on exist.", exc_info=True)
+
     try:
-        failed_count = 0
-        while failed_count <= antd.cfg.get_retry():
-            try:
-                _log.info("Searching for ANT devices.")
-                # in daemon mode we do not attempt to pair with unkown devices
-                # (it requires gps watch to wake up and would drain battery of
-                # any un-paired devices in range.)
-                beacon = host.search(include_unpaired_devices=not args.daemon,
-                                     include_devices_with_no_data=args.force or not args.daemon)
-                if beacon and (beacon.data_available or args.force):
-                    _log.info("Device has data. Linking.")
-                    host.link()
-                    _log.info("Pairing with device.")
-                    client_id = host.auth(pair=not args.daemon)
-                    raw_name = time.strftime("%Y%m%d-%H%M%S.raw")
-                    raw_full_path = antd.cfg.get_path("antd", "raw_output_dir", raw_name, 
-                                                      {"device_id": hex(host.device_id)})
-                    with open(raw_full_path, "w") as file:
-                        _log.info("Saving raw data to %s.", file.name)
-                        # create a garmin device, and initialize its
-                        # ant initialize its capabilities.
-                        dev = antd.Device(host)
-                        antd.garmin.dump(file, dev.get_product_data())
-                        # download runs
-                        runs = dev.get_runs()
-                        antd.garmin.dump(file, runs)
-                        if antd.cfg.get_delete_from_device(): dev.delete_runs()
-                    _log.info("Closing session.")
-                    host.disconnect()
-                    _log.info("Excuting plugins.")
-                    # dispatcher data to plugins
-                    antd.plugin.publish_data(host.device_id, "raw", [raw_full_path])
-                elif not args.daemon:
-                    _log.info("Found device, but no data available for download.")
-                if not args.daemon: break
-                failed_count = 0
-            except antd.AntError:
-                _log.warning("Caught error while communicating with device, will retry.", exc_info=True) 
-                failed_count += 1
+        dispatcher.run(download)
     finally:
-        try: host.close()
-        except Exception: _log.warning("Failed to cleanup resources on exist.", exc_info=True)
+        # hosts on channels of one stick share a session
+        for session in set(host.ant_session for host in hosts if host.channel_number is not None):
+            try: session.close()
+            except Exception: _log.warning("Failed to cleanup resources on exist.", exc_info=True)
     
     
 # vim: ts=4 sts=4 et
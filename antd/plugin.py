@@ -29,9 +29,16 @@
 
 import logging
 import os
+import threading
 
 _log = logging.getLogger("antd.plugin")
 _plugins = []
+# hosts of each ANT stick publish from their own thread,
+# reentrant since plugins publish the data they produce.
+_lock = threading.RLock()
+# files a plugin failed to process, including files
+# published by another plugin (e.g. tcx from raw)
+_failures = [0]
 
 class Plugin(object):
     """
@@ -108,6 +115,18 @@ def recover_and_publish_data(plugin):
             q.save_queue()
     
 def publish_data(device_sn, format, files):
+    """
+    Pass files to every plugin, files a plugin fails
+    to process are queued for it and retried later.
+    Returns true if every plugin processed every file,
+    and every file the plugins published in turn.
+    """
+    with _lock:
+        failures = _failures[0]
+        _publish_data(device_sn, format, files)
+        return _failures[0] == failures
+
+def _publish_data(device_sn, format, files):
     for plugin in _plugins:
         try:
             processed = plugin.data_available(device_sn, format, files)
@@ -121,6 +140,7 @@ def publish_data(device_sn, format, files):
             q.load_queue()
             q.add_to_queue(device_sn, format, not_processed)
             q.save_queue()
+        _failures[0] += len(not_processed)
 
 
 # vim: ts=4 sts=4 et
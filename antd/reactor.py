@@ -0,0 +1,323 @@
+# Copyright (c) 2012, Braiden Kindt.
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 
+#   1. Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+# 
+#   2. Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDER AND CONTRIBUTORS
+# ''AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY
+# WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Single threaded, non-blocking front end for ANT sessions.
+An EventLoop services the hardware of any number of
+AsyncSessions from one thread, rather than one thread per
+Session. Methods of AsyncChannel return a CommandFuture
+immediately, callers either register a callback with
+add_done_callback() or block on result() from another
+thread. Callbacks run on the loop thread and must not
+call blocking methods (e.g. Session.reset_system()).
+Only the session and channel layer is asynchronous,
+antfs.Host and garmin.Device are written as blocking
+protocols and still need a Session (and thread) each.
+"""
+
+import threading
+import collections
+import itertools
+import logging
+import heapq
+import time
+
+import antd.ant as ant
+
+_log = logging.getLogger("antd.reactor")
+
+
+def reply_data(reply):
+    return reply.data
+
+
+class EventLoop(object):
+    """
+    Services the hardware of many sessions from
+    a single thread. Hardware reads are blocking,
+    and there is no descriptor to select() on, so
+    each session's device is polled in turn with a
+    short read. poll_timeout (ms) is shared by all
+    sessions, a turn of the loop waits about that
+    long no matter how many sessions there are, and
+    doesn't wait at all after a turn which found work.
+    """
+
+    def __init__(self, poll_timeout=10):
+        self.poll_timeout = poll_timeout
+        self.sessions = []
+        self.running = False
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Start the loop thread, if not running.
+        """
+        if not self.running:
+            self.running = True
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        self.running = False
+        # thread is unset if start() was never called
+        if hasattr(self, "thread"):
+            self.thread.join(1)
+
+    def add(self, session):
+        with self._lock:
+            self.sessions.append(session)
+        self.start()
+
+    def remove(self, session):
+        with self._lock:
+            if session in self.sessions:
+                self.sessions.remove(session)
+
+    def run(self):
+        busy = False
+        while self.running:
+            with self._lock:
+                sessions = list(self.sessions)
+            if not sessions:
+                time.sleep(self.poll_timeout / 1000.)
+                continue
+            # 1ms is the shortest read, a timeout of 0 means
+            # wait forever to some usb backends.
+            timeout = 1 if busy else max(1, self.poll_timeout // len(sessions))
+            busy = False
+            for session in sessions:
+                busy = self.poll(session, timeout) or busy
+
+    def poll(self, session, timeout=None):
+        """
+        Read and dispatch pending messages for session,
+        waiting at most timeout ms (default poll_timeout).
+        Returns true if messages were read, or a burst
+        is still being written.
+        """
+        try:
+            # while a burst is being sent, don't wait for input
+            # between writes, but still read replies promptly.
+            if session._write_bursts(): timeout = 1
+            cmds = session.core.read(timeout or self.poll_timeout)
+            for cmd in cmds or []:
+                session._handle_message(cmd)
+            session._handle_idle()
+            return bool(cmds) or bool(session._bursts)
+        except Exception:
+            _log.error("Caught Exception handling message, session closing.", exc_info=True)
+            self.remove(session)
+            session._shutdown()
+            return False
+
+
+class AsyncChannel(ant.Channel):
+    """
+    Channel whose methods return a CommandFuture.
+    For reads the future's result is the data received.
+    """
+
+    def on_broadcast(self, callback):
+        """
+        Call callback(data) on the loop thread for
+        every broadcast received on this channel.
+        """
+        self._session._broadcast_callbacks[self.channel_number].append(callback)
+
+    def remove_broadcast_callback(self, callback):
+        self._session._broadcast_callbacks[self.channel_number].remove(callback)
+
+    def _execute(self, cmd, timeout=1, retry=0, data=False):
+        return self._session.submit(cmd, timeout, retry, transform=reply_data if data else None)
+
+
+class AsyncNetwork(ant.Network):
+
+    def _execute(self, cmd):
+        return self._session.submit(cmd)
+
+
+class AsyncSession(ant.Session):
+    """
+    Session serviced by an EventLoop. submit() never
+    blocks, commands for a busy channel (or network)
+    are queued and sent when the channel's command
+    completes. Retries are started by the loop thread,
+    once their backoff has elapsed, ahead of queued
+    commands. Burst packets are written by the loop
+    thread between reads, a few at a time.
+    Session level methods (reset_system, close, get_*)
+    still block, and must not be called from the loop.
+    """
+
+    channel_class = AsyncChannel
+    network_class = AsyncNetwork
+    # writes of each burst's packets per poll of device
+    burst_writes_per_poll = 4
+
+    def __init__(self, core, event_loop):
+        self.event_loop = event_loop
+        self._pending = collections.defaultdict(collections.deque)
+        # futures waiting out retry backoff, by scope, and a
+        # heap of (time, seq, future) to start them again.
+        self._backoff = {}
+        self._retries = []
+        self._retry_seq = itertools.count()
+        # (future, done) of bursts being written
+        self._bursts = []
+        self._broadcast_callbacks = collections.defaultdict(list)
+        super(AsyncSession, self).__init__(core)
+
+    def _start(self):
+        if not self.running:
+            self.running = True
+            self.event_loop.add(self)
+            self.reset_system()
+
+    def close(self):
+        try:
+            if self.running: self.reset_system()
+        finally:
+            self.event_loop.remove(self)
+            self._shutdown()
+            self.core.close()
+
+    def _claim(self, future):
+        retry = future.tries > 1
+        with self._cond:
+            if self._backoff.get(future.scope) is future:
+                del self._backoff[future.scope]
+            # new commands also wait behind queued ones, a retry goes first
+            if self.running and (future.scope in self._running or future.scope in self._backoff
+                    or (self._pending.get(future.scope) and not retry)):
+                if retry: self._pending[future.scope].appendleft(future)
+                else: self._pending[future.scope].append(future)
+                return False
+            elif self.running:
+                return super(AsyncSession, self)._claim(future)
+        future.error = ant.AntError("Session closed.")
+        future.done.set()
+        self._finish(future)
+        return False
+
+    def _on_complete(self, future):
+        # a retry keeps the scope, otherwise start the next command queued for it
+        if not self._retry(future):
+            self._finish(future)
+            self._start_next(future.scope)
+
+    def _start_next(self, scope):
+        with self._cond:
+            pending = self._pending.get(scope)
+            if not pending or scope in self._running or scope in self._backoff:
+                return
+            future = pending.popleft()
+            claimed = super(AsyncSession, self)._claim(future)
+        if claimed: self._write(future)
+
+    def _write(self, future):
+        if isinstance(future.cmd, ant.SendBurstData):
+            # see _write_bursts()
+            future.cmd.restart()
+            with self._cond:
+                self._bursts.append((future, future.done))
+        else:
+            super(AsyncSession, self)._write(future)
+
+    def _write_bursts(self):
+        """
+        Write the next packets of each burst being sent,
+        at most burst_writes_per_poll writes each, so the
+        loop can read replies (e.g. EVENT_TRANSFER_TX_FAILED)
+        between writes. Returns true if any burst has more
+        packets to write.
+        """
+        with self._cond:
+            bursts = list(self._bursts)
+        for entry in bursts:
+            future, done = entry
+            cmd = future.cmd
+            for n in xrange(self.burst_writes_per_poll):
+                if not self.running or done.is_set() or not cmd.has_more_data: break
+                count, msg = cmd.pack_next_packets(self.core.max_write_size)
+                if self.core.write(msg): cmd.incr_packet_index(count)
+                else: _log.warning("Device write timeout. Will keep trying.")
+            if not self.running or done.is_set() or not cmd.has_more_data:
+                with self._cond:
+                    self._bursts.remove(entry)
+        return bool(self._bursts)
+
+    def _retransmit(self, future, delay):
+        # the loop thread must not sleep, the scope is held for
+        # future until the retry is started by _handle_idle().
+        if not delay:
+            self._transmit(future)
+        else:
+            with self._cond:
+                self._backoff[future.scope] = future
+                heapq.heappush(self._retries, (time.time() + delay, next(self._retry_seq), future))
+
+    def _wait(self, future):
+        future._finished.wait()
+        return future._outcome()
+
+    def _handle_idle(self):
+        now = time.time()
+        with self._cond:
+            due = []
+            while self._retries and self._retries[0][0] <= now:
+                due.append(heapq.heappop(self._retries)[2])
+        for future in due:
+            self._transmit(future)
+        super(AsyncSession, self)._handle_idle()
+
+    def _handle_read(self, cmd=None):
+        if isinstance(cmd, ant.RecvBroadcastData):
+            for callback in list(self._broadcast_callbacks.get(cmd.channel_number, ())):
+                try: callback(cmd.data)
+                except Exception: _log.warning("Broadcast callback failed. %s", callback, exc_info=True)
+        super(AsyncSession, self)._handle_read(cmd)
+
+    def _shutdown(self):
+        super(AsyncSession, self)._shutdown()
+        with self._cond:
+            pending = [f for q in self._pending.values() for f in q] + [r[2] for r in self._retries]
+            self._pending.clear()
+            self._backoff.clear()
+            del self._retries[:]
+            del self._bursts[:]
+        for future in pending:
+            future.error = ant.AntError("Session closed.")
+            future.done.set()
+            self._finish(future)
+
+
+# vim: ts=4 sts=4 et
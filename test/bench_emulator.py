@@ -0,0 +1,59 @@
+#!/usr/bin/python
+
+import sys
+import time
+import logging
+import argparse
+
+import antd.ant as ant
+import antd.antfs as antfs
+import antd.garmin as garmin
+import antd.emulator as emulator
+
+logging.basicConfig(
+        level=logging.INFO,
+        out=sys.stderr,
+        format="[%(threadName)s]\t%(asctime)s\t%(levelname)s\t%(message)s")
+
+_LOG = logging.getLogger()
+
+# run the full download path (search, link, auth, get_runs)
+# against an emulated device, and report timing.
+parser = argparse.ArgumentParser()
+parser.add_argument("--runs", type=int, default=10)
+parser.add_argument("--trackpoints", type=int, default=10000)
+parser.add_argument("--speed", type=float, default=100,
+        help="emulated rf time runs this many times faster than real time")
+parser.add_argument("--drop-rate", type=float, default=0)
+parser.add_argument("--burst-failure-rate", type=float, default=0)
+parser.add_argument("--packets-per-reply", type=int, default=1,
+        help="garmin packets the emulated device sends per burst")
+parser.add_argument("--batch-acks", action="store_const", const=True,
+        help="ACK all packets of a burst with one write")
+args = parser.parse_args()
+
+stick = emulator.create_hardware(speed=args.speed, drop_rate=args.drop_rate,
+        burst_failure_rate=args.burst_failure_rate, runs=args.runs, trackpoints=args.trackpoints,
+        packets_per_reply=args.packets_per_reply)
+host = antfs.Host(ant.Session(ant.Core(stick)))
+try:
+    start = time.time()
+    host.search(include_unpaired_devices=True)
+    _LOG.info("search %.3fs", time.time() - start)
+    host.link()
+    host.auth(pair=True)
+    _LOG.info("auth %.3fs", time.time() - start)
+    dev = garmin.Device(host, batch_acks=args.batch_acks)
+    download_start = time.time()
+    runs = garmin.extract_runs(dev, dev.get_runs())
+    elapsed = time.time() - download_start
+    points = sum(len(run.wpts) for run in runs)
+    _LOG.info("get_runs %.3fs, %d run(s), %d trackpoint(s), %.1f trackpoints/sec",
+            elapsed, len(runs), points, points / elapsed)
+    host.disconnect()
+finally:
+    try: host.close()
+    except: _LOG.warning("Caught exception while resetting system.", exc_info=True)
+
+
+# vim: ts=4 sts=4 et
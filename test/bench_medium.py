@@ -0,0 +1,115 @@
+#!/usr/bin/python
+
+import sys
+import time
+import logging
+import argparse
+import threading
+
+import antd.ant as ant
+import antd.emulator as emulator
+
+logging.basicConfig(
+        level=logging.INFO,
+        out=sys.stderr,
+        format="[%(threadName)s]\t%(asctime)s\t%(levelname)s\t%(message)s")
+
+_LOG = logging.getLogger()
+
+# measure how Session scales with concurrent channels.
+# half the sticks open master channels, the other half
+# open slave channels, each slave tracks one master
+# and sends acknowledged data (or bursts) as fast as
+# the channel period allows.
+parser = argparse.ArgumentParser()
+parser.add_argument("--sticks", type=int, default=4)
+parser.add_argument("--channels", type=int, default=8, help="channels per stick")
+parser.add_argument("--duration", type=float, default=10, help="real seconds")
+parser.add_argument("--speed", type=float, default=1,
+        help="emulated rf time runs this many times faster than real time")
+parser.add_argument("--period", type=lambda s: int(s, 0), default=0x2000,
+        help="channel period, in 1/32768 seconds")
+parser.add_argument("--freqs", type=int, default=0,
+        help="rf frequencies shared between pairs, default one per pair")
+parser.add_argument("--burst", type=int, default=0, help="send bursts of this many bytes")
+parser.add_argument("--drop-rate", type=float, default=0)
+args = parser.parse_args()
+
+air = emulator.Air(emulator.Scheduler(args.speed), drop_rate=args.drop_rate)
+sessions = [ant.Session(ant.Core(emulator.EmulatedStick(air, max_channels=args.channels, serial_number=n + 1)))
+        for n in xrange(0, args.sticks)]
+masters = [c for s in sessions[:args.sticks // 2] for c in s.channels]
+slaves = [c for s in sessions[args.sticks // 2:] for c in s.channels]
+pairs = zip(masters, slaves)
+freqs = args.freqs or len(pairs)
+running = True
+lock = threading.Lock()
+counts = {"ok": 0, "failed": 0, "bytes": 0}
+latencies = []
+
+def configure(channel, channel_type, device_number, rf_freq):
+    channel.assign(channel_type=channel_type, network_number=0)
+    channel.set_id(device_number=device_number, device_type_id=1, trans_type=1)
+    channel.set_period(args.period)
+    channel.set_search_timeout(0xFF)
+    channel.set_rf_freq(rf_freq)
+    channel.open()
+
+def drain(channel):
+    while running:
+        try: channel.read(timeout=1)
+        except ant.AntError: pass
+
+def send(channel):
+    data = "x" * (args.burst or 8)
+    while running:
+        start = time.time()
+        try:
+            if args.burst: channel.send_burst(data)
+            else: channel.send_acknowledged(data)
+            result = "ok"
+        except ant.AntError:
+            result = "failed"
+        with lock:
+            counts[result] += 1
+            if result == "ok":
+                counts["bytes"] += len(data)
+                latencies.append(time.time() - start)
+
+threads = []
+try:
+    for session in sessions:
+        session.networks[0].set_key("\x00" * 8)
+    for n, (master, slave) in enumerate(pairs):
+        configure(master, 0x10, n + 1, 2 + n % freqs * 2)
+        configure(slave, 0x00, n + 1, 2 + n % freqs * 2)
+    for n, (master, slave) in enumerate(pairs):
+        try: slave.recv_broadcast(timeout=10)
+        except ant.AntError: _LOG.warning("Slave-%d did not find its master.", n)
+        threads.append(threading.Thread(target=drain, args=(master,), name="Master-%d" % n))
+        threads.append(threading.Thread(target=send, args=(slave,), name="Slave-%d" % n))
+    start = time.time()
+    for thread in threads: thread.start()
+    time.sleep(args.duration)
+    running = False
+    for thread in threads: thread.join()
+    elapsed = time.time() - start
+    latencies.sort()
+    _LOG.info("%d stick(s) x %d channel(s), %d pair(s) on %d freq(s), %.1fx speed",
+            args.sticks, args.channels, len(pairs), freqs, args.speed)
+    _LOG.info("%d transfer(s) ok, %d failed, %.1f transfers/sec, %.1f bytes/sec",
+            counts["ok"], counts["failed"], counts["ok"] / elapsed, counts["bytes"] / elapsed)
+    if latencies:
+        _LOG.info("latency median %.1fms, p90 %.1fms, max %.1fms",
+                latencies[len(latencies) // 2] * 1000, latencies[len(latencies) * 9 // 10] * 1000,
+                latencies[-1] * 1000)
+    _LOG.info("%d collision(s), %d drop(s)", air.collisions, air.drops)
+finally:
+    running = False
+    # slaves first, so they do not lose their masters
+    for session in reversed(sessions):
+        try: session.close()
+        except: _LOG.warning("Caught exception while resetting system.", exc_info=True)
+
+
+# vim: ts=4 sts=4 et
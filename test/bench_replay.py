@@ -0,0 +1,55 @@
+#!/usr/bin/python
+
+import sys
+import time
+import logging
+import argparse
+
+import antd.ant as ant
+import antd.antfs as antfs
+import antd.garmin as garmin
+import antd.hw as hw
+
+logging.basicConfig(
+        level=logging.INFO,
+        out=sys.stderr,
+        format="[%(threadName)s]\t%(asctime)s\t%(levelname)s\t%(message)s")
+
+_LOG = logging.getLogger()
+
+# replay a capture recorded with [antd.hw] capture_file through the
+# full download path (search, link, auth, get_runs) and report timing.
+parser = argparse.ArgumentParser()
+parser.add_argument("capture", help="capture file written by RecordingHardware")
+parser.add_argument("--realtime", action="store_const", const=True,
+        help="delay replies to match recorded timing")
+parser.add_argument("--keys", metavar="f",
+        help="auth pairing keys used when capture was recorded")
+parser.add_argument("--batch-acks", action="store_const", const=True,
+        help="ACK all packets of a burst with one write, as [antd] batch_acks")
+args = parser.parse_args()
+
+replay = hw.ReplayHardware(args.capture, realtime=args.realtime)
+host = antfs.Host(ant.Session(ant.Core(replay)), antfs.KnownDeviceDb(args.keys))
+try:
+    start = time.time()
+    beacon = host.search(include_unpaired_devices=True, include_devices_with_no_data=True)
+    _LOG.info("search %.3fs", time.time() - start)
+    if not beacon: sys.exit("No device found in capture.")
+    host.link()
+    _LOG.info("link %.3fs", time.time() - start)
+    host.auth(pair=True)
+    _LOG.info("auth %.3fs", time.time() - start)
+    dev = garmin.Device(host, batch_acks=args.batch_acks)
+    dev.get_product_data()
+    runs = dev.get_runs()
+    _LOG.info("get_runs %.3fs", time.time() - start)
+    host.disconnect()
+    _LOG.info("done %.3fs, %d write(s) differed from capture, %d record(s) unused",
+            time.time() - start, replay.mismatches, replay.remaining)
+finally:
+    try: host.close()
+    except: _LOG.warning("Caught exception while resetting system.", exc_info=True)
+
+
+# vim: ts=4 sts=4 et
@@ -0,0 +1,93 @@
+#!/usr/bin/python
+
+import sys
+import time
+import array
+import logging
+import argparse
+
+import antd.ant as ant
+import antd.hw as hw
+
+logging.basicConfig(
+        level=logging.INFO,
+        out=sys.stderr,
+        format="[%(threadName)s]\t%(asctime)s\t%(levelname)s\t%(message)s")
+
+_LOG = logging.getLogger()
+
+def burst_capture(packets, read_size=16384):
+    """
+    Build the reads UsbHardware would return while
+    receiving a burst of the given number of packets.
+    Reads are split at read_size, so messages can
+    straddle two reads.
+    """
+    stream = array.array("B")
+    for n in xrange(0, packets):
+        seq = 0 if not n else (n - 1) % 3 + 1
+        channel_number = (seq << 5) | (0x80 if n == packets - 1 else 0x00)
+        msg = [ant.SYNC, 9, ant.RecvBurstTransferPacket.ID, channel_number] + [n & 0xFF] * 8
+        msg.append(ant.generate_checksum(msg))
+        stream.extend(msg)
+    return [stream[n:n + read_size] for n in xrange(0, len(stream), read_size)]
+
+def legacy_recv(core, reads):
+    """
+    Tokenizer prior to MessageTokenizer, re-slices
+    the read for every message and copies again in unpack.
+    Messages are not allowed to straddle reads.
+    """
+    count = 0
+    for read in reads:
+        while read:
+            length = read[1]
+            msg = read[:4 + length]
+            read = read[4 + length:]
+            if ant.validate_checksum(msg):
+                core.input_msg_by_id[msg[2]].unpack_args(array.array("B", msg[3:-1]).tostring())
+                count += 1
+    return count
+
+def recv(core, reads):
+    count = 0
+    for read in reads:
+        for msg_id, msg in core.tokenizer.tokenize(read):
+            core.unpack(msg_id, msg)
+            count += 1
+    return count
+
+def bench(name, fn, core, reads, repeat=5):
+    best = None
+    for n in xrange(0, repeat):
+        start = time.time()
+        count = fn(core, reads)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    _LOG.info("%s: %d msgs, %.1f msgs/sec", name, count, count / best)
+
+def captured_reads(path):
+    """
+    Reads recorded by RecordingHardware ([antd.hw] capture_file).
+    """
+    with open(path, "rb") as file:
+        return [array.array("B", data) for usec, direction, data in hw.read_capture(file)
+                if direction == hw.CAPTURE_IN]
+
+parser = argparse.ArgumentParser()
+parser.add_argument("capture", nargs="?",
+        help="tokenize reads from a capture file rather than a synthetic burst")
+args = parser.parse_args()
+
+if args.capture:
+    # legacy tokenizer drops messages split across reads, counts may differ
+    reads = captured_reads(args.capture)
+else:
+    # legacy tokenizer can't handle split messages, so keep reads message aligned
+    reads = burst_capture(10000, read_size=13 * 1260)
+core = ant.Core(hardware=None)
+bench("legacy", legacy_recv, core, reads)
+bench("tokenizer", recv, core, reads)
+
+
+# vim: ts=4 sts=4 et
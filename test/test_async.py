@@ -0,0 +1,76 @@
+#!/usr/bin/python
+
+import sys
+import logging
+import threading
+
+import antd.ant as ant
+import antd.emulator as emulator
+import antd.reactor as reactor
+
+logging.basicConfig(
+        level=logging.DEBUG,
+        out=sys.stderr,
+        format="[%(threadName)s]\t%(asctime)s\t%(levelname)s\t%(message)s")
+
+_LOG = logging.getLogger()
+
+# test_medium.py through AsyncSession, both sticks serviced
+# by one EventLoop. The master reads with callbacks on the
+# loop thread instead of a thread of its own.
+air = emulator.Air(emulator.Scheduler(speed=1.0))
+loop = reactor.EventLoop()
+master = reactor.AsyncSession(ant.Core(emulator.EmulatedStick(air, serial_number=1)), loop)
+slave = reactor.AsyncSession(ant.Core(emulator.EmulatedStick(air, serial_number=2)), loop)
+
+def configure(session, channel_type, search_timeout):
+    channel = session.channels[0]
+    session.networks[0].set_key("\x00" * 8)
+    channel.assign(channel_type=channel_type, network_number=0)
+    channel.set_id(device_number=0, device_type_id=0, trans_type=0)
+    channel.set_period(0x4000)
+    channel.set_search_timeout(search_timeout)
+    channel.set_rf_freq(40)
+    # commands on a channel run in order, waiting on the last waits on all
+    channel.open().result()
+    return channel
+
+received = []
+master_closed = threading.Event()
+
+def read(channel):
+    def on_read(future):
+        try:
+            data = future.result()
+        except Exception:
+            _LOG.info("Master closed.")
+            master_closed.set()
+        else:
+            _LOG.info("READ %s", data)
+            received.append(data)
+            read(channel)
+    channel.read(timeout=10).add_done_callback(on_read)
+
+try:
+    channel = configure(master, 0x30, 20)
+    channel.send_broadcast("testtest").result()
+    read(channel)
+    channel = configure(slave, 0x00, 4)
+    _LOG.info("BROADCAST: %s", channel.recv_broadcast(timeout=0).result())
+    channel.send_acknowledged("ack").result()
+    channel.send_burst("burst").result()
+    channel.send_burst("burst" * 10).result()
+    channel.write("write").result()
+finally:
+    for session in (slave, master):
+        try: session.close()
+        except: _LOG.warning("Caught exception while resetting system.", exc_info=True)
+    master_closed.wait(10)
+    loop.stop()
+
+_LOG.info("RECEIVED %r", received)
+assert len(received) == 4, "master received %d of 4 messages" % len(received)
+assert received[2].startswith("burst" * 10)
+
+
+# vim: ts=4 sts=4 et
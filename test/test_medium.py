@@ -0,0 +1,59 @@
+#!/usr/bin/python
+
+import sys
+import logging
+import threading
+
+import antd.ant as ant
+import antd.emulator as emulator
+
+logging.basicConfig(
+        level=logging.DEBUG,
+        out=sys.stderr,
+        format="[%(threadName)s]\t%(asctime)s\t%(levelname)s\t%(message)s")
+
+_LOG = logging.getLogger()
+
+# test_master.py and test_slave.py, on two emulated sticks sharing the same air
+air = emulator.Air(emulator.Scheduler(speed=1.0))
+master = ant.Session(ant.Core(emulator.EmulatedStick(air, serial_number=1)))
+slave = ant.Session(ant.Core(emulator.EmulatedStick(air, serial_number=2)))
+
+def configure(session, channel_type, search_timeout):
+    channel = session.channels[0]
+    session.networks[0].set_key("\x00" * 8)
+    channel.assign(channel_type=channel_type, network_number=0)
+    channel.set_id(device_number=0, device_type_id=0, trans_type=0)
+    channel.set_period(0x4000)
+    channel.set_search_timeout(search_timeout)
+    channel.set_rf_freq(40)
+    channel.open()
+    return channel
+
+def read(channel):
+    try:
+        while True:
+            _LOG.info("READ %s", channel.read(timeout=10))
+    except Exception:
+        _LOG.info("Master closed.")
+
+reader = None
+try:
+    channel = configure(master, 0x30, 20)
+    channel.send_broadcast("testtest")
+    reader = threading.Thread(target=read, args=(channel,), name="Master")
+    reader.start()
+    channel = configure(slave, 0x00, 4)
+    _LOG.info("BROADCAST: %s", channel.recv_broadcast(timeout=0))
+    channel.send_acknowledged("ack")
+    channel.send_burst("burst")
+    channel.send_burst("burst" * 10)
+    channel.write("write")
+finally:
+    for session in (slave, master):
+        try: session.close()
+        except: _LOG.warning("Caught exception while resetting system.", exc_info=True)
+    if reader: reader.join()
+
+
+# vim: ts=4 sts=4 et
@@ -0,0 +1,59 @@
+#!/usr/bin/python
+
+import os
+import sys
+import shutil
+import logging
+import tempfile
+
+import antd.ant as ant
+import antd.antfs as antfs
+import antd.garmin as garmin
+import antd.emulator as emulator
+import antd.hw as hw
+
+logging.basicConfig(
+        level=logging.WARNING,
+        out=sys.stderr,
+        format="[%(threadName)s]\t%(asctime)s\t%(levelname)s\t%(message)s")
+
+_LOG = logging.getLogger()
+
+# record a download from an emulated device with RecordingHardware,
+# replay the capture with ReplayHardware, and check that replay
+# makes the same writes and returns the same runs.
+
+def download(stick, keys):
+    host = antfs.Host(ant.Session(ant.Core(stick)), antfs.KnownDeviceDb(keys))
+    # transport frequency is chosen at random, make it the same in both runs
+    host.link_quality.random.seed(0)
+    try:
+        host.search(include_unpaired_devices=True, include_devices_with_no_data=True)
+        host.link()
+        host.auth(pair=True)
+        dev = garmin.Device(host)
+        dev.get_product_data()
+        runs = dev.get_runs()
+        host.disconnect()
+        return [(run.time.gmtime, len(run.wpts)) for run in garmin.extract_runs(dev, runs)]
+    finally:
+        try: host.close()
+        except: _LOG.warning("Caught exception while resetting system.", exc_info=True)
+
+dir = tempfile.mkdtemp()
+try:
+    capture = os.path.join(dir, "capture.antcap")
+    stick = emulator.create_hardware(speed=20, runs=3, trackpoints=300)
+    recorded = download(hw.RecordingHardware(stick, capture), os.path.join(dir, "record.cfg"))
+    replay = hw.ReplayHardware(capture)
+    replayed = download(replay, os.path.join(dir, "replay.cfg"))
+    print "recorded %d run(s), replayed %d run(s), %d write(s) differed, %d record(s) unused" % (
+            len(recorded), len(replayed), replay.mismatches, replay.remaining)
+    assert recorded, "no runs recorded"
+    assert recorded == replayed, "replay returned different runs"
+    assert not replay.mismatches, "replay writes differ from capture"
+finally:
+    shutil.rmtree(dir)
+
+
+# vim: ts=4 sts=4 et
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2012, Braiden Kindt.
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 
+#   1. Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+# 
+#   2. Redistributions in binary form must reproduce the above
+#      copyright notice, this list of conditions and the following
+#      disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDER AND CONTRIBUTORS
+# ''AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY
+# WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+import sys
+import logging
+
+import antd.ant as ant
+import antd.hw as hw
+import antd.cfg as cfg
+
+cfg.init_loggers(logging.DEBUG, out=sys.stderr)
+
+if len(sys.argv) != 2:
+	print "usage: %s <file>" % sys.argv[0]
+	sys.exit(1)
+
+# decode a trace (hw.TracingHardware) or capture (hw.RecordingHardware)
+messages = {
+	hw.CAPTURE_IN: dict((m.ID, m) for m in ant.ALL_ANT_COMMANDS if m.DIRECTION == ant.DIR_IN),
+	hw.CAPTURE_OUT: dict((m.ID, m) for m in ant.ALL_ANT_COMMANDS if m.DIRECTION == ant.DIR_OUT),
+}
+tokenizers = {
+	hw.CAPTURE_IN: ant.MessageTokenizer(),
+	hw.CAPTURE_OUT: ant.MessageTokenizer(),
+}
+
+with open(sys.argv[1], "rb") as file:
+	for usec, direction, data in hw.read_capture(file):
+		# Core.write() pads every write with two zeros
+		if direction == hw.CAPTURE_OUT and data.endswith("\x00\x00"): data = data[:-2]
+		for msg_id, msg in tokenizers[direction].tokenize(data):
+			try:
+				cmd = messages[direction][msg_id].unpack_args(msg[3:-1])
+			except KeyError:
+				cmd = ant.UnimplementedCommand(msg_id, msg.tobytes())
+			print "%12.6f %s %s" % (usec / 1000000., "<<" if direction == hw.CAPTURE_IN else ">>", cmd)